@@ -10,21 +10,131 @@ make some interpretations. Contributions, fixes and additions welcome!
 
 """
 
-from datetime import datetime
-import pandas as pd
-from pandas.tseries.offsets import DateOffset
+import sys
+import types
+import importlib
+from datetime import datetime, timedelta
+
+
+# Submodules and classes are imported the first time they are used (PEP 562),
+# so that importing the package doesn't load pandas, numpy or requests.
+# name -> (submodule, attribute)
+_lazy = {
+    # Functions to query event data
+    'eventData': ('eventData', 'eventData'),
+    # Functions to interpret event data json files
+    'eventRecord': ('eventRecord', 'eventRecord'),
+    # Events per object in date order, for range queries
+    'eventIndex': ('eventIndex', 'eventIndex'),
+    # Samples of events with estimated counts
+    'eventSample': ('eventSample', 'eventSample'),
+    # Graph of relations between subjects and objects
+    'relationGraph': ('relationGraph', 'relationGraph'),
+    # Matching many substrings in one pass
+    'patternMatcher': ('patternMatcher', 'patternMatcher'),
+
+    'evidenceRecords': ('evidenceRecords', 'evidenceRecords'),
+    # Bulk fetching of evidence records into a local archive
+    'evidenceArchive': ('evidenceArchive', 'evidenceArchive'),
+    # Domain counts across many evidence records
+    'domainAnalytics': ('domainAnalytics', 'domainAnalytics'),
+    'activityLogs': ('activityLogs', 'activityLogs'),
+    # Indexes of activity log entries
+    'activityIndex': ('activityIndex', 'activityIndex'),
+    # Per-hour aggregates over ranges of activity logs
+    'activityAggregate': ('activityAggregate', 'activityAggregate'),
+
+    # Streaming pipelines from activity logs to events
+    'pipeline': ('pipeline', 'pipeline'),
+    'eventsFromLogs': ('pipeline', 'eventsFromLogs'),
+
+    # Aggregates updated by eventData.tail(), for live dashboards
+    'liveAggregates': ('liveAggregates', 'liveAggregates'),
+    'countBy': ('liveAggregates', 'countBy'),
+    'recentActivity': ('liveAggregates', 'recentActivity'),
+
+    # Harvests of many prefixes with per-host budgets
+    'harvestScheduler': ('harvestScheduler', 'harvestScheduler'),
+
+    # Synthetic corpora and benchmarks of the analysis methods
+    'syntheticEvents': ('syntheticEvents', 'syntheticEvents'),
+    'benchmark': ('benchmark', 'benchmark'),
+    # Local stand-in for the APIs, for offline and load testing
+    'mockServer': ('mockServer', 'mockServer'),
+
+    # Instrumentation of HTTP calls and analysis methods
+    'metrics': ('instrument', 'metrics'),
+    'callbackSink': ('instrument', 'callbackSink'),
+    'jsonLogSink': ('instrument', 'jsonLogSink'),
+    'prometheusSink': ('instrument', 'prometheusSink'),
+    'rateLimiter': ('instrument', 'rateLimiter'),
+    'hostRateLimiter': ('instrument', 'hostRateLimiter'),
+
+    # Responses written to disk as they arrive, parsed when used
+    'rawJson': ('rawJson', 'rawJson'),
+
+    # Daily works snapshots stored as deltas
+    'worksSnapshots': ('worksSnapshots', 'worksSnapshots'),
+
+    # Counts of values spilled to disk past a memory budget
+    'externalHist': ('externalHist', 'externalHist'),
+
+    # Chart data reduced to a bounded size
+    'chartData': ('chartData', 'chartData'),
+
+    # Evidence records and event ids already handled, kept across runs
+    'seenSet': ('seenSet', 'seenSet'),
+
+    # Incremental, cached builds of reports
+    'reportBuild': ('reportBuild', 'reportBuild'),
+    'journalReport': ('reportBuild', 'journalReport'),
+
+    # Function to query the REST API
+    'restApi': ('restApi', 'restApi'),
+    # Compiled extraction of records from REST API works
+    'workExtractor': ('workExtractor', 'workExtractor'),
+
+    # Async clients for asyncio services, need aiohttp
+    'asyncHttp': ('asyncApi', 'asyncHttp'),
+    'asyncEventData': ('asyncApi', 'asyncEventData'),
+    'asyncRestApi': ('asyncApi', 'asyncRestApi'),
+}
+
+__all__ = list(_lazy) + ['lastNmonths']
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
+
+    module, attr = _lazy[name]
+    value = getattr(importlib.import_module('.' + module, __name__), attr)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
+
+
+class _package(types.ModuleType):
+    '''
+    Most submodules have the same name as the class they hold. Importing a
+    submodule sets it as an attribute of the package, which would hide the
+    class, so the class is kept instead, as it was when every submodule was
+    imported here.
 
+    '''
 
-# Functions to query event data
-from .eventData import eventData
-# Functions to interpret event data json files
-from .eventRecord import eventRecord
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and name in _lazy and \
+                value.__name__ == __name__ + '.' + _lazy[name][0]:
+            value = getattr(value, _lazy[name][1], value)
+        super().__setattr__(name, value)
 
-from .evidenceRecords import evidenceRecords
-from .activityLogs import activityLogs
 
-# Function to query the REST API
-from .restApi import restApi
+sys.modules[__name__].__class__ = _package
 
 # Function to get the last n months
 
@@ -54,8 +164,17 @@ def lastNmonths(n: int) -> list:
 
     '''
 
-    start = (datetime.utcnow().date() + DateOffset(months=-n)).date()
-    return [
-        (f"{d.year}-{d.month:02}-01", f"{d.year}-{d.month:02}-{d.day}")
-        for d in pd.date_range(start, periods=n, freq="M")
-    ]
+    # count months from year 0, starting n months before this one
+    today = datetime.utcnow().date()
+    first = today.year * 12 + today.month - 1 - n
+
+    months = []
+    for m in range(first, first + n):
+        year, month = divmod(m, 12)
+        month += 1
+        # the last day is the day before the first day of the next month
+        nextYear, nextMonth = divmod(m + 1, 12)
+        last = (datetime(nextYear, nextMonth + 1, 1) - timedelta(days=1)).day
+        months.append((f"{year}-{month:02}-01", f"{year}-{month:02}-{last}"))
+
+    return months
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+python -m mrced2, see cli.py
+
+@author: martynrittman
+"""
+
+import sys
+
+from mrced2.cli import main
+
+sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-hour aggregates of activity logs over a range of hours.
+
+@author: martynrittman
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+def hourRange(start, end):
+    '''
+    List of hours from start to end (inclusive) in the format used by
+    activityLogs.buildQuery, e.g. 2021-01-01T01.
+
+    Parameters
+    ----------
+    start, end : str or datetime
+        YYYY-MM-DDTHH or YYYY-MM-DD (midnight), or datetime objects
+
+    '''
+
+    def toDatetime(d):
+        if isinstance(d, datetime):
+            return d.replace(minute=0, second=0, microsecond=0)
+        if len(d) >= 13:
+            return datetime.strptime(d[:13], '%Y-%m-%dT%H')
+        return datetime.strptime(d[:10], '%Y-%m-%d')
+
+    h = toDatetime(start)
+    last = toDatetime(end)
+
+    hours = []
+    while h <= last:
+        hours.append(h.strftime('%Y-%m-%dT%H'))
+        h += timedelta(hours=1)
+
+    return hours
+
+
+def summariseHour(entries, recordKey='r', agentKey='c', statusKey='e'):
+    '''
+    Count the entries of one hour's log.
+
+    Returns
+    -------
+    dict:
+        lines, records (number of distinct evidence records), and dicts of
+        counts per agent and per outcome
+
+    '''
+
+    lines = 0
+    records = set()
+    agents = {}
+    outcomes = {}
+    for entry in entries:
+        lines += 1
+        # a literal line can give a list or dict, which isn't a record
+        evrec = entry.get(recordKey)
+        if isinstance(evrec, str):
+            records.add(evrec)
+        agent = entry.get(agentKey)
+        if agent is not None:
+            if not isinstance(agent, str):
+                agent = str(agent)
+            agents[agent] = agents.get(agent, 0) + 1
+        status = entry.get(statusKey)
+        if status is not None:
+            status = str(status)
+            outcomes[status] = outcomes.get(status, 0) + 1
+
+    return {'lines': lines, 'records': len(records), 'agents': agents,
+            'outcomes': outcomes, 'malformed': 0}
+
+
+class activityAggregate:
+    '''
+    Compact per-hour aggregates of activity logs. Each hour is folded into
+    counts as soon as it has been read, and the lines aren't kept.
+
+    Arrays (one element per hour in self.hours):
+        self.lines - number of log entries
+        self.records - number of distinct evidence records
+        self.fetched - 1 if the hour's log was read successfully
+        self.malformed - number of lines that couldn't be parsed
+        self.agents - agent -> array of entry counts
+        self.outcomes - status -> array of entry counts
+
+    basic usage:
+        al = activityLogs()
+        agg = al.ingestRange('2021-01-01T00', '2021-01-31T23', workers=8)
+        agg.toDataFrame()
+
+    '''
+
+    recordKey = 'r'
+    agentKey = 'c'
+    statusKey = 'e'
+
+    def __init__(self, hours):
+        '''
+        Parameters
+        ----------
+        hours : list of str
+            the hours covered, e.g. from hourRange()
+
+        '''
+
+        self.hours = list(hours)
+        self.position = {h: i for i, h in enumerate(self.hours)}
+
+        n = len(self.hours)
+        self.lines = np.zeros(n, dtype=np.int64)
+        self.records = np.zeros(n, dtype=np.int64)
+        self.fetched = np.zeros(n, dtype=np.int8)
+        self.malformed = np.zeros(n, dtype=np.int64)
+        self.agents = {}
+        self.outcomes = {}
+
+    def _column(self, table, key):
+        ''' the array for key in table (agents or outcomes), made if needed '''
+
+        try:
+            return table[key]
+        except KeyError:
+            table[key] = np.zeros(len(self.hours), dtype=np.int64)
+            return table[key]
+
+    def foldHour(self, hour, entries, malformed=0):
+        '''
+        Count the entries of one hour's log and store the counts.
+
+        Parameters
+        ----------
+        hour : str
+            one of self.hours
+        entries : iterable of dicts
+            log entries, e.g. activityLogs.iterLogs()
+        malformed : int
+            number of malformed lines in the log
+
+        '''
+
+        counts = summariseHour(entries, self.recordKey, self.agentKey, self.statusKey)
+        counts['malformed'] = malformed
+        self.fold(hour, counts)
+
+    def fold(self, hour, counts):
+        '''
+        Store the counts for one hour, as produced by summariseHour().
+        Called from one thread only, so no locking is needed.
+
+        '''
+
+        i = self.position[hour]
+        self.fetched[i] = 1
+        self.lines[i] = counts['lines']
+        self.records[i] = counts['records']
+        self.malformed[i] = counts['malformed']
+
+        for agent, n in counts['agents'].items():
+            self._column(self.agents, agent)[i] = n
+        for status, n in counts['outcomes'].items():
+            self._column(self.outcomes, status)[i] = n
+
+    # =====================================
+
+    # Output
+
+    def missingHours(self):
+        ''' hours whose logs couldn't be read '''
+
+        return [h for h, f in zip(self.hours, self.fetched) if not f]
+
+    def totals(self):
+        ''' totals over the whole range '''
+
+        return {'hours': int(self.fetched.sum()),
+                'lines': int(self.lines.sum()),
+                'malformed': int(self.malformed.sum()),
+                'agents': {a: int(c.sum()) for a, c in self.agents.items()},
+                'outcomes': {s: int(c.sum()) for s, c in self.outcomes.items()}}
+
+    def toDataFrame(self):
+        ''' pandas DataFrame with one row per hour, agents and outcomes as columns '''
+
+        import pandas as pd
+
+        data = {'lines': self.lines, 'records': self.records,
+                'malformed': self.malformed, 'fetched': self.fetched}
+        for agent, c in self.agents.items():
+            data['agent:' + str(agent)] = c
+        for status, c in self.outcomes.items():
+            data['outcome:' + str(status)] = c
+
+        return pd.DataFrame(data, index=pd.to_datetime(self.hours, format='%Y-%m-%dT%H'))
+
+    def save(self, filename):
+        ''' save the aggregates to a compressed .npz file '''
+
+        agents = list(self.agents)
+        outcomes = list(self.outcomes)
+        np.savez_compressed(
+            filename, hours=np.array(self.hours), lines=self.lines,
+            records=self.records, fetched=self.fetched, malformed=self.malformed,
+            agentNames=np.array(json.dumps(agents)),
+            outcomeNames=np.array(json.dumps(outcomes)),
+            agents=np.array([self.agents[a] for a in agents]).reshape(len(agents), len(self.hours)),
+            outcomes=np.array([self.outcomes[s] for s in outcomes]).reshape(len(outcomes), len(self.hours)))
+
+    @classmethod
+    def load(cls, filename):
+        ''' load aggregates saved with save() '''
+
+        d = np.load(filename)
+        agg = cls([str(h) for h in d['hours']])
+        agg.lines = d['lines']
+        agg.records = d['records']
+        agg.fetched = d['fetched']
+        agg.malformed = d['malformed']
+        agg.agents = dict(zip(json.loads(str(d['agentNames'])), d['agents']))
+        agg.outcomes = dict(zip(json.loads(str(d['outcomeNames'])), d['outcomes']))
+
+        return agg
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Indexed view of Crossref Event Data activity logs.
+
+@author: martynrittman
+"""
+
+import time
+import calendar
+from datetime import datetime, timezone
+
+try:
+    from mrced2.eventIndex import utcStamp
+except:
+    from eventIndex import utcStamp
+
+
+class activityIndex:
+    '''
+    Holds parsed activity log entries in indexes rather than as a list, so
+    that questions about evidence records, agents and failures don't need a
+    scan of every line. Entries from several hourly logs can be added to the
+    same index.
+
+    Indexes:
+        self.records - evidence record -> [first timestamp, last timestamp, count]
+        self.byAgent - agent -> set of evidence records
+        self.byStatus - status -> number of entries
+        self.byHour - hour (YYYY-MM-DDTHH) -> number of entries
+        self.failuresByHour - hour -> number of failed entries
+
+    Timestamps are in milliseconds, as in the logs; timestamps given as
+    strings (numbers or ISO dates) are turned into milliseconds as they are
+    added, so logs of both kinds can be mixed. Boolean statuses are counted
+    as 'true' and 'false'. The keys used to read log entries are class
+    attributes, so they can be changed if needed.
+
+    basic usage:
+        ai = activityIndex()
+        ai.update(al.iterLogs())   # al is an activityLogs object
+        ai.recordsForAgent('twitter')
+        ai.failuresPerHour()
+
+    '''
+
+    recordKey = 'r'  # evidence record id
+    agentKey = 'c'  # component, e.g. the agent name
+    statusKey = 'e'  # outcome, 't'/'f' or an HTTP status code
+    timeKey = 't'  # timestamp in milliseconds
+
+    # statuses that count as failures, as well as HTTP codes of 400 and above
+    failureStatuses = ('f', 'false', 'error', 'exception')
+
+    def __init__(self):
+
+        self.records = {}
+        self.byAgent = {}
+        self.byStatus = {}
+        self.byHour = {}
+        self.failuresByHour = {}
+
+        self.entryCount = 0
+
+        # hour number (ms // 3600000) -> YYYY-MM-DDTHH, as there are few distinct hours
+        self._hourNames = {}
+        # status -> is it a failure?
+        self._failures = {}
+
+    # =====================================
+
+    # Adding entries
+
+    def hourName(self, timestamp):
+        ''' YYYY-MM-DDTHH for a timestamp in milliseconds (or an ISO string), None if unknown '''
+
+        if isinstance(timestamp, str):
+            # ISO format, e.g. 2021-01-17T01:23:45Z
+            return timestamp[:13] if len(timestamp) >= 13 else None
+
+        try:
+            hour = int(timestamp) // 3600000
+        except (TypeError, ValueError):
+            return None
+
+        name = self._hourNames.get(hour)
+        if name is None:
+            name = datetime.fromtimestamp(hour * 3600, tz=timezone.utc).strftime('%Y-%m-%dT%H')
+            self._hourNames[hour] = name
+
+        return name
+
+    def millis(self, timestamp):
+        ''' a timestamp as int milliseconds: from a number, a string of one or an ISO date '''
+
+        if timestamp is None or timestamp.__class__ is int:
+            return timestamp
+
+        if isinstance(timestamp, str):
+            try:
+                return int(float(timestamp))
+            except ValueError:
+                pass
+            # an ISO date, with any offset converted to UTC
+            stamp = utcStamp(timestamp)
+            if stamp is None:
+                return None
+            return calendar.timegm(time.strptime(stamp, '%Y-%m-%dT%H:%M:%S')) * 1000
+
+        try:
+            return int(timestamp)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def isFailure(self, status):
+        ''' does a status value mean that something went wrong? '''
+
+        if status in self.failureStatuses:
+            return True
+
+        try:
+            return int(status) >= 400
+        except (TypeError, ValueError):
+            return False
+
+    def add(self, entry):
+        '''
+        Add one parsed log entry to the indexes.
+
+        Parameters
+        ----------
+        entry : dict
+            a log line, as produced by activityLogs.iterLogs
+
+        '''
+
+        self.entryCount += 1
+
+        timestamp = entry.get(self.timeKey)
+        if timestamp.__class__ is not int:
+            timestamp = self.millis(timestamp)
+        hour = self._hourNames.get(timestamp // 3600000) if timestamp is not None else None
+        if hour is None:
+            hour = self.hourName(timestamp)
+        if hour is not None:
+            self.byHour[hour] = self.byHour.get(hour, 0) + 1
+
+        status = entry.get(self.statusKey)
+        if status is not None:
+            if status.__class__ is bool:
+                # False == 0, so it would share a count with a status of 0
+                status = 'true' if status else 'false'
+            elif status.__class__ not in (str, int):
+                status = str(status)
+            self.byStatus[status] = self.byStatus.get(status, 0) + 1
+
+            failed = self._failures.get(status)
+            if failed is None:
+                failed = self._failures[status] = self.isFailure(status)
+            if failed and hour is not None:
+                self.failuresByHour[hour] = self.failuresByHour.get(hour, 0) + 1
+
+        # a literal line can give a list or dict, which isn't a record
+        evrec = entry.get(self.recordKey)
+        if evrec.__class__ is not str:
+            return
+
+        # first and last appearance of the evidence record
+        seen = self.records.get(evrec)
+        if seen is None:
+            self.records[evrec] = [timestamp, timestamp, 1]
+        else:
+            seen[2] += 1
+            if timestamp is not None:
+                if seen[0] is None or timestamp < seen[0]:
+                    seen[0] = timestamp
+                if seen[1] is None or timestamp > seen[1]:
+                    seen[1] = timestamp
+
+        agent = entry.get(self.agentKey)
+        if agent is not None:
+            if agent.__class__ is not str:
+                agent = str(agent)
+            try:
+                self.byAgent[agent].add(evrec)
+            except KeyError:
+                self.byAgent[agent] = {evrec}
+
+    def update(self, entries):
+        ''' add an iterable of log entries, e.g. activityLogs.jsonData or activityLogs.iterLogs() '''
+
+        add = self.add
+        for entry in entries:
+            add(entry)
+
+        return self
+
+    # =====================================
+
+    # Queries
+
+    def evidenceRecords(self):
+        ''' list of all evidence records, in the order they were first added '''
+
+        return list(self.records)
+
+    def recordsForAgent(self, agent):
+        ''' set of evidence records mentioned in entries from an agent '''
+
+        return self.byAgent.get(agent, set())
+
+    def agents(self):
+        ''' number of evidence records for each agent '''
+
+        return {agent: len(records) for agent, records in self.byAgent.items()}
+
+    def failuresPerHour(self):
+        ''' number of failed entries in each hour, in time order '''
+
+        return dict(sorted(self.failuresByHour.items()))
+
+    def firstSeen(self, evrec):
+        ''' timestamp of the first appearance of an evidence record, or None '''
+
+        seen = self.records.get(evrec)
+        return None if seen is None else seen[0]
+
+    def lastSeen(self, evrec):
+        ''' timestamp of the last appearance of an evidence record, or None '''
+
+        seen = self.records.get(evrec)
+        return None if seen is None else seen[1]
+
+    def __contains__(self, evrec):
+        return evrec in self.records
+
+    def __len__(self):
+        return len(self.records)
@@ -5,29 +5,91 @@ Package for extracting data from Crossref Event Data evidence logs.
 
 '''
 
-import datetime
 import requests
 import json
+import ast
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+try:
+    from mrced2.activityIndex import activityIndex
+    from mrced2.instrument import metrics
+except:
+    from activityIndex import activityIndex
+    from instrument import metrics
+
+# orjson is much faster than json for many small lines, but isn't required
+try:
+    import orjson
+    _loads = orjson.loads
+    _JSONError = orjson.JSONDecodeError
+except ImportError:
+    _loads = json.loads
+    _JSONError = ValueError
+
+
+def parseLine(line):
+    '''
+    Parse one line of an activity log into a dictionary, without eval.
+
+    Lines are JSON; lines written as Python literals are parsed with
+    ast.literal_eval, which only accepts literals.
+
+    Parameters
+    ----------
+    line : bytes or str
+
+    Returns
+    -------
+    dict, or None if the line couldn't be parsed
+
+    '''
+
+    try:
+        d = _loads(line)
+    except _JSONError:
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            d = ast.literal_eval(line)
+        except (ValueError, TypeError, SyntaxError, UnicodeDecodeError, MemoryError, RecursionError):
+            return None
+
+    if not isinstance(d, dict):
+        return None
+
+    return d
 
 
 class activityLogs:
 
-    def __init__(self):
+    def __init__(self, baseUrl='https://evidence.eventdata.crossref.org'):
+        '''
+        Parameters
+        ----------
+        baseUrl : str
+            location of the evidence service, can be changed e.g. to use a mockServer
+
+        '''
 
         self.outputFile = 'test.json'
 
-        self.queryPrefix = 'https://evidence.eventdata.crossref.org/log/'
+        self.queryPrefix = baseUrl.rstrip('/') + '/log/'
         self.query = ""
         self.jsonData = []
         self.success = False
 
-    def buildQuery(self, date):
+        # counts from the last log that was read
+        self.lineCount = 0
+        self.malformed = 0
+
+    def buildQuery(self, date, quiet=False):
         '''
         Build a query of the evidence logs
 
         Parameters
         ==========
         date: date in text of datetime format, e.g. 2021-01-01T01
+        quiet: if True, the query isn't printed
 
         Returns
         =======
@@ -40,56 +102,184 @@ class activityLogs:
 
             self.query = self.queryPrefix + date + '.txt'
 
-        print(self.query)
+        if not(quiet):
+            metrics.say(self.query)
 
     def runQuery(self, quiet=False):
         '''
-        Use requests to run the query defined by buildQuery
+        Use requests to run the query defined by buildQuery. The log is
+        streamed and parsed line by line into self.jsonData; see iterLogs.
         '''
 
-        r = requests.get(self.query)
+        self.jsonData = list(self.iterLogs(quiet=quiet))
 
-        # print a short confirmation on completion
-        if not(quiet):
-            print('Evidence log API query complete ', r.status_code)
+    def iterLogs(self, quiet=False, chunkSize=65536):
+        '''
+        Stream the log defined by buildQuery and yield each line as a dictionary.
+        The log is never held in memory as a whole.
+
+        Lines that can't be parsed are skipped and counted in self.malformed;
+        self.lineCount is the number of non-empty lines read.
+
+        Parameters
+        ----------
+        quiet : boolean
+            There is no printed output if True. The default is False.
+        chunkSize : int
+            number of bytes read from the response at a time
+
+        Yields
+        ------
+        dict:
+            one log entry
+
+        '''
+
+        self.lineCount = 0
+        self.malformed = 0
+
+        with metrics.get(self.query, stream=True) as r:
+
+            # print a short confirmation on completion
+            if not(quiet):
+                metrics.say('Evidence log API query complete ', r.status_code)
+
+            # stop if there wasn't a response
+            if not(r.status_code in (200, 201)):
+                self.success = False
+                return
 
-        # stop if there wasn't a response
-        if r.status_code in (200, 201):
             self.success = True
-            # find and save the next cursor (add to next call to iterate results pages)
-            tx = r.text
 
-            # make the output json compatible
+            for line in r.iter_lines(chunk_size=chunkSize):
+                if not line.strip():
+                    continue
+
+                self.lineCount += 1
+                d = parseLine(line)
+                if d is None:
+                    self.malformed += 1
+                    continue
+
+                yield d
+
+        if not(quiet):
+            metrics.say(str(self.lineCount) + ' log lines read, ' +
+                        str(self.malformed) + ' malformed')
+
+    def ingestRange(self, start, end, workers=8, retry=3, quiet=False, aggregate=None):
+        '''
+        Fetch every hourly log from start to end (inclusive) concurrently and
+        fold each hour into per-hour counts. The log lines aren't kept, so a
+        month of logs fits in a few kilobytes. self.jsonData isn't changed.
+
+        Parameters
+        ----------
+        start, end : str or datetime
+            first and last hours, e.g. 2021-01-01T00 and 2021-01-31T23. A date
+            on its own (2021-01-31) means midnight.
+        workers : int
+            number of logs fetched at once, over one pool of connections
+        retry : int
+            number of attempts per hour
+        quiet : boolean
+            There is no printed output if True. The default is False.
+        aggregate : activityAggregate, optional
+            aggregates to fill in, e.g. to retry the missing hours of an
+            earlier run. Only hours without data are fetched.
+
+        Returns
+        -------
+        activityAggregate
+
+        '''
 
-            # split lines
-            logsd = tx.split('\n')
+        # imported here, numpy is only needed for aggregates
+        try:
+            from mrced2.activityAggregate import activityAggregate, hourRange, summariseHour
+        except:
+            from activityAggregate import activityAggregate, hourRange, summariseHour
+
+        hours = hourRange(start, end)
+        if aggregate is None:
+            aggregate = activityAggregate(hours)
+        todo = [h for h in hours if h in aggregate.position
+                and not aggregate.fetched[aggregate.position[h]]]
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        def fetchHour(hour):
+            for ii in range(retry):
+                malformed = [0]
+
+                def entries(r):
+                    for line in r.iter_lines(chunk_size=65536):
+                        if not line.strip():
+                            continue
+                        d = parseLine(line)
+                        if d is None:
+                            malformed[0] += 1
+                            continue
+                        yield d
 
-            self.jsonData = []  # new object with successfully transformed lines
-            for l in range(len(logsd)):
                 try:
-                    # turn line into a dictionary
-                    self.jsonData.append(eval(logsd[l]))
-                except:
-                    pass
+                    with metrics.get(self.queryPrefix + hour + '.txt', session=session, retries=ii,
+                                     stream=True, timeout=120) as r:
+                        if not(r.status_code in (200, 201)):
+                            continue
+                        counts = summariseHour(entries(r), aggregate.recordKey,
+                                               aggregate.agentKey, aggregate.statusKey)
+                except requests.RequestException:
+                    continue
+
+                counts['malformed'] = malformed[0]
+                return counts
+
+            return None
+
+        if not(quiet):
+            metrics.say('fetching ' + str(len(todo)) + ' hourly logs')
+
+        done = 0
+        # the aggregates are only changed from this thread
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetchHour, hour): hour for hour in todo}
+            for future in as_completed(futures):
+                counts = future.result()
+                if counts is not None:
+                    aggregate.fold(futures[future], counts)
+                    done += 1
+                    if not(quiet) and done % 24 == 0:
+                        metrics.say(str(done) + ' hours done')
+
+        session.close()
+
+        if not(quiet):
+            metrics.say(str(done) + ' of ' + str(len(todo)) + ' hourly logs read')
 
-        else:
-            self.success = False
+        return aggregate
 
     # ====================================
 
     # Analysis scripts
 
+    @metrics.timed(size=lambda self: len(self.jsonData))
     def getEvidenceRecords(self):
         '''
         Examine the log entries and pull out any evidence records mentioned.
 
         Returns
         -------
-        None.
+        list:
+            evidence records, in the order they first appear
 
         '''
 
-        evidenceRecords = []
+        # a dictionary keeps the order and makes the "seen it" check O(1)
+        evidenceRecords = {}
 
         for log in self.jsonData:
 
@@ -100,13 +290,61 @@ class activityLogs:
                 # we didn't find an activity log
                 continue
 
-            # we've already seen this one
-            if evrec in evidenceRecords:
-                continue
+            # a literal line can give a list or dict here, which isn't a record
+            if isinstance(evrec, str):
+                evidenceRecords[evrec] = None
+
+        return list(evidenceRecords)
+
+    def buildIndex(self, index=None):
+        '''
+        Add the entries in self.jsonData to an activityIndex.
+
+        Parameters
+        ----------
+        index : activityIndex, optional
+            index to add to, e.g. one holding other hours. A new one is made if
+            not given.
+
+        Returns
+        -------
+        activityIndex
+
+        '''
+
+        if index is None:
+            index = activityIndex()
+
+        return index.update(self.jsonData)
+
+    def indexLogs(self, dates, index=None, quiet=False):
+        '''
+        Stream several hourly logs straight into an activityIndex, without
+        keeping the lines. self.jsonData isn't changed.
+
+        Parameters
+        ----------
+        dates : list of str
+            hours in the format used by buildQuery, e.g. 2021-01-01T01
+        index : activityIndex, optional
+            index to add to, a new one is made if not given
+        quiet : boolean
+            There is no printed output if True. The default is False.
+
+        Returns
+        -------
+        activityIndex
+
+        '''
+
+        if index is None:
+            index = activityIndex()
 
-            evidenceRecords.append(evrec)
+        for date in dates:
+            self.buildQuery(date, quiet=quiet)
+            index.update(self.iterLogs(quiet=quiet))
 
-        return evidenceRecords
+        return index
 
 
 if __name__ == '__main__':
@@ -116,7 +354,7 @@ if __name__ == '__main__':
 
     al.runQuery()
 
-    actlogs = al.getActivityLogs()
+    evrecs = al.getEvidenceRecords()
 
-    print(actlogs)
-    print(len(actlogs))
+    print(evrecs)
+    print(len(evrecs))
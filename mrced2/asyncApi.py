@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Async counterparts of the eventData and restApi clients, for use inside
+asyncio services. Needs aiohttp (pip install aiohttp).
+
+basic usage:
+
+    async with asyncHttp(limit=200) as http:
+        ed = asyncEventData(http=http)
+        async for ev in ed.iterEvents({'obj-id.prefix': '10.21105', 'source': 'wikipedia'}):
+            ...
+        records = await asyncRestApi(http=http).enrich(rows)
+
+@author: martynrittman
+"""
+
+import json
+import time
+import asyncio
+import weakref
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# orjson is much faster than json for large pages, but isn't required
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# bodies larger than this are parsed on a thread, so that a page of events
+# doesn't hold up the other requests on the event loop
+PARSE_IN_THREAD = 1 << 16
+
+try:
+    from mrced2.eventData import eventData
+    from mrced2.eventRecord import eventRecord
+    from mrced2.restApi import restApi
+    from mrced2.instrument import metrics, retryAfter
+except:
+    from eventData import eventData
+    from eventRecord import eventRecord
+    from restApi import restApi
+    from instrument import metrics, retryAfter
+
+
+class asyncHttp:
+    '''
+    One aiohttp connection pool shared by any number of async clients and
+    concurrent requests. Calls are recorded by metrics and follow
+    metrics.limiter, like the blocking clients. Rate limited requests (429
+    and 503) wait for their Retry-After, or back off exponentially, and are
+    tried again.
+
+    Use it as an async context manager, or call close() when done. Clients
+    that aren't given one use asyncHttp.shared(), one per event loop.
+
+    '''
+
+    # event loop -> the shared asyncHttp for that loop
+    _shared = weakref.WeakKeyDictionary()
+
+    def __init__(self, limit=100, limitPerHost=0, timeout=60, rateLimitRetries=5,
+                 backoff=2.0, maxWait=300):
+        '''
+        Parameters
+        ----------
+        limit : int
+            most connections open at once, over all hosts
+        limitPerHost : int
+            most connections open to one host, 0 for no limit
+        timeout : float
+            seconds allowed for each request
+        rateLimitRetries : int
+            times a rate limited request is tried again
+        backoff : float
+            seconds to wait after the first rate limited response without a
+            Retry-After, doubling each time
+        maxWait : float
+            most seconds to wait before trying again
+
+        '''
+
+        if aiohttp is None:
+            raise ImportError('the async clients need aiohttp: pip install aiohttp')
+
+        self.limit = limit
+        self.limitPerHost = limitPerHost
+        self.timeout = timeout
+        self.rateLimitRetries = rateLimitRetries
+        self.backoff = backoff
+        self.maxWait = maxWait
+        self.session = None
+
+    @classmethod
+    def shared(cls):
+        ''' the shared pool of the running event loop, made if needed '''
+
+        loop = asyncio.get_running_loop()
+        http = cls._shared.get(loop)
+        if http is None or http.closed:
+            http = cls._shared[loop] = cls()
+
+        return http
+
+    @classmethod
+    async def closeShared(cls):
+        ''' close the shared pool of the running event loop, e.g. when a service stops '''
+
+        http = cls._shared.pop(asyncio.get_running_loop(), None)
+        if http is not None:
+            await http.close()
+
+    @property
+    def closed(self):
+        return self.session is not None and self.session.closed
+
+    def _session(self):
+        # the session has to be made inside the event loop it is used in
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limitPerHost)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        self._session()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get(self, url, params=None, retries=0):
+        '''
+        GET a URL.
+
+        Parameters
+        ----------
+        url : str
+        params : dict, optional
+            query parameters
+        retries : int
+            number of earlier attempts for the same request, recorded with the call
+
+        Returns
+        -------
+        (int, bytes):
+            the status code and body. The status is None if the request failed.
+
+        '''
+
+        # requests leaves out parameters that are None, aiohttp won't take them
+        if params is not None:
+            params = {k: v for k, v in params.items() if v is not None}
+
+        for waits in range(self.rateLimitRetries + 1):
+            if metrics.limiter is not None:
+                seconds = metrics.limiter.delay(url)
+                if seconds > 0:
+                    await asyncio.sleep(seconds)
+
+            start = time.perf_counter()
+            try:
+                async with self._session().get(url, params=params) as r:
+                    body = await r.read()
+                    status = r.status
+                    wait = r.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.recordHttp(url, 'error', time.perf_counter() - start, None, retries)
+                return None, b''
+
+            metrics.recordHttp(url, status, time.perf_counter() - start, len(body), retries)
+
+            if status not in (429, 503) or waits == self.rateLimitRetries:
+                break
+
+            wait = retryAfter(wait, self.backoff * 2 ** waits)
+            await asyncio.sleep(min(wait, self.maxWait))
+            retries += 1
+
+        return status, body
+
+
+async def parseJson(body):
+    ''' parse a response body, on a thread if it is large '''
+
+    if len(body) > PARSE_IN_THREAD:
+        return await asyncio.to_thread(_loads, body)
+
+    return _loads(body)
+
+
+class asyncEventData(eventData):
+    '''
+    eventData with async queries. buildQuery() is the same; runQuery() and
+    the methods that call it (getNextPage(), getAllPages(), poll() and
+    tail()) are coroutines, and pages and events can be read with async for.
+
+    basic usage:
+        ed = asyncEventData(mailto='me@example.org')
+        ed.buildQuery({'obj-id.prefix': '10.21105'})
+        await ed.runQuery()
+        ed.events.getHits()
+
+    '''
+
+    def __init__(self, http=None, **kwargs):
+        '''
+        Parameters
+        ----------
+        http : asyncHttp, optional
+            connection pool to use, defaults to asyncHttp.shared()
+        kwargs :
+            as for eventData
+
+        '''
+
+        super().__init__(**kwargs)
+        self.http = http
+
+    async def runQuery(self, retry=1, quiet=False, saveToFile=True):
+        '''
+        Run the query defined by buildQuery().
+
+        Parameters
+        ----------
+        retry : int
+            number of times to retry the API query if it fails
+        quiet : boolean
+            if true, nothing is printed to screen.
+        saveToFile : boolean
+            Saves the result to self.outputFile if set to True. The default is True.
+
+        Returns
+        -------
+        None.
+
+        '''
+
+        if not(quiet):
+            metrics.say("Event Data query started...")
+
+        http = self.http or asyncHttp.shared()
+        url = self.baseUrl + "/v1/events"
+
+        for ii in range(retry):
+            status, body = await http.get(url, params=self.params, retries=ii)
+
+            if not(quiet):
+                metrics.say('API query complete ', status)
+
+            if status in (200, 201):
+                self.success = True
+                jsonData = await parseJson(body)
+                self.cursor = jsonData["message"]["next-cursor"]
+
+                self.events = eventRecord()
+                self.events.jsonData = jsonData
+
+                if saveToFile:
+                    # the file is written on a thread so the loop isn't held up
+                    await asyncio.to_thread(self._saveJson, jsonData)
+                    if not(quiet):
+                        metrics.say("output file written to " + self.outputFile)
+
+                break
+
+            else:
+                self.success = False
+
+    def _saveJson(self, jsonData):
+        with open(self.outputFile, 'w') as f:
+            json.dump(jsonData, f)
+
+    async def runCommand(self):
+        metrics.say("please use runQuery, runCommand will be deprecated")
+
+        await self.runQuery()
+
+    async def getNextPage(self):
+        ''' as eventData.getNextPage() '''
+
+        if self.cursor in ("-1", None):
+            metrics.say("max page limit reached", self.cursor)
+            self.cursor = "-1"
+            return
+
+        self.params["cursor"] = self.cursor
+
+        # add a page number to the result
+        outputFile = self.outputFile
+        if outputFile[-5:] == ".json":
+            self.outputFile = outputFile[:-5] + str(self.pageCount).zfill(3) + ".json"
+        else:
+            self.outputFile = outputFile[:-5] + str(self.pageCount).zfill(3)
+
+        try:
+            await self.runQuery(retry=1)
+        except Exception:
+            metrics.say('failure for ' + self.outputFile)
+
+        if self.success:
+            self.pageCount += 1
+
+        self.outputFile = outputFile
+
+    async def getAllPages(self, maxPages, filters, fileprefix='test'):
+        ''' as eventData.getAllPages() '''
+
+        if filters.get('rows', self.rows) == 0:
+            metrics.say('zero rows defined')
+            return
+
+        for x in range(maxPages):
+
+            self.outputFile = fileprefix + str(x).zfill(4) + '.json'
+            self.buildQuery(filters, cursor=True)
+            await self.runQuery(retry=5)
+
+            if self.cursor in ('-1', None):
+                break
+
+            if not(self.success):
+                metrics.say('unsuccessful query')
+                break
+
+    async def poll(self, filters, since=None, lag=600, retry=3, maxPages=None):
+        ''' as eventData.poll() '''
+
+        query, cursor = self._pollQuery(filters, since)
+
+        new = []
+        pages = 0
+        complete = False
+        while maxPages is None or pages < maxPages:
+            self.buildQuery(query, quiet=True, cursor=cursor)
+            await self.runQuery(retry=retry, quiet=True, saveToFile=False)
+            if not(self.success):
+                cursor = None
+                break
+
+            events = self._pollPage(new)
+            pages += 1
+
+            if self.cursor in (None, '', '-1') or len(events) == 0:
+                complete = True
+                break
+            cursor = self.cursor
+
+        self.tailCursor = cursor
+        if complete:
+            self._pollMark(lag)
+
+        return new
+
+    async def tail(self, filters, since=None, interval=60, aggregators=None, maxPolls=None,
+                   lag=600, retry=3, maxPages=None, quiet=False):
+        '''
+        As eventData.tail(), as an async generator:
+
+            async for new in ed.tail({'obj-id.prefix': '10.21105'}, aggregators=la):
+                ...
+
+        '''
+
+        if aggregators is None:
+            aggregators = []
+        elif hasattr(aggregators, 'update'):
+            aggregators = [aggregators]
+
+        loop = asyncio.get_running_loop()
+        polls = 0
+        while maxPolls is None or polls < maxPolls:
+            started = loop.time()
+
+            new = await self.poll(filters, since if polls == 0 else None, lag, retry, maxPages)
+            for agg in aggregators:
+                agg.update(new)
+            polls += 1
+
+            if not(quiet):
+                metrics.say(len(new), 'new events, since', self.tailSince)
+
+            yield new
+
+            if maxPolls is None or polls < maxPolls:
+                await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+
+    async def iterPages(self, filters, maxPages=None, retry=3):
+        '''
+        Run a query and follow the cursor through all the results pages.
+
+        Parameters
+        ----------
+        filters : dict
+            same as for buildQuery()
+        maxPages : int, optional
+            stop after this many pages
+        retry : int
+            attempts per page
+
+        Yields
+        ------
+        eventRecord:
+            one per page. Iteration stops early if a page can't be fetched,
+            check self.success afterwards.
+
+        '''
+
+        cursor = None
+        pages = 0
+        while maxPages is None or pages < maxPages:
+            self.buildQuery(filters, quiet=True, cursor=cursor)
+            await self.runQuery(retry=retry, quiet=True, saveToFile=False)
+            if not(self.success):
+                return
+
+            yield self.events
+            pages += 1
+
+            cursor = self.cursor
+            if cursor in (None, '', '-1') or len(self.events.jsonData['message']['events']) == 0:
+                return
+
+    async def iterEvents(self, filters, maxPages=None, retry=3):
+        ''' the events from iterPages(), one at a time '''
+
+        async for page in self.iterPages(filters, maxPages, retry):
+            for ev in page.jsonData['message']['events']:
+                yield ev
+
+
+class asyncRestApi(restApi):
+    '''
+    restApi with async queries. Records are built the same way; runQuery()
+    is a coroutine, and enrich() fetches many works at once over one
+    connection pool.
+
+    basic usage:
+        ra = asyncRestApi()
+        records = await ra.enrich(rows)   # rows with ["obj_id"] and ["count"]
+        ra.failed                         # DOIs that couldn't be fetched
+
+    '''
+
+    def __init__(self, http=None, **kwargs):
+        '''
+        Parameters
+        ----------
+        http : asyncHttp, optional
+            connection pool to use, defaults to asyncHttp.shared()
+        kwargs :
+            as for restApi
+
+        '''
+
+        super().__init__(**kwargs)
+        self.http = http
+        self.work = None
+        # DOIs that enrich() couldn't fetch
+        self.failed = []
+
+    async def getWork(self, doi, retry=1):
+        ''' the "message" of a work from the REST API, or None '''
+
+        http = self.http or asyncHttp.shared()
+        for ii in range(retry):
+            status, body = await http.get(self.baseUrl + "/works/" + doi,
+                                          params={'mailto': self.mailto}, retries=ii)
+            if status in (200, 201):
+                return (await parseJson(body))["message"]
+            if status == 404:
+                return None
+
+        return None
+
+    async def runQuery(self, row, retry=1, quiet=False):
+        '''
+        Parameters
+        ----------
+        row :
+            data frame row with ["obj_id"] and ["count"]
+        retry : int
+            number of times to retry the API query if it fails
+        quiet : boolean
+            if true, nothing is printed to screen.
+
+        Returns
+        -------
+        None.
+
+        '''
+
+        if not(quiet):
+            metrics.say(f"REST API query started for {row['obj_id'][16:]}...")
+
+        work = await self.getWork(row["obj_id"][16:], retry)
+        self.success = work is not None
+
+        if work is not None and work["type"] == "posted-content":
+            self.work = self.worksToRecords([row], [work])[0]
+        else:
+            self.work = None
+
+    async def enrich(self, rows, retry=3, concurrency=500, types=('posted-content',)):
+        '''
+        Records for many works at once, like runQuery() for each row.
+
+        Parameters
+        ----------
+        rows : iterable
+            data frame rows with ["obj_id"] and ["count"]
+        retry : int
+            attempts per work
+        concurrency : int
+            most requests waiting at once. Connections are limited by the
+            asyncHttp pool.
+        types : tuple or None
+            only keep works of these types, None for all. runQuery() keeps
+            posted-content only.
+
+        Returns
+        -------
+        list of dicts:
+            one record per work that was found, in the order of rows. The
+            DOIs of works that weren't found or couldn't be read are in
+            self.failed.
+
+        '''
+
+        rows = list(rows)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(row):
+            async with semaphore:
+                return await self.getWork(row["obj_id"][16:], retry)
+
+        # a work that can't be read fails on its own, not the whole batch
+        works = await asyncio.gather(*(fetch(row) for row in rows), return_exceptions=True)
+
+        self.failed = [row["obj_id"][16:] for row, work in zip(rows, works)
+                       if not isinstance(work, dict)]
+
+        keep = [(row, work) for row, work in zip(rows, works) if isinstance(work, dict)
+                and (types is None or work.get("type") in types)]
+        if len(keep) == 0:
+            return []
+
+        return self.worksToRecords([row for row, work in keep], [work for row, work in keep])
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the analysis hot paths on synthetic corpora.
+
+Run from the command line, e.g.
+
+    python -m mrced2.benchmark --sizes 10k 1M --save-baseline
+    python -m mrced2.benchmark --sizes 10k 1M   # compares with the baseline
+
+@author: martynrittman
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import tracemalloc
+
+try:
+    from mrced2.eventRecord import eventRecord
+    from mrced2.evidenceRecords import evidenceRecords
+    from mrced2.syntheticEvents import syntheticEvents
+    from mrced2.instrument import metrics
+except:
+    from eventRecord import eventRecord
+    from evidenceRecords import evidenceRecords
+    from syntheticEvents import syntheticEvents
+    from instrument import metrics
+
+
+# corpus sizes used by the suite. Every operation holds the whole corpus in
+# memory, about 4 GB per million events, so larger sizes have to be given as
+# numbers of events.
+SIZES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+
+
+class benchmark:
+    '''
+    Times the analysis methods on synthetic corpora of increasing size and
+    records the time and peak memory of each operation, then compares them
+    with a stored baseline.
+
+    Operations:
+        loadJson, mergeJsons, filterEvents, eventHist, eventHist-bins,
+        searchEvents, countDomains
+
+    basic usage:
+        b = benchmark(sizes=['10k', '1M'])
+        results = b.run()
+        regressions = b.compare('benchmark_baseline.json')
+
+    '''
+
+    operations = ('loadJson', 'mergeJsons', 'filterEvents', 'eventHist',
+                  'eventHist-bins', 'searchEvents', 'countDomains')
+
+    # operations run on an eventRecord of the corpus, loaded from its file
+    onRecord = ('filterEvents', 'eventHist', 'eventHist-bins', 'searchEvents')
+
+    def __init__(self, sizes=('10k',), operations=None, repeat=1, memory=True,
+                 seed=0, quiet=False):
+        '''
+        Parameters
+        ----------
+        sizes : list
+            corpus sizes, names from SIZES or numbers of events
+        operations : list, optional
+            operations to run, all of them by default
+        repeat : int
+            number of timed runs, the fastest is kept
+        memory : boolean
+            also measure peak memory, in a separate run with tracemalloc
+        seed : int
+            seed for the synthetic corpus
+        quiet : boolean
+            There is no printed output if True. The default is False.
+
+        '''
+
+        self.sizes = [SIZES[s] if s in SIZES else int(s) for s in sizes]
+        self.operations = list(operations or self.operations)
+        self.repeat = repeat
+        self.memory = memory
+        self.quiet = quiet
+        self.corpus = syntheticEvents(seed=seed)
+
+        # {operation: {size: {'seconds': float, 'peak-mb': float}}}
+        self.results = {}
+
+    # =====================================
+
+    # Operations
+
+    def setUp(self, n, folder):
+        '''
+        Write the corpus for a size to disk, one event at a time: the events
+        in a json file and in 10 page files. What the operations hold in
+        memory is made by prepare().
+
+        '''
+
+        corpusFile = os.path.join(folder, 'corpus.json')
+        self.corpus.writeJson(corpusFile, n)
+
+        pageSize = max(1, -(-n // 10))
+        pages = []
+        f = None
+        for i, ev in enumerate(self.corpus.iterEvents(n)):
+            if i % pageSize == 0:
+                if f is not None:
+                    f.write(']}}')
+                    f.close()
+                pages.append(os.path.join(folder, 'page' + str(len(pages)).zfill(3) + '.json'))
+                f = open(pages[-1], 'w')
+                f.write('{"status": "ok", "message": {"total-results": ' +
+                        str(min(pageSize, n - i)) + ', "events": [')
+            else:
+                f.write(', ')
+            f.write(json.dumps(ev))
+        if f is not None:
+            f.write(']}}')
+            f.close()
+
+        bins = sorted(set(e['subj'].get('author', {}).get('url', e['subj_id'])[:30]
+                          for e in itertools.islice(self.corpus.iterEvents(n), 1000)))[:200]
+
+        return {'n': n, 'file': corpusFile, 'pages': pages, 'folder': folder, 'bins': bins}
+
+    def prepare(self, name, data):
+        '''
+        Make what an operation holds in memory, if it isn't there already: an
+        eventRecord of the corpus, or an evidence record with n actions.
+        Done before the operation is timed.
+
+        '''
+
+        if name in self.onRecord and 'er' not in data:
+            data['er'] = eventRecord()
+            data['er'].loadJson(data['file'])
+        elif name == 'countDomains' and 'evidence' not in data:
+            data['evidence'] = evidenceRecords()
+            data['evidence'].jsonData = self.corpus.evidenceRecord(data['n'])
+
+    def release(self, later, data):
+        ''' drop what is held in memory once none of the later operations need it '''
+
+        if not any(name in self.onRecord for name in later):
+            data.pop('er', None)
+        if 'countDomains' not in later:
+            data.pop('evidence', None)
+
+    def runOperation(self, name, data):
+        ''' run one operation on the data made by setUp and prepare '''
+
+        er = data.get('er')
+        if name == 'loadJson':
+            eventRecord().loadJson(data['file'])
+        elif name == 'mergeJsons':
+            eventRecord().mergeJsons(data['pages'], saveToFile=False, quiet=True)
+        elif name == 'filterEvents':
+            er.filterEvents(filters={'source_id': ['wikipedia']})
+        elif name == 'eventHist':
+            er.eventHist('source_id')
+        elif name == 'eventHist-bins':
+            er.eventHist('subj_id', bins=data['bins'], useSubjs=True)
+        elif name == 'searchEvents':
+            er.searchEvents('subj_id', 'wikipedia.org')
+        elif name == 'countDomains':
+            data['evidence'].countDomains()
+        else:
+            raise ValueError('unknown operation ' + name)
+
+    def measure(self, name, data):
+        ''' time (best of self.repeat) and peak memory of an operation '''
+
+        best = None
+        for ii in range(self.repeat):
+            start = time.perf_counter()
+            self.runOperation(name, data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        result = {'seconds': round(best, 4)}
+
+        if self.memory:
+            tracemalloc.start()
+            self.runOperation(name, data)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['peak-mb'] = round(peak / 1e6, 2)
+
+        return result
+
+    def run(self):
+        '''
+        Run every operation at every size.
+
+        Returns
+        -------
+        dict:
+            {operation: {size: {'seconds': float, 'peak-mb': float}}}
+
+        '''
+
+        for n in self.sizes:
+            folder = tempfile.mkdtemp(prefix='mrced2-benchmark-')
+            try:
+                if not(self.quiet):
+                    metrics.say('generating ' + str(n) + ' events')
+                data = self.setUp(n, folder)
+
+                for i, name in enumerate(self.operations):
+                    self.prepare(name, data)
+                    result = self.measure(name, data)
+                    self.results.setdefault(name, {})[str(n)] = result
+                    self.release(self.operations[i + 1:], data)
+                    if not(self.quiet):
+                        metrics.say(name.ljust(16) + str(n).rjust(10) + '  ' +
+                                    ('%.4f' % result['seconds']).rjust(10) + ' s' +
+                                    (('  ' + str(result['peak-mb']) + ' MB') if 'peak-mb' in result else ''))
+                del data
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+
+        return self.results
+
+    # =====================================
+
+    # Baselines
+
+    def save(self, filename):
+        ''' save the results, with a note of the machine they came from '''
+
+        with open(filename, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.platform(),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'results': self.results}, f, indent=1)
+
+    def compare(self, filename, tolerance=1.25):
+        '''
+        Compare the results with a baseline saved by save().
+
+        Parameters
+        ----------
+        filename : str
+            the baseline file
+        tolerance : float
+            a time or memory more than this times the baseline is a regression
+
+        Returns
+        -------
+        list of dicts:
+            one per regression: operation, size, metric, baseline and current value
+
+        '''
+
+        with open(filename) as f:
+            baseline = json.load(f)['results']
+
+        regressions = []
+        for name, sizes in self.results.items():
+            for size, result in sizes.items():
+                old = baseline.get(name, {}).get(size)
+                if old is None:
+                    continue
+                for metric in ('seconds', 'peak-mb'):
+                    if metric in result and metric in old and old[metric] > 0 \
+                            and result[metric] > tolerance * old[metric]:
+                        regressions.append({'operation': name, 'size': size, 'metric': metric,
+                                            'baseline': old[metric], 'current': result[metric]})
+
+        if not(self.quiet):
+            for r in regressions:
+                metrics.say('REGRESSION ' + r['operation'] + ' at ' + r['size'] + ' events: ' +
+                            r['metric'] + ' ' + str(r['baseline']) + ' -> ' + str(r['current']))
+            if len(regressions) == 0:
+                metrics.say('no regressions against ' + filename)
+
+        return regressions
+
+
+def main(argv=None):
+    ''' command line entry point, returns 1 if there are regressions '''
+
+    parser = argparse.ArgumentParser(description='Benchmark mrced2 on synthetic corpora')
+    parser.add_argument('--sizes', nargs='+', default=['10k'],
+                        help='corpus sizes: ' + ', '.join(SIZES) + ' or a number of events')
+    parser.add_argument('--operations', nargs='+', default=None,
+                        help='operations to run: ' + ', '.join(benchmark.operations))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    parser.add_argument('--output', help='also save the results to this file')
+    args = parser.parse_args(argv)
+
+    b = benchmark(sizes=args.sizes, operations=args.operations, repeat=args.repeat,
+                  memory=not args.no_memory)
+    b.run()
+
+    if args.output:
+        b.save(args.output)
+
+    if args.save_baseline:
+        b.save(args.baseline)
+        print('baseline written to ' + args.baseline)
+        return 0
+
+    if os.path.exists(args.baseline):
+        return 1 if b.compare(args.baseline, args.tolerance) else 0
+
+    print('no baseline found at ' + args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
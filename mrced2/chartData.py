@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Data for charts, reduced before plotting so that the size of a chart
+doesn't grow with the number of works or events behind it.
+
+@author: martynrittman
+"""
+
+import math
+
+import numpy as np
+
+
+class chartData:
+    '''
+    Reduces data to a bounded number of records for altair/Vega or
+    matplotlib charts:
+
+        points - scatter points, binned into cells once there are too many
+        histogram2d - counts in a grid of rectangular cells
+        hexbin - counts in hexagonal cells
+        downsample - a line with many points, thinned by largest triangle
+                     three buckets (LTTB), which keeps its shape
+        timeSeries - counts per day, month or year, downsampled if long
+        bars - counts per category, the largest few and the rest as "Other"
+
+    Records are lists of dicts, which pandas.DataFrame() or alt.Data(values=)
+    take as they are. Dates (YYYY, YYYY-MM or YYYY-MM-DD) are plotted as
+    decimal years.
+
+    basic usage:
+        cd = chartData(maxPoints=5000)
+        scatter = cd.points(df['published'], df['citations'], yScale='log',
+                            names=('published', 'citations'))
+        alt.Chart(pd.DataFrame(scatter)).mark_circle().encode(
+            x='published:Q', y='citations:Q', size='count:Q')
+
+    '''
+
+    def __init__(self, maxPoints=5000, xBins=100, yBins=60, maxBars=20):
+        '''
+        Parameters
+        ----------
+        maxPoints : int
+            most records for points(), downsample() and timeSeries()
+        xBins, yBins : int
+            grid of histogram2d(), and of points() when it bins
+        maxBars : int
+            most bars from bars(), including "Other"
+
+        '''
+
+        self.maxPoints = maxPoints
+        self.xBins = xBins
+        self.yBins = yBins
+        self.maxBars = maxBars
+
+    # =====================================
+
+    # Inputs
+
+    def numbers(self, values):
+        '''
+        A float array from numbers or dates. Dates become decimal years and
+        anything missing becomes NaN.
+
+        '''
+
+        values = np.asarray(values)
+        if values.dtype.kind in 'iufb':
+            return values.astype(float)
+
+        if values.dtype.kind != 'M':
+            # strings (or objects) of dates; missing values become NaT
+            values = np.array([str(v)[:10] if v not in (None, '') and v == v else 'NaT'
+                               for v in values.tolist()], dtype='datetime64[D]')
+
+        days = values.astype('datetime64[D]')
+        years = days.astype('datetime64[Y]')
+        out = years.astype(float) + 1970 + \
+            (days - years.astype('datetime64[D]')).astype(float) / 365.25
+        out[np.isnat(days)] = np.nan
+
+        return out
+
+    def _pair(self, x, y):
+        ''' x and y as floats, without the points where either is missing '''
+
+        x = self.numbers(x)
+        y = self.numbers(y)
+        keep = ~(np.isnan(x) | np.isnan(y))
+
+        return x[keep], y[keep]
+
+    # =====================================
+
+    # Scatter plots
+
+    def histogram2d(self, x, y, xBins=None, yBins=None, yScale='linear', names=('x', 'y')):
+        '''
+        Counts of points in a grid of cells. Empty cells are left out.
+
+        Parameters
+        ----------
+        x, y : arrays or lists
+            numbers or dates
+        xBins, yBins : int, optional
+            size of the grid, default self.xBins and self.yBins
+        yScale : str
+            'linear' or 'log', for cells of equal height on a log axis
+            (e.g. for citation counts)
+        names : (str, str)
+            names of the x and y fields of the records
+
+        Returns
+        -------
+        list of dicts:
+            {x, y (cell centres), x0, x1, y0, y1 (cell edges), count}
+
+        '''
+
+        x, y = self._pair(x, y)
+        if len(x) == 0:
+            return []
+
+        log = yScale == 'log'
+        if log:
+            y = np.log10(1 + np.clip(y, 0, None))
+
+        counts, xEdges, yEdges = np.histogram2d(x, y, bins=[xBins or self.xBins, yBins or self.yBins])
+        if log:
+            yEdges = 10 ** yEdges - 1
+
+        xName, yName = names
+        records = []
+        for i, j in zip(*np.nonzero(counts)):
+            records.append({xName: float(xEdges[i] + xEdges[i + 1]) / 2,
+                            yName: float(yEdges[j] + yEdges[j + 1]) / 2,
+                            xName + '0': float(xEdges[i]), xName + '1': float(xEdges[i + 1]),
+                            yName + '0': float(yEdges[j]), yName + '1': float(yEdges[j + 1]),
+                            'count': int(counts[i, j])})
+
+        return records
+
+    def hexbin(self, x, y, gridSize=40, yScale='linear', names=('x', 'y')):
+        '''
+        Counts of points in hexagonal cells, as matplotlib's hexbin: gridSize
+        hexagons across, and gridSize / sqrt(3) down. Empty cells are left out.
+
+        Parameters
+        ----------
+        x, y : arrays or lists
+            numbers or dates
+        gridSize : int
+        yScale : str
+            'linear' or 'log'
+        names : (str, str)
+
+        Returns
+        -------
+        list of dicts:
+            {x, y (hexagon centres), count}
+
+        '''
+
+        x, y = self._pair(x, y)
+        if len(x) == 0:
+            return []
+
+        log = yScale == 'log'
+        if log:
+            y = np.log10(1 + np.clip(y, 0, None))
+
+        nx = gridSize
+        ny = max(1, int(round(gridSize / math.sqrt(3))))
+        xMin, xMax = x.min(), x.max()
+        yMin, yMax = y.min(), y.max()
+        sx = (xMax - xMin) / nx or 1.0
+        sy = (yMax - yMin) / ny or 1.0
+
+        # positions in units of the lattice; hexagon centres are on two
+        # offset rectangular lattices, and each point goes to the nearer one
+        u = (x - xMin) / sx
+        v = (y - yMin) / sy
+        i1, j1 = np.round(u), np.round(v)
+        i2, j2 = np.floor(u), np.floor(v)
+        d1 = (u - i1) ** 2 + 3 * (v - j1) ** 2
+        d2 = (u - i2 - 0.5) ** 2 + 3 * (v - j2 - 0.5) ** 2
+        first = d1 < d2
+
+        # centres in half steps, as one integer per cell
+        cu = np.where(first, 2 * i1, 2 * i2 + 1).astype(np.int64)
+        cv = np.where(first, 2 * j1, 2 * j2 + 1).astype(np.int64)
+        width = 2 * ny + 3
+        cells, counts = np.unique(cu * width + cv, return_counts=True)
+
+        cx = xMin + (cells // width) / 2 * sx
+        cy = yMin + (cells % width) / 2 * sy
+        if log:
+            cy = 10 ** cy - 1
+
+        xName, yName = names
+        return [{xName: float(a), yName: float(b), 'count': int(c)}
+                for a, b, c in zip(cx, cy, counts)]
+
+    def points(self, x, y, maxPoints=None, yScale='linear', names=('x', 'y')):
+        '''
+        Points for a scatter plot: every point while there are at most
+        maxPoints, after that the non-empty cells of histogram2d(), so the
+        chart can size or shade each mark by its count.
+
+        Returns
+        -------
+        list of dicts:
+            {x, y, count}, count is 1 for single points
+
+        '''
+
+        x, y = self._pair(x, y)
+        xName, yName = names
+
+        if len(x) <= (maxPoints or self.maxPoints):
+            return [{xName: float(a), yName: float(b), 'count': 1} for a, b in zip(x, y)]
+
+        return [{xName: r[xName], yName: r[yName], 'count': r['count']}
+                for r in self.histogram2d(x, y, yScale=yScale, names=names)]
+
+    # =====================================
+
+    # Lines
+
+    def lttb(self, x, y, n):
+        '''
+        Positions of the n points kept by largest triangle three buckets:
+        the first and last points, and from each of n - 2 buckets the point
+        that makes the largest triangle with the point kept before it and
+        the average of the next bucket.
+
+        Parameters
+        ----------
+        x, y : float arrays, sorted by x
+        n : int
+
+        Returns
+        -------
+        int array
+
+        '''
+
+        size = len(x)
+        if n >= size or n < 3:
+            return np.arange(size) if n >= size else np.array([0, size - 1][:max(n, 0)])
+
+        edges = np.floor(np.linspace(1, size - 1, n - 1)).astype(int)
+        kept = np.zeros(n, dtype=int)
+        kept[-1] = size - 1
+
+        a = 0
+        for k in range(n - 2):
+            lo, hi = edges[k], max(edges[k + 1], edges[k] + 1)
+            # average of the next bucket, or the last point
+            nlo, nhi = hi, (edges[k + 2] if k + 2 < n - 1 else size)
+            nhi = max(nhi, nlo + 1)
+            avgX = x[nlo:nhi].mean()
+            avgY = y[nlo:nhi].mean()
+
+            area = np.abs((x[a] - avgX) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avgY - y[a]))
+            a = lo + int(np.argmax(area))
+            kept[k + 1] = a
+
+        return kept
+
+    def downsample(self, x, y, maxPoints=None, names=('x', 'y')):
+        '''
+        A line chart's points, thinned to at most maxPoints with lttb().
+
+        Parameters
+        ----------
+        x, y : arrays or lists
+            x can be dates, and needn't be sorted
+        maxPoints : int, optional
+        names : (str, str)
+
+        Returns
+        -------
+        list of dicts:
+            {x, y}, x as given
+
+        '''
+
+        xs = self.numbers(x)
+        ys = self.numbers(y)
+        keep = np.nonzero(~(np.isnan(xs) | np.isnan(ys)))[0]
+        keep = keep[np.argsort(xs[keep], kind='stable')]
+
+        kept = keep[self.lttb(xs[keep], ys[keep], maxPoints or self.maxPoints)]
+
+        xName, yName = names
+        x = list(x) if not isinstance(x, np.ndarray) else x
+        y = list(y) if not isinstance(y, np.ndarray) else y
+
+        return [{xName: _plain(x[i]), yName: _plain(y[i])} for i in kept]
+
+    def timeSeries(self, dates, values=None, period='month', maxPoints=None, names=('date', 'count')):
+        '''
+        Counts (or sums of values) per day, month or year, including periods
+        with none, thinned with lttb() if there are more than maxPoints.
+
+        Parameters
+        ----------
+        dates : array or list
+            YYYY-MM-DD strings or datetime64
+        values : array or list, optional
+            summed per period; events are counted if not given
+        period : str
+            'day', 'month' or 'year'
+        maxPoints : int, optional
+        names : (str, str)
+
+        Returns
+        -------
+        list of dicts:
+            {date (YYYY-MM-DD, YYYY-MM or YYYY), count}
+
+        '''
+
+        unit = {'day': 'D', 'month': 'M', 'year': 'Y'}[period]
+        days = np.array([str(d)[:10] if d not in (None, '') else 'NaT' for d in list(dates)],
+                        dtype='datetime64[D]')
+        keep = ~np.isnat(days)
+        if not keep.any():
+            return []
+
+        periods = days[keep].astype('datetime64[' + unit + ']')
+        first, last = periods.min(), periods.max()
+        position = (periods - first).astype(int)
+        weights = None if values is None else np.asarray(values, dtype=float)[keep]
+        totals = np.bincount(position, weights=weights, minlength=int((last - first).astype(int)) + 1)
+
+        steps = np.arange(len(totals))
+        kept = self.lttb(steps.astype(float), totals.astype(float), maxPoints or self.maxPoints)
+
+        xName, yName = names
+        return [{xName: str(first + int(k)), yName: _plain(totals[k])} for k in kept]
+
+    # =====================================
+
+    # Bars
+
+    def bars(self, data, maxBars=None, other='Other', names=('label', 'count')):
+        '''
+        Counts per category for a bar chart, largest first. Past maxBars, the
+        smallest categories are added together as one bar.
+
+        Parameters
+        ----------
+        data : dict, list of dicts or iterable
+            label -> count, records with the two names (e.g. the sources
+            list of the notebook), or labels to count
+        maxBars : int, optional
+        other : str or None
+            label of the bar of the rest; None to leave them out
+        names : (str, str)
+            names of the label and count fields
+
+        Returns
+        -------
+        list of dicts:
+            {label, count}
+
+        '''
+
+        labelName, countName = names
+        maxBars = maxBars or self.maxBars
+
+        if isinstance(data, dict):
+            counts = dict(data)
+        else:
+            counts = {}
+            for item in data:
+                if isinstance(item, dict):
+                    counts[item[labelName]] = counts.get(item[labelName], 0) + item[countName]
+                else:
+                    counts[item] = counts.get(item, 0) + 1
+
+        ordered = sorted(counts.items(), key=lambda kv: -kv[1])
+        if len(ordered) > maxBars:
+            rest = ordered[maxBars - 1:] if other is not None else []
+            ordered = ordered[:maxBars - 1 if other is not None else maxBars]
+            if rest:
+                ordered.append((other, sum(c for l, c in rest)))
+
+        return [{labelName: _plain(l), countName: _plain(c)} for l, c in ordered]
+
+
+def _plain(v):
+    ''' numpy scalars as Python ones, for json '''
+
+    return v.item() if isinstance(v, np.generic) else v
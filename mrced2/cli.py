@@ -0,0 +1,815 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line interface for scheduled, headless harvests.
+
+    python -m mrced2 harvest --prefix 10.21105 --from 2021-01-01 --until 2021-01-31
+    python -m mrced2 sync events.json --workers 16
+    python -m mrced2 enrich events.json --output works.csv
+    python -m mrced2 aggregate 2021-01-01T00 2021-01-31T23 --output activity.npz
+    python -m mrced2 schedule --prefix-file prefixes.txt --jobs works,eventCounts
+    python -m mrced2 count events.jsonl --field subj.author.url --memory 512MB
+
+Installed with setup.py, the commands are also run as mrced2 (e.g. mrced2 sync).
+Each command can be split across hosts with --shard K/N (K from 0 to N-1).
+Progress goes to stderr, as one json object per line with --progress json.
+
+Exit codes:
+    0  finished
+    1  finished, but some items failed (pages, records, works or hours)
+    2  bad arguments
+    3  failed
+
+@author: martynrittman
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import gzip
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from mrced2.instrument import metrics, rateLimiter, prometheusSink
+    from mrced2.rawJson import rawJson
+except:
+    from instrument import metrics, rateLimiter, prometheusSink
+    from rawJson import rawJson
+
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_FAILED = 3
+
+
+class progressReporter:
+    '''
+    Reports the progress of a command to stderr, as text, as one json object
+    per line (for schedulers) or not at all.
+
+    json lines look like
+        {"time": 1635159600.1, "command": "sync", "event": "progress",
+         "done": 500, "total": 2000, "failed": 3}
+    where event is start, progress or done. The done line has the exit code.
+
+    '''
+
+    def __init__(self, command, mode='text', stream=None):
+        self.command = command
+        self.mode = mode
+        self.stream = stream or sys.stderr
+        self.started = time.time()
+
+    def emit(self, event, **fields):
+        if self.mode == 'none':
+            return
+
+        if self.mode == 'json':
+            record = {'time': round(time.time(), 3), 'command': self.command, 'event': event}
+            record.update(fields)
+            self.stream.write(json.dumps(record) + '\n')
+        else:
+            self.stream.write(self.command + ' ' + event + ': ' +
+                              ', '.join(k + ' ' + str(v) for k, v in fields.items()) + '\n')
+        self.stream.flush()
+
+    def start(self, **fields):
+        self.emit('start', **fields)
+
+    def update(self, **fields):
+        self.emit('progress', **fields)
+
+    def finish(self, exitCode, **fields):
+        self.emit('done', exitCode=exitCode,
+                  seconds=round(time.time() - self.started, 3), **fields)
+        return exitCode
+
+
+# =====================================
+
+# Helpers
+
+
+def parseShard(shard):
+    ''' "K/N" -> (K, N), or None for no sharding '''
+
+    if shard is None:
+        return None
+
+    try:
+        k, n = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard should look like K/N, e.g. 0/4')
+    if not(0 <= k < n):
+        raise argparse.ArgumentTypeError('shard K/N needs 0 <= K < N')
+
+    return k, n
+
+
+def shardItems(items, shard):
+    ''' the contiguous block of items that belongs to a shard '''
+
+    if shard is None:
+        return items
+
+    k, n = shard
+    return items[len(items) * k // n:len(items) * (k + 1) // n]
+
+
+def eventFiles(paths):
+    ''' files of events: the files given and the .json/.jsonl files in folders given '''
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path)
+                            if f.endswith(('.json', '.jsonl')))
+        else:
+            files.append(path)
+
+    return files
+
+
+def iterEvents(paths):
+    ''' events from Event Data json files (e.g. ced.json) or json-lines files '''
+
+    for filename in eventFiles(paths):
+        if filename.endswith('.jsonl'):
+            with open(filename) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            with open(filename) as f:
+                jsonData = json.load(f)
+            if isinstance(jsonData, list):
+                yield from jsonData
+            else:
+                yield from jsonData['message']['events']
+
+
+def writeEvents(filename, fmt, pages):
+    '''
+    Write the events in a list of page files to one file, one page at a time.
+
+    fmt is json (the Event Data format, like ced.json) or jsonl (one event per line).
+
+    '''
+
+    total = 0
+    with open(filename + '.tmp', 'w') as out:
+        if fmt == 'json':
+            out.write('{"status": "ok", "message-type": "event-list", "message": {"events": [')
+        for page in pages:
+            for ev in rawJson(filename=page).parse()['message']['events']:
+                if fmt == 'json':
+                    out.write(', ' if total else '')
+                    out.write(json.dumps(ev))
+                else:
+                    out.write(json.dumps(ev) + '\n')
+                total += 1
+        if fmt == 'json':
+            out.write('], "total-results": ' + str(total) + '}}')
+
+    os.replace(filename + '.tmp', filename)
+
+    return total
+
+
+def dayRange(start, end):
+    ''' list of days from start to end (inclusive), YYYY-MM-DD '''
+
+    d = datetime.strptime(start[:10], '%Y-%m-%d')
+    last = datetime.strptime(end[:10], '%Y-%m-%d')
+
+    days = []
+    while d <= last:
+        days.append(d.strftime('%Y-%m-%d'))
+        d += timedelta(days=1)
+
+    return days
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# =====================================
+
+# Commands
+
+
+def harvest(args, progress):
+    '''
+    Query Event Data and page through all the results. Pages are written to
+    the cache as they arrive, without being parsed, with the cursor of the
+    next page, so an interrupted harvest carries on where it stopped when it
+    is run again. If a request fails, the events fetched so far are written
+    to the output file name with .partial added.
+
+    '''
+
+    import requests
+
+    try:
+        from mrced2.eventData import eventData
+    except:
+        from eventData import eventData
+
+    filters = {}
+    if args.prefix:
+        filters['obj-id.prefix'] = args.prefix
+    if args.source:
+        filters['source'] = args.source
+    if args.from_date:
+        filters['from-' + args.date_field + '-date'] = args.from_date
+    if args.until_date:
+        filters['until-' + args.date_field + '-date'] = args.until_date
+    for f in args.filter:
+        key, _, value = f.partition('=')
+        filters[key] = value
+
+    # a shard harvests a block of the days in the date range
+    if args.shard is not None:
+        if not(args.from_date and args.until_date):
+            progress.emit('error', message='--shard needs --from and --until for harvest')
+            return progress.finish(EXIT_USAGE)
+        days = shardItems(dayRange(args.from_date, args.until_date), args.shard)
+        if len(days) == 0:
+            return progress.finish(EXIT_OK, pages=0, events=0)
+        filters['from-' + args.date_field + '-date'] = days[0]
+        filters['until-' + args.date_field + '-date'] = days[-1]
+
+    # one folder per query, so different harvests can share a cache
+    key = hashlib.sha1(json.dumps([filters, args.rows, args.base_url],
+                                  sort_keys=True).encode()).hexdigest()[:16]
+    folder = os.path.join(args.cache, 'harvest', key)
+    os.makedirs(folder, exist_ok=True)
+    stateFile = os.path.join(folder, 'state.json')
+
+    state = {'filters': filters, 'cursor': None, 'pages': [], 'bytes': 0, 'complete': False}
+    if os.path.exists(stateFile) and not(args.restart):
+        with open(stateFile) as f:
+            state = json.load(f)
+
+    def saveState():
+        with open(stateFile + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(stateFile + '.tmp', stateFile)
+
+    progress.start(filters=filters, cache=folder, resumed=len(state['pages']))
+
+    ed = eventData(mailto=args.mailto, rows=args.rows, baseUrl=args.base_url)
+    status = EXIT_OK
+
+    while not(state['complete']):
+        if args.max_pages and len(state['pages']) >= args.max_pages:
+            break
+
+        ed.buildQuery(filters, quiet=True, cursor=state['cursor'])
+        ed.outputFile = os.path.join(folder, 'page' + str(len(state['pages'])).zfill(5) + '.json')
+        try:
+            ed.runQuery(retry=args.retry, quiet=True, saveToFile=True, raw=True,
+                        compress=args.compress)
+        except (requests.RequestException, ValueError) as e:
+            progress.emit('error', message=repr(e))
+            ed.success = False
+
+        if not(ed.success):
+            status = EXIT_PARTIAL if state['pages'] else EXIT_FAILED
+            break
+
+        page = ed.outputFile + ('.gz' if args.compress else '')
+        state['pages'].append(page)
+        state['bytes'] += os.path.getsize(page)
+        state['cursor'] = ed.cursor
+        state['complete'] = ed.cursor in (None, '', '-1')
+        saveState()
+
+        progress.update(pages=len(state['pages']), bytes=state['bytes'])
+
+    saveState()
+
+    # events are only counted (and parsed) when they're written out. After a
+    # failed request they go to a .partial file, so that what was fetched can
+    # be looked at without being taken for a finished harvest; running again
+    # carries on from the cache.
+    events = None
+    output = folder
+    if args.format != 'pages' and state['pages']:
+        output = args.output if status == EXIT_OK else args.output + '.partial'
+        events = writeEvents(output, args.format, state['pages'])
+        if status == EXIT_OK and os.path.exists(args.output + '.partial'):
+            os.remove(args.output + '.partial')
+
+    return progress.finish(status, pages=len(state['pages']), events=events,
+                           complete=state['complete'], output=output)
+
+
+def sync(args, progress):
+    '''
+    Fetch the evidence records of events into the local evidence archive.
+    Records already archived are skipped, and with --seen so are records
+    fetched by other runs or workers sharing the seen-set.
+
+    '''
+
+    try:
+        from mrced2.evidenceArchive import evidenceArchive
+        from mrced2.seenSet import seenSet
+    except:
+        from evidenceArchive import evidenceArchive
+        from seenSet import seenSet
+
+    # ids rather than URLs, so that --base-url applies
+    ids = list(dict.fromkeys(ev['evidence_record'].rstrip('/').rsplit('/', 1)[-1]
+                             for ev in iterEvents(args.events) if ev.get('evidence_record')))
+    ids = shardItems(ids, args.shard)
+
+    ea = evidenceArchive(os.path.join(args.cache, 'evidence'), quiet=True, baseUrl=args.base_url)
+
+    seen = None
+    if args.seen:
+        seen = seenSet(os.path.join(args.cache, 'seen') if args.seen is True else args.seen)
+
+    progress.start(records=len(ids), archive=ea.folder)
+
+    totals = {'requested': 0, 'archived': 0, 'seen': 0, 'fetched': 0, 'failed': 0}
+    failedUrls = []
+    for batch in chunks(ids, args.batch):
+        summary = ea.fetchAll(batch, workers=args.workers, retry=args.retry,
+                              refresh=args.refresh, seen=seen)
+        for k in totals:
+            totals[k] += summary[k]
+        failedUrls += summary['failedUrls']
+        progress.update(done=totals['requested'], total=len(ids), fetched=totals['fetched'],
+                        failed=totals['failed'])
+
+    if args.failed_output:
+        with open(args.failed_output, 'w') as f:
+            f.write(''.join(u + '\n' for u in failedUrls))
+
+    if seen is not None:
+        seen.close()
+
+    if totals['failed'] == 0:
+        status = EXIT_OK
+    elif totals['fetched'] + totals['archived'] + totals['seen'] > 0:
+        status = EXIT_PARTIAL
+    else:
+        status = EXIT_FAILED
+
+    return progress.finish(status, **totals)
+
+
+def enrich(args, progress):
+    '''
+    Fetch the REST API metadata of the works that events point to, and write
+    one record per work with its number of events. Responses are cached.
+
+    '''
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    try:
+        from mrced2.restApi import restApi
+    except:
+        from restApi import restApi
+
+    counts = {}
+    for ev in iterEvents(args.events):
+        if ev.get('obj_id', '').startswith('https://doi.org/'):
+            counts[ev['obj_id']] = counts.get(ev['obj_id'], 0) + 1
+
+    objIds = shardItems(sorted(counts, key=lambda k: (-counts[k], k)), args.shard)
+
+    folder = os.path.join(args.cache, 'works')
+    os.makedirs(folder, exist_ok=True)
+
+    ra = restApi(mailto=args.mailto, baseUrl=args.base_url)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def fetch(objId):
+        ''' the "message" of a work, from the cache or the REST API '''
+
+        doi = objId[16:]
+        path = os.path.join(folder, hashlib.sha1(doi.lower().encode()).hexdigest() + '.json.gz')
+        if os.path.exists(path) and not(args.refresh):
+            with gzip.open(path, 'rt') as f:
+                return json.load(f)
+
+        for ii in range(args.retry):
+            try:
+                r = metrics.get(ra.baseUrl + '/works/' + doi, session=session, retries=ii,
+                                params={'mailto': ra.mailto}, timeout=60)
+            except requests.RequestException:
+                continue
+            if r.status_code in (200, 201):
+                work = r.json()['message']
+                with gzip.open(path + '.tmp', 'wt') as f:
+                    json.dump(work, f)
+                os.replace(path + '.tmp', path)
+                return work
+            if r.status_code == 404:
+                return None
+
+        return None
+
+    progress.start(works=len(objIds))
+
+    rows, works, failed, done = [], [], 0, 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(fetch, objId): objId for objId in objIds}
+        for future in as_completed(futures):
+            work = future.result()
+            if work is None:
+                failed += 1
+            elif args.type is None or work.get('type') == args.type:
+                rows.append({'obj_id': futures[future], 'count': counts[futures[future]]})
+                works.append(work)
+
+            # including works left out by --type
+            done += 1
+            if done % 100 == 0 or done == len(objIds):
+                progress.update(done=done, total=len(objIds), failed=failed)
+
+    session.close()
+
+    records = ra.worksToRecords(rows, works) if works else []
+    records.sort(key=lambda r: (-r['tweets'], r['doi']))
+
+    with open(args.output + '.tmp', 'w', newline='') as f:
+        if args.format == 'csv':
+            if records:
+                writer = csv.DictWriter(f, fieldnames=list(records[0]))
+                writer.writeheader()
+                for r in records:
+                    writer.writerow({k: v if isinstance(v, (str, int, float, type(None)))
+                                     else json.dumps(v) for k, v in r.items()})
+        elif args.format == 'jsonl':
+            f.write(''.join(json.dumps(r) + '\n' for r in records))
+        else:
+            json.dump(records, f)
+    os.replace(args.output + '.tmp', args.output)
+
+    if failed == 0:
+        status = EXIT_OK
+    elif records:
+        status = EXIT_PARTIAL
+    else:
+        status = EXIT_FAILED
+
+    return progress.finish(status, works=len(records), failed=failed, output=args.output)
+
+
+def aggregate(args, progress):
+    '''
+    Fold the hourly activity logs in a range into per-hour counts, a day at a
+    time. With an .npz output the counts are saved after every day, and a
+    second run only fetches the hours that are missing.
+
+    '''
+
+    try:
+        from mrced2.activityLogs import activityLogs
+        from mrced2.activityAggregate import activityAggregate, hourRange
+    except:
+        from activityLogs import activityLogs
+        from activityAggregate import activityAggregate, hourRange
+
+    hours = shardItems(hourRange(args.start, args.end), args.shard)
+    if len(hours) == 0:
+        return progress.finish(EXIT_OK, hours=0)
+
+    checkpoint = args.output if args.format == 'npz' else \
+        os.path.join(args.cache, 'aggregate-' + hours[0] + '-' + hours[-1] + '.npz')
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+
+    agg = None
+    if os.path.exists(checkpoint) and not(args.restart):
+        agg = activityAggregate.load(checkpoint)
+        if agg.hours != hours:
+            agg = None
+    if agg is None:
+        agg = activityAggregate(hours)
+
+    progress.start(hours=len(hours), missing=len(agg.missingHours()))
+
+    al = activityLogs(baseUrl=args.base_url)
+    for day in chunks(hours, 24):
+        if all(agg.fetched[agg.position[h]] for h in day):
+            continue
+        al.ingestRange(day[0], day[-1], workers=args.workers, retry=args.retry,
+                       quiet=True, aggregate=agg)
+        agg.save(checkpoint)
+        progress.update(hours=int(agg.fetched.sum()), total=len(hours),
+                        lines=int(agg.lines.sum()))
+
+    agg.save(checkpoint)
+
+    if args.format == 'csv':
+        agg.toDataFrame().to_csv(args.output, index_label='hour')
+    elif args.format == 'json':
+        with open(args.output, 'w') as f:
+            json.dump(agg.totals(), f)
+
+    missing = agg.missingHours()
+    if len(missing) == 0:
+        status = EXIT_OK
+    elif len(missing) < len(hours):
+        status = EXIT_PARTIAL
+    else:
+        status = EXIT_FAILED
+
+    return progress.finish(status, hours=len(hours) - len(missing), missing=len(missing),
+                           output=args.output)
+
+
+def count(args, progress):
+    '''
+    Count the events with each value of a field, with the counts spilled to
+    disk once they take more than --memory, so that fields with millions of
+    values (e.g. subj_id) can be counted on a small machine.
+
+    '''
+
+    try:
+        from mrced2.externalHist import externalHist
+    except:
+        from externalHist import externalHist
+
+    files = shardItems(eventFiles(args.events), args.shard)
+    progress.start(files=len(files), field=args.field, memory=args.memory)
+
+    with externalHist(args.field, args.memory, partitions=args.partitions,
+                      folder=args.cache if os.path.isdir(args.cache) else None) as h:
+        for ev in iterEvents(files):
+            h.add(ev)
+            if h.events % args.batch == 0:
+                progress.update(events=h.events, spills=h.spills)
+
+        if args.top:
+            rows = h.top(args.top)
+            with open(args.output + '.tmp', 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow([args.field, 'count'])
+                w.writerows(rows)
+            os.replace(args.output + '.tmp', args.output)
+            values = len(rows)
+        else:
+            values = h.writeCsv(args.output, args.min_count)
+
+        return progress.finish(EXIT_OK, events=h.events, values=values, spills=h.spills,
+                               output=args.output)
+
+
+def schedule(args, progress):
+    '''
+    Run works, event count and event harvests for many prefixes with a
+    harvestScheduler, sharing each API host's budget fairly between them.
+    The job state is kept in the cache, so a second run carries on.
+
+    '''
+
+    try:
+        from mrced2.harvestScheduler import harvestScheduler
+    except:
+        from harvestScheduler import harvestScheduler
+
+    # prefix -> priority; prefix files have a prefix and optionally a priority per line
+    prefixes = {p: 0 for p in args.prefixes}
+    if args.prefix_file:
+        with open(args.prefix_file) as f:
+            for line in f:
+                parts = line.split('#')[0].split()
+                if parts:
+                    prefixes[parts[0]] = int(parts[1]) if len(parts) > 1 else 0
+    if len(prefixes) == 0:
+        progress.emit('error', message='give prefixes or --prefix-file')
+        return progress.finish(EXIT_USAGE)
+
+    def pairs(items, convert):
+        out = {}
+        for item in items:
+            key, _, value = item.partition('=')
+            out[key] = convert(value)
+        return out
+
+    hs = harvestScheduler(folder=os.path.join(args.cache, 'scheduler'), mailto=args.mailto,
+                          apiUrl=args.base_url, eventDataUrl=args.event_data_url,
+                          hostLimits=pairs(args.host_limit, int), defaultHostLimit=args.workers,
+                          rates=pairs(args.host_rate, float) or None, rows=args.rows,
+                          retry=args.retry, compress=args.compress, quiet=True)
+
+    kinds = [k.strip() for k in args.jobs.split(',') if k.strip()]
+    jobIds = []
+    for prefix in shardItems(sorted(prefixes), args.shard):
+        for kind in kinds:
+            jobIds.append(hs.addJob(kind, prefix, prefixes[prefix],
+                                    filters=pairs(args.filter, str) if kind != 'works' else None,
+                                    sources=args.source if kind == 'eventCounts' else None))
+    if args.retry_failed:
+        hs.retryFailed()
+
+    progress.start(prefixes=len(prefixes), jobs=len(jobIds), **hs.status())
+
+    steps = [0]
+
+    def onStep(job):
+        steps[0] += 1
+        if steps[0] % args.batch == 0:
+            progress.update(requests=steps[0], **hs.status())
+
+    hs.run(maxSeconds=args.max_seconds, onStep=onStep)
+
+    jobs = [{k: hs.jobs[j][k] for k in ('id', 'status', 'pages', 'items', 'result', 'error')}
+            for j in jobIds]
+    for job in jobs:
+        job['pages'] = hs.pages(job['id'])
+    with open(args.output + '.tmp', 'w') as f:
+        json.dump(jobs, f)
+    os.replace(args.output + '.tmp', args.output)
+
+    counts = {'pending': 0, 'done': 0, 'failed': 0}
+    for job in jobs:
+        counts[job['status']] += 1
+
+    if counts['failed'] == 0 and counts['pending'] == 0:
+        status = EXIT_OK
+    elif counts['done']:
+        status = EXIT_PARTIAL
+    else:
+        status = EXIT_FAILED
+
+    return progress.finish(status, requests=steps[0], output=args.output, **counts)
+
+
+# =====================================
+
+# Entry point
+
+
+def buildParser():
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=8, help='requests in flight at once')
+    common.add_argument('--retry', type=int, default=3, help='attempts per request')
+    common.add_argument('--rate-limit', type=float, default=None,
+                        help='most requests started per second, across all workers')
+    common.add_argument('--cache', default='.mrced2-cache',
+                        help='folder for cached pages, records and works')
+    common.add_argument('--progress', choices=('text', 'json', 'none'), default='text',
+                        help='progress messages on stderr')
+    common.add_argument('--metrics', default=None,
+                        help='write Prometheus metrics to this file')
+    common.add_argument('--shard', type=parseShard, default=None,
+                        help='K/N: do the Kth of N equal parts of the work')
+    common.add_argument('--mailto', default='Anonymous',
+                        help='email address sent with API queries')
+
+    parser = argparse.ArgumentParser(prog='mrced2',
+                                     description='Harvest and analyse Crossref Event Data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('harvest', parents=[common], help='query Event Data')
+    p.add_argument('--prefix', help='DOI prefix of the objects, e.g. 10.21105')
+    p.add_argument('--source', help='source id, e.g. twitter')
+    p.add_argument('--from', dest='from_date', help='first date, YYYY-MM-DD')
+    p.add_argument('--until', dest='until_date', help='last date, YYYY-MM-DD')
+    p.add_argument('--date-field', choices=('collected', 'occurred', 'updated'),
+                   default='collected', help='the date that --from and --until apply to')
+    p.add_argument('--filter', action='append', default=[], metavar='KEY=VALUE',
+                   help='any other Event Data filter, can be repeated')
+    p.add_argument('--rows', type=int, default=1000, help='events per page')
+    p.add_argument('--max-pages', type=int, default=None)
+    p.add_argument('--format', choices=('json', 'jsonl', 'pages'), default='json',
+                   help='json (like ced.json), jsonl, or leave the pages in the cache')
+    p.add_argument('--output', default='events.json')
+    p.add_argument('--compress', action='store_true', help='gzip the pages in the cache')
+    p.add_argument('--restart', action='store_true', help="don't resume an earlier harvest")
+    p.add_argument('--base-url', default='https://api.eventdata.crossref.org')
+    p.set_defaults(run=harvest)
+
+    p = commands.add_parser('sync', parents=[common],
+                            help='fetch the evidence records of events into an archive')
+    p.add_argument('events', nargs='+', help='event files (json or jsonl) or folders')
+    p.add_argument('--batch', type=int, default=500, help='records per progress report')
+    p.add_argument('--refresh', action='store_true', help='fetch archived records again')
+    p.add_argument('--failed-output', default=None,
+                   help='write the URLs of records that failed to this file')
+    p.add_argument('--seen', nargs='?', const=True, default=None, metavar='FOLDER',
+                   help='skip records fetched by earlier runs or other workers, as kept '
+                        'in this seen-set, by default the one in the cache')
+    p.add_argument('--base-url', default='https://evidence.eventdata.crossref.org')
+    p.set_defaults(run=sync)
+
+    p = commands.add_parser('enrich', parents=[common],
+                            help='fetch REST API metadata of the works in events')
+    p.add_argument('events', nargs='+', help='event files (json or jsonl) or folders')
+    p.add_argument('--type', default=None, help='only keep works of this type, e.g. posted-content')
+    p.add_argument('--format', choices=('csv', 'jsonl', 'json'), default='csv')
+    p.add_argument('--output', default='works.csv')
+    p.add_argument('--refresh', action='store_true', help='fetch cached works again')
+    p.add_argument('--base-url', default='https://api.crossref.org')
+    p.set_defaults(run=enrich)
+
+    p = commands.add_parser('aggregate', parents=[common],
+                            help='per-hour counts of activity logs')
+    p.add_argument('start', help='first hour, YYYY-MM-DDTHH (or a date)')
+    p.add_argument('end', help='last hour, YYYY-MM-DDTHH (or a date)')
+    p.add_argument('--format', choices=('npz', 'csv', 'json'), default='npz',
+                   help='npz (activityAggregate.load), csv per hour, or json totals')
+    p.add_argument('--output', default='activity.npz')
+    p.add_argument('--restart', action='store_true', help="don't resume an earlier run")
+    p.add_argument('--base-url', default='https://evidence.eventdata.crossref.org')
+    p.set_defaults(run=aggregate)
+
+    p = commands.add_parser('count', parents=[common],
+                            help='count the events with each value of a field')
+    p.add_argument('events', nargs='+', help='event files (json or jsonl) or folders')
+    p.add_argument('--field', default='source_id',
+                   help='field to count, dots for nested fields, e.g. subj.author.url')
+    p.add_argument('--memory', default='256MB', help='counts held in memory before spilling')
+    p.add_argument('--partitions', type=int, default=64, help='files spilled counts go into')
+    p.add_argument('--top', type=int, default=None, help='only write the N largest counts')
+    p.add_argument('--min-count', type=int, default=1, help='leave out smaller counts')
+    p.add_argument('--batch', type=int, default=100000, help='events per progress report')
+    p.add_argument('--output', default='counts.csv')
+    p.set_defaults(run=count)
+
+    p = commands.add_parser('schedule', parents=[common],
+                            help='harvest many prefixes, sharing each API fairly')
+    p.add_argument('prefixes', nargs='*', help='DOI prefixes, e.g. 10.21105')
+    p.add_argument('--prefix-file', default=None,
+                   help='file with a prefix and optionally a priority on each line')
+    p.add_argument('--jobs', default='works,eventCounts',
+                   help='comma-separated job kinds: works, eventCounts, events')
+    p.add_argument('--source', action='append', default=None,
+                   help='source to count for eventCounts, can be repeated (default all)')
+    p.add_argument('--filter', action='append', default=[], metavar='KEY=VALUE',
+                   help='other Event Data filter for events jobs, can be repeated')
+    p.add_argument('--host-limit', action='append', default=[], metavar='HOST=N',
+                   help='requests in flight to a host (default --workers), can be repeated')
+    p.add_argument('--host-rate', action='append', default=[], metavar='HOST=R',
+                   help='requests started per second to a host, can be repeated')
+    p.add_argument('--rows', type=int, default=1000, help='items per page')
+    p.add_argument('--batch', type=int, default=100, help='requests per progress report')
+    p.add_argument('--max-seconds', type=float, default=None,
+                   help='stop after this long, a later run carries on')
+    p.add_argument('--retry-failed', action='store_true', help='try failed jobs again')
+    p.add_argument('--compress', action='store_true', help='gzip the pages in the cache')
+    p.add_argument('--output', default='jobs.json', help='summary of the jobs')
+    p.add_argument('--base-url', default='https://api.crossref.org')
+    p.add_argument('--event-data-url', default='https://api.eventdata.crossref.org')
+    p.set_defaults(run=schedule)
+
+    return parser
+
+
+def main(argv=None):
+    ''' command line entry point, returns the exit code '''
+
+    parser = buildParser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return EXIT_OK if e.code == 0 else EXIT_USAGE
+
+    progress = progressReporter(args.command, args.progress)
+
+    # the reporter replaces the package's own messages
+    quiet = metrics.quiet
+    metrics.quiet = args.progress != 'text'
+    limiter = metrics.limiter
+    if args.rate_limit:
+        metrics.limiter = rateLimiter(args.rate_limit)
+    sink = metrics.addSink(prometheusSink(args.metrics)) if args.metrics else None
+
+    try:
+        return args.run(args, progress)
+    except KeyboardInterrupt:
+        return progress.finish(EXIT_FAILED, message='interrupted')
+    except Exception as e:
+        return progress.finish(EXIT_FAILED, message=repr(e))
+    finally:
+        if sink is not None:
+            sink.flush()
+            metrics.removeSink(sink)
+        metrics.quiet = quiet
+        metrics.limiter = limiter
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Domain counts across many evidence records at once.
+
+@author: martynrittman
+"""
+
+import os
+import gzip
+import json
+from functools import lru_cache
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from mrced2.instrument import metrics
+except:
+    from instrument import metrics
+
+
+@lru_cache(maxsize=65536)
+def netloc(url):
+    '''
+    The network location (domain) of a URL, the same as urlparse(url).netloc.
+
+    Most URLs look like scheme://host/path, in which case the host is cut out
+    of the string directly; anything else goes through urlparse. Results are
+    memoized because the same URLs turn up again and again in evidence records.
+
+    '''
+
+    scheme, sep, rest = url.partition('://')
+    if sep and scheme.isalpha():
+        end = len(rest)
+        for c in '/?#':
+            i = rest.find(c, 0, end)
+            if i >= 0:
+                end = i
+        return rest[:end]
+
+    return urlparse(url).netloc
+
+
+class domainCounts(dict):
+    '''
+    Observation and event counts per domain, stored as
+    {domain: [observations, events]}. Counts from different evidence records
+    (or different processes) are combined with merge().
+
+    '''
+
+    def add(self, domain, observations=0, events=0):
+        ''' add observations and events for one domain '''
+
+        try:
+            c = self[domain]
+        except KeyError:
+            c = self[domain] = [0, 0]
+        c[0] += observations
+        c[1] += events
+
+    def merge(self, other):
+        ''' add the counts from another domainCounts (or dict of [observations, events]) '''
+
+        for domain, (observations, events) in other.items():
+            self.add(domain, observations, events)
+
+        return self
+
+    def __add__(self, other):
+        return domainCounts().merge(self).merge(other)
+
+    def toDict(self):
+        '''
+        The counts in the same format as evidenceRecords.countDomains:
+        {domain: {'observations': int, 'events': int, 'event-ratio': float}}.
+        The ratio is 0 when there are no observations.
+
+        '''
+
+        out = {}
+        for domain, (observations, events) in self.items():
+            out[domain] = {'observations': observations, 'events': events,
+                           'event-ratio': events / float(observations) if observations else 0}
+
+        return out
+
+
+# =====================================
+
+# Counting a single record
+
+
+def countRecordDomains(jsonData, counts=None):
+    '''
+    Count observations and events per domain of the subject URL of each
+    action. Don't use this for Twitter, see countRecordTwitterDomains.
+
+    Parameters
+    ----------
+    jsonData : dict
+        an evidence record
+    counts : domainCounts, optional
+        counts to add to, a new object is made if not given
+
+    Returns
+    -------
+    domainCounts
+
+    '''
+
+    if counts is None:
+        counts = domainCounts()
+
+    for page in jsonData['pages']:
+        for action in page['actions']:
+
+            # get the candidate url from the action
+            try:
+                url = action['subj']['url']
+            except KeyError:
+                continue
+
+            counts.add(netloc(url), len(action.get('processed-observations', ())),
+                       len(action.get('events', ())))
+
+    return counts
+
+
+def countRecordTwitterDomains(jsonData, counts=None):
+    '''
+    Count candidate URLs (observations) and event object URLs (events) per
+    domain for a twitter-agent evidence record. Other agents give no counts.
+
+    Parameters
+    ----------
+    jsonData : dict
+        an evidence record
+    counts : domainCounts, optional
+        counts to add to, a new object is made if not given
+
+    Returns
+    -------
+    domainCounts
+
+    '''
+
+    if counts is None:
+        counts = domainCounts()
+
+    try:
+        if not(jsonData['agent']['name'] == 'twitter-agent'):
+            return counts
+    except (KeyError, TypeError):
+        # couldn't locate agent name
+        return counts
+
+    for page in jsonData['pages']:
+        for action in page['actions']:
+            for obs in action.get('processed-observations', ()):
+                try:
+                    for candidate in obs['candidates']:
+                        try:
+                            url = candidate['value']
+                        except KeyError:
+                            continue
+                        counts.add(netloc(url), observations=1)
+                except (KeyError, TypeError):
+                    pass
+
+            for event in action.get('events', ()):
+                try:
+                    url = event['obj']['url']
+                except KeyError:
+                    continue
+                counts.add(netloc(url), events=1)
+
+    return counts
+
+
+def isTwitter(jsonData):
+    ''' is this evidence record from the twitter agent? '''
+
+    try:
+        return jsonData['agent']['name'] == 'twitter-agent'
+    except (KeyError, TypeError):
+        return False
+
+
+def loadRecord(item):
+    '''
+    Load an evidence record from a path (json or gzipped json, e.g. a file in
+    an evidenceArchive) or return it unchanged if it's already a dictionary.
+
+    '''
+
+    if isinstance(item, dict):
+        return item
+
+    opener = gzip.open if item.endswith('.gz') else open
+    with opener(item, 'rb') as f:
+        return json.loads(f.read())
+
+
+def countChunk(args):
+    '''
+    Count domains for a list of records. Run in worker processes, so it takes
+    a single picklable argument (items, mode) and returns a plain dict.
+
+    '''
+
+    items, mode = args
+    counts = domainCounts()
+    failed = 0
+
+    for item in items:
+        try:
+            jsonData = loadRecord(item)
+        except (OSError, ValueError):
+            failed += 1
+            continue
+
+        if mode == 'twitter' or (mode == 'auto' and isTwitter(jsonData)):
+            countRecordTwitterDomains(jsonData, counts)
+        else:
+            countRecordDomains(jsonData, counts)
+
+    return dict(counts), failed
+
+
+class domainAnalytics:
+    '''
+    Domain counts aggregated over many evidence records, using a pool of
+    processes. Workers load records from files themselves, so records in an
+    evidenceArchive or in json files are counted in parallel; records that are
+    already loaded are counted in this process.
+
+    basic usage:
+        da = domainAnalytics(processes=8)
+        report = da.run(archive)   # an evidenceArchive, or a list of files or dicts
+        da.topDomains(20)
+
+    '''
+
+    def __init__(self, processes=None, chunkSize=64, quiet=False):
+        '''
+        Parameters
+        ----------
+        processes : int
+            number of worker processes, defaults to the number of CPUs.
+            Use 0 to count in this process.
+        chunkSize : int
+            number of records sent to a worker at a time
+        quiet : boolean
+            There is no printed output if True. The default is False.
+
+        '''
+
+        self.processes = processes
+        self.chunkSize = chunkSize
+        self.quiet = quiet
+
+        self.counts = domainCounts()
+        self.failed = 0
+
+    def recordItems(self, records, urls=None):
+        '''
+        Turn the input into a list of paths or dicts that worker processes can
+        load by themselves.
+
+        Parameters
+        ----------
+        records : evidenceArchive, list of str (file paths), list of dicts
+            or list of evidenceRecords objects
+        urls : list of str, optional
+            with an evidenceArchive, only use these evidence records
+
+        '''
+
+        # an evidenceArchive: send the object paths rather than the contents
+        if hasattr(records, 'objectPath'):
+            index = records.index
+            if urls is None:
+                keys = index.keys()
+            else:
+                keys = [records.fullUrl(u) for u in urls]
+            return [records.objectPath(index[k]) for k in keys if k in index]
+
+        items = []
+        for r in records:
+            if hasattr(r, 'jsonData'):
+                items.append(r.jsonData)
+            else:
+                items.append(r)
+
+        return items
+
+    def run(self, records, mode='auto', urls=None):
+        '''
+        Count domains across all the records and add them to self.counts.
+
+        Only records given as files (paths, or an evidenceArchive) are counted
+        in parallel, as workers read them themselves. Records already in
+        memory (dicts or evidenceRecords objects) are counted in this
+        process: sending them to a worker costs more than counting them (on
+        100 synthetic records of 2000 actions, pickling and unpickling took
+        about 12 times as long as counting). To count many records in
+        parallel, save them or fetch them into an evidenceArchive first.
+
+        Parameters
+        ----------
+        records : see recordItems()
+        mode : str
+            "standard" counts like evidenceRecords.countDomains, "twitter" like
+            countTwitterDomains, "auto" picks per record from the agent name
+        urls : list of str, optional
+            with an evidenceArchive, only use these evidence records
+
+        Returns
+        -------
+        dict:
+            {domain: {'observations': int, 'events': int, 'event-ratio': float}}
+
+        '''
+
+        if not(mode in ('auto', 'standard', 'twitter')):
+            metrics.say('Supply a valid mode for counting domains')
+            return
+
+        items = self.recordItems(records, urls)
+        chunks = [(items[i:i + self.chunkSize], mode)
+                  for i in range(0, len(items), self.chunkSize)]
+
+        if not(self.quiet):
+            metrics.say('counting domains in ' + str(len(items)) + ' evidence records')
+
+        # a single chunk isn't worth starting processes for, and records that
+        # are already in memory cost more to send to a process than to count,
+        # see above
+        inMemory = len(items) > 0 and not isinstance(items[0], str)
+        if self.processes == 0 or len(chunks) <= 1 or inMemory:
+            for counts, failed in map(countChunk, chunks):
+                self.counts.merge(counts)
+                self.failed += failed
+        else:
+            with ProcessPoolExecutor(max_workers=self.processes or os.cpu_count()) as pool:
+                for counts, failed in pool.map(countChunk, chunks):
+                    self.counts.merge(counts)
+                    self.failed += failed
+
+        if not(self.quiet) and self.failed > 0:
+            metrics.say(str(self.failed) + ' evidence records could not be read')
+
+        return self.counts.toDict()
+
+    def topDomains(self, n=20, by='events'):
+        '''
+        The n domains with most events (or observations).
+
+        Returns
+        -------
+        list of (domain, {'observations', 'events', 'event-ratio'}) tuples
+
+        '''
+
+        report = self.counts.toDict()
+        return sorted(report.items(), key=lambda kv: kv[1][by], reverse=True)[:n]
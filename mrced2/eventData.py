@@ -2,11 +2,17 @@
 
 import requests
 import json
+import time
+import calendar
 #from tenacity import retry, stop_after_attempt, wait_random_exponential
 try:
     from mrced2.eventRecord import eventRecord
+    from mrced2.instrument import metrics
+    from mrced2.rawJson import rawJson, headValue, writeResponse
 except:
     from eventRecord import eventRecord
+    from instrument import metrics
+    from rawJson import rawJson, headValue, writeResponse
 
 
 class eventData:
@@ -27,6 +33,7 @@ class eventData:
                 rows - number of rows of full results to add into json file
                 self.cursor - a cursor for the next search, if required
                 self.pageCount - iterates through results pages
+                self.baseUrl - location of the API, without /v1/events
 
         '''
 
@@ -57,6 +64,12 @@ class eventData:
         else:
             self.rows = 1000  # default number of rows to report
 
+        # API location, can be changed e.g. to use a mockServer
+        if "baseUrl" in kwargs:
+            self.baseUrl = kwargs["baseUrl"].rstrip('/')
+        else:
+            self.baseUrl = 'https://api.eventdata.crossref.org'
+
         # Internal varaibles
         # displays the command executed; note that the acutal call is done with the requests package
         self.queryUrl = ''
@@ -64,6 +77,14 @@ class eventData:
         self.pageCount = 1  # iterates through results pages, also used in filenames
         self.success = False  # True if the last API call was successful
 
+        # tail mode: collected timestamp that polls start from, the ids of
+        # events seen since then (id -> timestamp), and the query and cursor
+        # that the next poll carries on from
+        self.tailSince = None
+        self.tailSeen = {}
+        self.tailQuery = None
+        self.tailCursor = None
+
     def buildQuery(self, filters, quiet=False, cursor=None):
         ''' Build the query for the eventdata API, but don't execute it. Run 'runcommand' to execute.
 
@@ -137,8 +158,8 @@ class eventData:
                 params[k] = str(filters[k])
             else:
                 # error message in case
-                print('non-standard filter found, ' +
-                      k + ', ' + str(filters[k]))
+                metrics.say('non-standard filter found, ' +
+                            k + ', ' + str(filters[k]))
 
         # add count to facets
         if 'facet' in params:
@@ -148,21 +169,21 @@ class eventData:
 
         if not(quiet):
             # For the benefit of users, display the query to be made
-            self.queryUrl = 'https://api.eventdata.crossref.org/v1/events?'
+            self.queryUrl = self.baseUrl + '/v1/events?'
 
             # add parameters to the text query
             for p in params:
                 self.queryUrl += str(p) + "=" + str(self.params[p]) + "&"
 
             self.queryUrl = self.queryUrl[:-1]
-            print(self.queryUrl)
+            metrics.say(self.queryUrl)
 
     def runCommand(self):
-        print("please use runQuery, runCommand will be deprecated")
+        metrics.say("please use runQuery, runCommand will be deprecated")
 
         self.runQuery()
 
-    def runQuery(self, retry=1, quiet=False, saveToFile=True):
+    def runQuery(self, retry=1, quiet=False, saveToFile=True, raw=False, compress=False):
         '''
         Run the query defined by buildQuery(), uses requests
 
@@ -177,6 +198,12 @@ class eventData:
         saveToFile : boolean
             Saves the result to self.outputFile if 
             set to True. The default is True.
+        raw : boolean
+            Write the response to self.outputFile as it arrives, without parsing
+            and re-encoding it. The next cursor is read from the start of the
+            response, and self.events is parsed when it is first used.
+        compress : boolean
+            With raw, write a gzip file (self.outputFile + '.gz').
 
         Returns
         -------
@@ -186,22 +213,42 @@ class eventData:
 
         # Short message to say things are getting going
         if not(quiet):
-            print("Event Data query started...")
+            metrics.say("Event Data query started...")
 
         # the query URL
         # "https://api-staging.eventdata.crossref.org/v1/events"
-        url = "https://api.eventdata.crossref.org/v1/events"
+        url = self.baseUrl + "/v1/events"
 
         for ii in range(retry):
             # make the API request using parameters from buildQuery()
-            r = requests.get(url, params=self.params)
+            r = metrics.get(url, retries=ii, params=self.params, stream=raw and saveToFile)
 
             # print a short confirmation on completion
             if not(quiet):
-                print('API query complete ', r.status_code)
+                metrics.say('API query complete ', r.status_code)
+
+            if raw and r.status_code in (200, 201):
+                self.success = True
+                self.events = eventRecord()
+
+                if saveToFile:
+                    filename, head = writeResponse(r, self.outputFile, compress)
+                    self.events.jsonData = rawJson(filename=filename)
+                    if not(quiet):
+                        metrics.say("output file written to " + filename)
+                else:
+                    head = r.content[:65536]
+                    self.events.jsonData = rawJson(content=r.content)
+
+                # the cursor comes before the events, so the page needn't be parsed
+                found, self.cursor = headValue(head, 'next-cursor')
+                if not(found):
+                    self.cursor = self.events.jsonData["message"]["next-cursor"]
+
+                break
 
             # stop if there wasn't a response
-            if r.status_code in (200, 201):
+            elif r.status_code in (200, 201):
                 self.success = True
                 # find and save the next cursor (add to next call to iterate results pages)
                 jsonData = r.json()
@@ -215,12 +262,13 @@ class eventData:
                         # save the json result to file
                         json.dump(jsonData, f)
                         if not(quiet):
-                            print("output file written to " + self.outputFile)
+                            metrics.say("output file written to " + self.outputFile)
 
                 break
 
             else:
                 self.success = False
+                r.close()
 
     def getNextPage(self):
         '''
@@ -234,7 +282,7 @@ class eventData:
 
         # put the cursor into the parameters
         if self.cursor in ("-1", None):
-            print("max page limit reached", self.cursor)
+            metrics.say("max page limit reached", self.cursor)
             self.cursor = "-1"
 
         else:
@@ -253,7 +301,7 @@ class eventData:
             try:
                 self.runQuery(retry=1)
             except:
-                print('failure for ' + self.outputFile)
+                metrics.say('failure for ' + self.outputFile)
 
             # iterate the page number
             if self.success:
@@ -281,10 +329,10 @@ class eventData:
 
         if 'rows' in filters:
             if filters['rows'] == 0:
-                print('zero rows defined')
+                metrics.say('zero rows defined')
                 return
         elif self.rows == 0:
-            print('zero rows defined')
+            metrics.say('zero rows defined')
             return
 
         # Subsequent runs
@@ -300,8 +348,185 @@ class eventData:
                 break
 
             if self.success == False:
-                print('unsuccessful query')
+                metrics.say('unsuccessful query')
+                break
+
+    # ========================================================================
+
+    # Tail mode
+
+    def poll(self, filters, since=None, lag=600, retry=3, maxPages=None):
+        '''
+        Fetch the events collected since the last poll, leaving out any that
+        were returned before, and any without an id.
+
+        The API filters collected dates by day, so the first poll of a day
+        pages through the events collected since the start of the day of
+        self.tailSince. Later polls carry on from the last page fetched, so
+        each one costs about a page plus the new events. Events already seen
+        are recognised by their id. After a complete poll, self.tailSince
+        moves up to `lag` seconds before the newest event.
+
+        Carrying on from the last page assumes that new events are added
+        after the ones already returned. An event indexed late into an
+        earlier page is only found when a poll starts the day again: when
+        self.tailSince moves to a new day, or after a failed request.
+
+        Parameters
+        ----------
+        filters : dict
+            same as for buildQuery(), without collected dates
+        since : str, optional
+            YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ, start from here rather than
+            self.tailSince. The first poll starts from now if neither is set.
+        lag : int
+            seconds that events can take to appear after they are collected
+        retry : int
+            attempts per page
+        maxPages : int, optional
+            stop after this many pages, the next poll carries on from there
+
+        Returns
+        -------
+        list of dicts:
+            the new events
+
+        '''
+
+        query, cursor = self._pollQuery(filters, since)
+
+        new = []
+        pages = 0
+        complete = False
+        while maxPages is None or pages < maxPages:
+            self.buildQuery(query, quiet=True, cursor=cursor)
+            try:
+                self.runQuery(retry=retry, quiet=True, saveToFile=False)
+            except requests.RequestException:
+                self.success = False
+            if not(self.success):
+                # the cursor may have expired, the next poll starts the day again
+                cursor = None
+                break
+
+            events = self._pollPage(new)
+            pages += 1
+
+            if self.cursor in (None, '', '-1') or len(events) == 0:
+                complete = True
                 break
+            cursor = self.cursor
+
+        self.tailCursor = cursor
+        if complete:
+            self._pollMark(lag)
+
+        return new
+
+    def _pollQuery(self, filters, since):
+        '''
+        The query of a poll, from since or self.tailSince, and the cursor to
+        start from: the one left by the last poll if the query hasn't changed.
+
+        '''
+
+        if since is not None:
+            self.tailSince = since if 'T' in since else since[:10] + 'T00:00:00Z'
+        if self.tailSince is None:
+            self.tailSince = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+        query = dict(filters)
+        query['from-collected-date'] = self.tailSince[:10]
+
+        if query != self.tailQuery:
+            self.tailQuery = query
+            self.tailCursor = None
+
+        return query, self.tailCursor
+
+    def _pollPage(self, new):
+        ''' add the unseen events of the page in self.events to new, and return the page's events '''
+
+        events = self.events.jsonData["message"]["events"]
+        for ev in events:
+            t = ev.get('timestamp', '')
+            eventId = ev.get('id')
+            # without an id, it would be returned again by every poll
+            if eventId is None or t < self.tailSince or eventId in self.tailSeen:
+                continue
+            self.tailSeen[eventId] = t
+            new.append(ev)
+
+        return events
+
+    def _pollMark(self, lag):
+        '''
+        Move the watermark after a complete poll; only then, so that events on
+        pages that weren't fetched aren't skipped next time.
+
+        '''
+
+        if self.tailSeen:
+            newest = calendar.timegm(time.strptime(max(self.tailSeen.values())[:19],
+                                                   '%Y-%m-%dT%H:%M:%S'))
+            mark = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(newest - lag))
+            if mark > self.tailSince:
+                self.tailSince = mark
+                self.tailSeen = {i: t for i, t in self.tailSeen.items() if t >= mark}
+
+    def tail(self, filters, since=None, interval=60, aggregators=None, maxPolls=None,
+             lag=600, retry=3, maxPages=None, quiet=False):
+        '''
+        Poll for new events every `interval` seconds, for live dashboards.
+
+        Parameters
+        ----------
+        filters : dict
+            same as for buildQuery(), without collected dates
+        since : str, optional
+            YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ to start from, default now
+        interval : float
+            seconds from the start of one poll to the start of the next
+        aggregators : object or list, optional
+            objects with an update(events) method, e.g. a liveAggregates,
+            given the new events of each poll
+        maxPolls : int, optional
+            stop after this many polls
+        lag : int
+            see poll()
+        retry : int
+            attempts per page
+        maxPages : int, optional
+            see poll()
+
+        Yields
+        ------
+        list of dicts:
+            the new events of each poll
+
+        '''
+
+        if aggregators is None:
+            aggregators = []
+        elif hasattr(aggregators, 'update'):
+            aggregators = [aggregators]
+
+        polls = 0
+        while maxPolls is None or polls < maxPolls:
+            started = time.monotonic()
+
+            new = self.poll(filters, since if polls == 0 else None, lag, retry, maxPages)
+            for agg in aggregators:
+                agg.update(new)
+            polls += 1
+
+            if not(quiet):
+                metrics.say(len(new), 'new events, since', self.tailSince)
+
+            yield new
+
+            if maxPolls is None or polls < maxPolls:
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
 
 
 if __name__ == "__main__":
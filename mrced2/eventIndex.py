@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-ordered index of events per object, for range and latest-N queries.
+
+@author: martynrittman
+"""
+
+from datetime import datetime, date, timezone
+
+import numpy as np
+
+try:
+    from mrced2.eventRecord import eventRecord
+except:
+    from eventRecord import eventRecord
+
+
+# period name -> numpy datetime unit, for timeline()
+PERIODS = {'day': 'D', 'month': 'M', 'year': 'Y'}
+
+
+class eventIndex:
+    '''
+    Events grouped by obj_id and sorted by occurred_at, so that the events of
+    one paper between two dates are found by binary search instead of a scan
+    of every event.
+
+    The index is held in arrays:
+        self.objects - the obj_ids, sorted
+        self.offsets - the events of self.objects[k] are positions
+                       offsets[k] to offsets[k+1] of order and times
+        self.order - position of each event in self.events
+        self.times - occurred_at in seconds since 1970, ascending for each object
+
+    Events without the key field or a readable occurred_at aren't indexed,
+    and are counted in self.skipped. Times with an offset (e.g. +01:00) are
+    converted to UTC.
+
+    Dates given to the queries can be YYYY-MM-DD, an ISO timestamp, a
+    datetime or a date. As for the Event Data API, fromDate and untilDate
+    are both included, and a untilDate without a time runs to the end of
+    that day.
+
+    basic usage:
+        ix = er.buildIndex()   # er is an eventRecord
+        ix.range('10.21105/joss.01686', '2021-01-01', '2021-06-30')
+        ix.latest('10.21105/joss.01686', 5)
+        ix.timeline('10.21105/joss.01686', period='month')
+
+    '''
+
+    def __init__(self, er=None, events=None, key='obj_id'):
+        '''
+        Parameters
+        ----------
+        er : eventRecord, optional
+            index the events of er.jsonData
+        events : list of dicts, optional
+            index these events instead
+        key : str
+            the field to group events by, e.g. subj_id
+
+        '''
+
+        self.key = key
+        self.skipped = 0
+
+        if er is not None:
+            events = er.jsonData["message"]["events"]
+
+        self.build([] if events is None else events)
+
+    # =====================================
+
+    # Building
+
+    def build(self, events):
+        '''
+        Index a list of events, replacing anything indexed before. The list
+        is kept, not copied.
+
+        Returns
+        -------
+        self
+
+        '''
+
+        self.events = events
+
+        positions = []
+        keys = []
+        stamps = []
+        for i, ev in enumerate(events):
+            k = ev.get(self.key)
+            occurred = ev.get('occurred_at')
+            if k is None or not occurred or not isinstance(occurred, str):
+                continue
+            # fractions of a second are dropped; times not in UTC are converted
+            if occurred[19:].lstrip('.0123456789') not in ('', 'Z'):
+                occurred = utcStamp(occurred)
+                if occurred is None:
+                    continue
+            positions.append(i)
+            keys.append(k)
+            stamps.append(occurred[:19])
+
+        try:
+            times = np.array(stamps, dtype='datetime64[s]').astype(np.int64)
+        except ValueError:
+            # one at a time, leaving out the ones that can't be read
+            times = []
+            keep = []
+            for j, stamp in enumerate(stamps):
+                try:
+                    times.append(np.datetime64(stamp, 's').astype(np.int64))
+                except ValueError:
+                    continue
+                keep.append(j)
+            times = np.array(times, dtype=np.int64)
+            positions = [positions[j] for j in keep]
+            keys = [keys[j] for j in keep]
+
+        self.skipped = len(events) - len(positions)
+
+        self.objects, codes = np.unique(np.array(keys, dtype=object), return_inverse=True)
+        self.objects = self.objects.tolist()
+        self._positions = {o: k for k, o in enumerate(self.objects)}
+        # by object, then by time within each object
+        sort = np.lexsort((times, codes))
+
+        self.order = np.array(positions, dtype=np.int64)[sort]
+        self.times = times[sort]
+        self.offsets = np.zeros(len(self.objects) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(self.objects)), out=self.offsets[1:])
+
+        return self
+
+    def add(self, events):
+        '''
+        Add more events and rebuild the index.
+
+        Returns
+        -------
+        self
+
+        '''
+
+        return self.build(list(self.events) + list(events))
+
+    # =====================================
+
+    # Queries
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, objId):
+        return self._lookup(objId) is not None
+
+    def _lookup(self, objId):
+        ''' position of objId in self.objects, None if it has no events '''
+
+        k = self._positions.get(objId)
+        # bare DOIs are matched to https://doi.org/ obj_ids
+        if k is None and not objId.startswith('http'):
+            k = self._positions.get('https://doi.org/' + objId)
+
+        return k
+
+    def _span(self, objId, fromDate=None, untilDate=None):
+        ''' the first and last+1 positions in self.order of objId's events between the dates '''
+
+        k = self._lookup(objId)
+        if k is None:
+            return 0, 0
+
+        lo, hi = self.offsets[k], self.offsets[k + 1]
+        times = self.times[lo:hi]
+
+        start, end = 0, hi - lo
+        if fromDate is not None:
+            start = np.searchsorted(times, toSeconds(fromDate), side='left')
+        if untilDate is not None:
+            end = np.searchsorted(times, toSeconds(untilDate, end=True), side='right')
+
+        return lo + start, lo + max(start, end)
+
+    def range(self, objId, fromDate=None, untilDate=None):
+        '''
+        Events of one object between two dates.
+
+        Parameters
+        ----------
+        objId : str
+            obj_id, or a bare DOI
+        fromDate, untilDate : str, datetime or date, optional
+            included; leave out for no limit
+
+        Returns
+        -------
+        list of dicts:
+            the events, oldest first
+
+        '''
+
+        lo, hi = self._span(objId, fromDate, untilDate)
+
+        return [self.events[i] for i in self.order[lo:hi]]
+
+    def count(self, objId, fromDate=None, untilDate=None):
+        ''' number of events of one object between two dates, without reading them '''
+
+        lo, hi = self._span(objId, fromDate, untilDate)
+
+        return int(hi - lo)
+
+    def latest(self, objId, n=10, untilDate=None):
+        '''
+        The most recent events of one object.
+
+        Parameters
+        ----------
+        objId : str
+        n : int
+            number of events
+        untilDate : str, datetime or date, optional
+            latest as of this date
+
+        Returns
+        -------
+        list of dicts:
+            up to n events, newest first
+
+        '''
+
+        lo, hi = self._span(objId, None, untilDate)
+
+        return [self.events[i] for i in self.order[max(lo, hi - n):hi][::-1]]
+
+    def timeline(self, objId, period='month', fromDate=None, untilDate=None):
+        '''
+        Counts of the events of one object per day, month or year.
+
+        Parameters
+        ----------
+        objId : str
+        period : str
+            'day', 'month' or 'year'
+        fromDate, untilDate : str, datetime or date, optional
+
+        Returns
+        -------
+        dict:
+            period (e.g. 2021-03) -> count, in date order. Periods without
+            events are left out.
+
+        '''
+
+        lo, hi = self._span(objId, fromDate, untilDate)
+
+        periods = self.times[lo:hi].astype('datetime64[s]').astype('datetime64[' + PERIODS[period] + ']')
+        names, counts = np.unique(periods, return_counts=True)
+
+        return {str(p): int(c) for p, c in zip(names, counts)}
+
+    def counts(self):
+        ''' obj_id -> number of indexed events '''
+
+        return dict(zip(self.objects, np.diff(self.offsets).tolist()))
+
+    def toEventRecord(self, objId, fromDate=None, untilDate=None):
+        '''
+        The events of range() as an eventRecord, in the same form as
+        eventRecord.filterEvents() returns.
+
+        '''
+
+        events = self.range(objId, fromDate, untilDate)
+
+        er = eventRecord()
+        er.jsonData = {"status": "ok", "message": {
+            "total-results": len(events), "events": events}}
+        er.jsonLoadSuccess = True
+
+        return er
+
+    # =====================================
+
+    # Saving
+
+    def save(self, filename):
+        '''
+        Save the index arrays to an .npz file. The events aren't saved, so
+        load() needs the same list of events.
+
+        '''
+
+        np.savez(filename, objects=np.array(self.objects, dtype=str), offsets=self.offsets,
+                 order=self.order, times=self.times, key=self.key, skipped=self.skipped,
+                 eventCount=len(self.events))
+
+    @classmethod
+    def load(cls, filename, er=None, events=None):
+        '''
+        Load an index saved by save().
+
+        Parameters
+        ----------
+        filename : str
+        er : eventRecord, optional
+            the events the index was built from
+        events : list of dicts, optional
+            or the list of events itself
+
+        Returns
+        -------
+        eventIndex
+
+        '''
+
+        if er is not None:
+            events = er.jsonData["message"]["events"]
+
+        with np.load(filename) as data:
+            if int(data['eventCount']) != len(events):
+                raise ValueError(f'{filename} indexes {int(data["eventCount"])} events, not {len(events)}')
+
+            ix = cls.__new__(cls)
+            ix.key = str(data['key'])
+            ix.skipped = int(data['skipped'])
+            ix.events = events
+            ix.objects = data['objects'].tolist()
+            ix._positions = {o: k for k, o in enumerate(ix.objects)}
+            ix.offsets = data['offsets']
+            ix.order = data['order']
+            ix.times = data['times']
+
+        return ix
+
+
+def utcStamp(value):
+    ''' YYYY-MM-DDTHH:MM:SS in UTC for an ISO timestamp with an offset, None if it can't be read '''
+
+    try:
+        t = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc)
+
+    return t.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def toSeconds(value, end=False):
+    '''
+    Seconds since 1970 for a date or time.
+
+    Parameters
+    ----------
+    value : str, datetime or date
+        YYYY-MM-DD, YYYY-MM, YYYY or an ISO timestamp
+    end : boolean
+        for a value without a time, the last second of that period rather
+        than the first
+
+    Returns
+    -------
+    int
+
+    '''
+
+    if isinstance(value, datetime):
+        value = value.strftime('%Y-%m-%dT%H:%M:%S')
+    elif isinstance(value, date):
+        value = value.isoformat()
+
+    value = value[:19]
+    t = np.datetime64(value)
+
+    if end and 'T' not in value:
+        # the start of the next day, month or year, less a second
+        t = t + np.timedelta64(1, np.datetime_data(t.dtype)[0])
+        return int(t.astype('datetime64[s]').astype(np.int64)) - 1
+
+    return int(t.astype('datetime64[s]').astype(np.int64))
@@ -6,9 +6,18 @@ Created on Mon Jun  8 14:28:58 2020
 @author: martynrittman
 """
 
+import os
+import gzip
 import json
-import pandas as pd
 import pprint
+try:
+    from mrced2.patternMatcher import patternMatcher
+    from mrced2.instrument import metrics, eventCount
+    from mrced2.rawJson import lazyJsonData
+except:
+    from patternMatcher import patternMatcher
+    from instrument import metrics, eventCount
+    from rawJson import lazyJsonData
 
 
 class eventRecord():
@@ -26,10 +35,16 @@ class eventRecord():
     filterEvents - create a subset of events by filtering
     eventHist - find counts of events with certain properties
     dictValueCheck - used by eventHist, checks for values in a dictionary
+    buildIndex - index events by obj_id and occurred_at for date range queries
+    sample - a random sample of the events, for approximate analysis
 
+    jsonData can be given a rawJson (see eventData.runQuery(raw=True)), which
+    is only parsed when it is first used.
 
     '''
 
+    jsonData = lazyJsonData()
+
     def __init__(self, **kwargs):
         ''' Initialisation. The variables here are set elsewhere, no user input is needed.
 
@@ -53,12 +68,15 @@ class eventRecord():
 
     # Get json data in and out
 
+    @metrics.timed(size=lambda self, filename: os.path.getsize(filename))
     def loadJson(self, filename):
-        ''' load a json file (filename) and turn it into a dictionary, self.jsonData
+        ''' load a json file (filename) and turn it into a dictionary, self.jsonData.
+            The file can be gzip-compressed, with a name ending in .gz
 
             returns 1 for success, otherwise returns 0'''
 
-        with open(filename) as f:
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt') as f:
             try:
                 # Use the json package to load the data
                 self.jsonData = json.load(f)
@@ -74,7 +92,7 @@ class eventRecord():
 
             except:
                 # Print a message but don't raise an exception in case of failure
-                print('JSON file could not be read, check the contents')
+                metrics.say('JSON file could not be read, check the contents')
 
                 return False  # failure
 
@@ -104,7 +122,9 @@ class eventRecord():
 
         return self.jsonLoadSuccess
 
-    def mergeJsons(self, fileList, folder=""):
+    @metrics.timed(size=lambda self, fileList, *args, **kwargs: len(fileList))
+    def mergeJsons(self, fileList, folder="", saveToFile=True, quiet=False,
+                   outputFile="10.21105/ced.json"):
         '''
         A function to join multiple json files into one, for example if you collect
         different pages for a single call.
@@ -112,15 +132,18 @@ class eventRecord():
         Parameters
         ----------
         fileList : List of strings
-            A list of files for which events should be merged.
+            A list of files for which events should be merged. Files ending in
+            .gz are read as gzip-compressed.
         folder : String
             optional argument to include in case all files are in a subfolder,
             will be prefixed to the file name before opening.
         saveToFile : boolean
-            Saves the merged json contents to self.outputFile if 
+            Saves the merged json contents to outputFile if 
             set to True. The default is True.
         quiet: boolean
             if True nothing will be printed
+        outputFile : String
+            file the merged json is saved to
 
         Returns
         -------
@@ -139,7 +162,8 @@ class eventRecord():
         # iterate the file list
         for fname in fileList:
             try:
-                with open(folder + fname) as f:
+                opener = gzip.open if fname.endswith('.gz') else open
+                with opener(folder + fname, 'rt') as f:
                     # get the data from the file using the json module
 
                     js = json.load(f)
@@ -152,17 +176,20 @@ class eventRecord():
 
             except:
                 # print a message but continue to the next file if something goes wrong
-                print("failed to load " + fname)
+                if not(quiet):
+                    metrics.say("failed to load " + fname)
 
         # check if something loaded
         if len(self.jsonData["message"]["events"]) > 0:
             self.jsonLoadSuccess = True
 
         # save to a new JSON file
-        with open("10.21105/ced.json", 'w') as f:
-            # save the json result to file
-            json.dump(self.jsonData, f)
-            print("output file written to " + "10.21105/ced.json")
+        if saveToFile:
+            with open(outputFile, 'w') as f:
+                # save the json result to file
+                json.dump(self.jsonData, f)
+                if not(quiet):
+                    metrics.say("output file written to " + outputFile)
 
     def getStatus(self):
         ''' Check the Json data to see the status of the search 
@@ -179,7 +206,7 @@ class eventRecord():
         try:
             status = self.jsonData["status"]
         except:
-            print('no status data in json')
+            metrics.say('no status data in json')
             return 'null'
 
         return status
@@ -206,7 +233,7 @@ class eventRecord():
         # check if the json is valid
         s = self.getStatus()
         if s != 'ok':
-            print('no hits - invalid json')
+            metrics.say('no hits - invalid json')
             return -1
 
         # Get the number of results
@@ -215,7 +242,7 @@ class eventRecord():
 
         # print results
         if not(quiet):
-            print(h, "events found")
+            metrics.say(h, "events found")
 
         return h
 
@@ -240,7 +267,7 @@ class eventRecord():
         # check if the json is valid
         s = self.getStatus()
         if s != 'ok':
-            print('no events - invalid json')
+            metrics.say('no events - invalid json')
             return -1
 
         # Check if n is more than the number of available events
@@ -280,7 +307,7 @@ class eventRecord():
         try:
             self.stats['facets'] = self.jsonData['message']['facets']
         except:
-            print('no facets in json file')
+            metrics.say('no facets in json file')
             return
 
         if not(quiet):
@@ -288,6 +315,7 @@ class eventRecord():
 
         return self.stats['facets']
 
+    @metrics.timed(size=eventCount)
     def searchEvents(self, field, value):
         '''
         Search events for some kind of characteristic. Matches if value is
@@ -300,12 +328,21 @@ class eventRecord():
             field: String
                 name of any field in an event (e.g. id, terms, obj_id)
 
-            value: String
-                value of a field to search for
+            value: String or list of strings
+                value of a field to search for. If a list is given, all the
+                values are searched for in a single pass over each field.
+
+        Returns:
+            int: number of matches, or if value is a list, a dictionary of
+                value -> number of matches
 
         '''
 
-        count = 0
+        single = isinstance(value, str)
+        values = [value] if single else list(value)
+        matcher = patternMatcher(values)
+        counts = [0] * len(values)
+
         for ev in self.jsonData["message"]["events"]:
 
             dc = [ev]
@@ -324,11 +361,15 @@ class eventRecord():
             # search top level fields, object and subject for the specified data
             for d in dc:
                 if field in d:
-                    if value in d[field]:
-                        count += 1
+                    for i in matcher.search(d[field]):
+                        counts[i] += 1
 
-        return count
+        if single:
+            return counts[0]
 
+        return {v: c for v, c in zip(values, counts)}
+
+    @metrics.timed(size=eventCount)
     def filterEvents(self, mode="AND", useSubjs=False, useObjs=False, filters={}):
         '''
         filter all the events found by some criteria
@@ -353,12 +394,12 @@ class eventRecord():
         # check if the json is valid
         s = self.getStatus()
         if s != 'ok':
-            print('invalid json')
+            metrics.say('invalid json')
             return
 
         # Stop if the mode isn't correct
         if not(mode in ["AND", "OR", "NOT"]):
-            print("Supply a valid mode for filtering")
+            metrics.say("Supply a valid mode for filtering")
             return
 
         # reset the filter
@@ -423,6 +464,7 @@ class eventRecord():
 
         return jd
 
+    @metrics.timed(size=eventCount)
     def eventHist(self, field, bins=[], useObjs=False, useSubjs=False):
         '''
         Pool data from events based on field. Requires a json file to be loaded.
@@ -449,6 +491,7 @@ class eventRecord():
         --------
         histData: dictionary of keys and integers
             the count of each key found in the data.
+            For fields with too many values to hold, see eventHistExternal().
 
 
         '''
@@ -456,7 +499,7 @@ class eventRecord():
         # check if the json is valid
         s = self.getStatus()
         if s != 'ok':
-            print('invalid json')
+            metrics.say('invalid json')
             return -1
 
         # Case where a list of values is provided by the user
@@ -474,6 +517,11 @@ class eventRecord():
             for b in bins:
                 self.histData[b] = 0
 
+        # compile the bins once, so each field is scanned once for all of them
+        if binBool:
+            binList = list(self.histData)
+            matcher = patternMatcher(binList)
+
         # Iterate the loaded events
         for ev in self.jsonData["message"]["events"]:
             found = False  # was a match found?
@@ -493,6 +541,14 @@ class eventRecord():
                 except:
                     pass
 
+            # predefined bins: find all the bins in each field in one pass
+            if binBool:
+                for d in dc:
+                    if field in d:
+                        for i in matcher.search(d[field]):
+                            self.histData[binList[i]] += 1
+                continue
+
             # iterate the previous bins
             for b in self.histData:
                 # check to see if the value can be found in the field
@@ -512,6 +568,41 @@ class eventRecord():
         # Output
         return self.histData
 
+    def eventHistExternal(self, field, memoryBudget='256MB', useObjs=False, useSubjs=False):
+        '''
+        Count the events with each value of a field with an externalHist,
+        which spills counts to disk past memoryBudget. For fields with too
+        many values to hold, e.g. subj_id.
+
+        Parameters
+        ----------
+        field : str
+            field to count the values of, dots go into nested fields
+        memoryBudget : int or str
+            bytes of counts to hold in memory, e.g. '512MB'
+        useObjs, useSubjs : boolean
+            as for eventHist()
+
+        Returns
+        -------
+        externalHist, or -1 if the json isn't valid:
+            read it with items(), top() or writeCsv(), and close() it when done
+
+        '''
+
+        try:
+            from mrced2.externalHist import externalHist
+        except:
+            from externalHist import externalHist
+
+        # check if the json is valid
+        s = self.getStatus()
+        if s != 'ok':
+            metrics.say('invalid json')
+            return -1
+
+        return externalHist(field, memoryBudget, useObjs=useObjs, useSubjs=useSubjs).update(self)
+
     def dictValueCheck(self, d, field, value):
         '''
         Check if a value is in a given field of a dictionary
@@ -538,6 +629,62 @@ class eventRecord():
         else:
             return False
 
+    # ========================================================================
+
+    # Indexes
+
+    def buildIndex(self, key='obj_id'):
+        '''
+        Index the events by key and occurred_at, so that the events of one
+        object between two dates are found without a scan of all events.
+
+        Parameters
+        ----------
+        key : str
+            field to group events by, e.g. subj_id
+
+        Returns
+        -------
+        eventIndex
+
+        '''
+
+        try:
+            from mrced2.eventIndex import eventIndex
+        except:
+            from eventIndex import eventIndex
+
+        return eventIndex(self, key=key)
+
+    def sample(self, n=10000, by=None, seed=None, confidence=0.95):
+        '''
+        A random sample of the events. The analysis methods of the sample
+        give estimates for all the events, with confidence intervals.
+
+        Parameters
+        ----------
+        n : int
+            events to sample, or with `by`, events to sample for each value
+        by : str, optional
+            field to stratify the sample by, e.g. source_id
+        seed : int, optional
+            for a repeatable sample
+        confidence : float
+            level of the confidence intervals
+
+        Returns
+        -------
+        eventSample
+
+        '''
+
+        try:
+            from mrced2.eventSample import eventSample
+        except:
+            from eventSample import eventSample
+
+        return eventSample.fromEvents(self.jsonData["message"]["events"], n, by, seed, confidence)
+
 
 if __name__ == '__main__':
 
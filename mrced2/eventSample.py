@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Samples of events, for quick approximate answers from large corpora.
+
+@author: martynrittman
+"""
+
+import math
+import random
+from statistics import NormalDist
+
+try:
+    from mrced2.eventRecord import eventRecord
+    from mrced2.instrument import metrics
+except:
+    from eventRecord import eventRecord
+    from instrument import metrics
+
+
+class estimate(float):
+    '''
+    A count estimated from a sample: a float with the bounds of its
+    confidence interval in self.low and self.high. Arithmetic on it gives
+    plain floats. self.exact is True if the whole population was sampled.
+
+    '''
+
+    def __new__(cls, value, low, high):
+        est = super().__new__(cls, value)
+        est.low = low
+        est.high = high
+        est.exact = low == high
+
+        return est
+
+    def __repr__(self):
+        if self.exact:
+            return str(round(self))
+        return f'{round(self)} ({round(self.low)}-{round(self.high)})'
+
+
+class eventSample(eventRecord):
+    '''
+    A random sample of the events of an eventRecord, which the analysis
+    methods accept in the same way. getHits(), eventHist() and searchEvents()
+    return estimates for all the events rather than counts in the sample, and
+    filterEvents() returns another eventSample, from which the number of
+    events matching the filter in the whole set can be estimated.
+
+    Samples are simple random samples, or stratified by a field such as
+    source_id: the events of each value of the field are sampled separately,
+    up to n of each, so that rare sources are as well covered as common
+    ones. Estimates are the sum over strata of stratum size * the share of
+    sampled events that match, with a normal confidence interval that
+    allows for sampling without replacement.
+
+    Events from the sample are in self.jsonData as usual.
+        self.groups - stratum -> sampled events (None is the only stratum
+                      of a simple sample)
+        self.strata - stratum -> [number of events, number sampled]
+
+    basic usage:
+        s = er.sample(10000, by='source_id')   # er is an eventRecord
+        s.eventHist('source_id')               # {'twitter': 7512034 (7508311-7515757), ...}
+        s.filterEvents(filters={'relation_type_id': ['discusses']}).getHits()
+
+    '''
+
+    def __init__(self, groups=None, strata=None, by=None, confidence=0.95, seed=None):
+        '''
+        Parameters
+        ----------
+        groups : dict
+            stratum -> sampled events
+        strata : dict
+            stratum -> [number of events, number sampled]
+        by : str, optional
+            the field the sample is stratified by
+        confidence : float
+            level of the confidence intervals
+        seed : int, optional
+            seed the sample was drawn with
+
+        '''
+
+        super().__init__()
+
+        self.groups = groups or {}
+        self.strata = strata or {}
+        self.by = by
+        self.confidence = confidence
+        self.seed = seed
+        # made by filterEvents(), so not every event is like those sampled
+        self.filtered = False
+
+        self.population = sum(s[0] for s in self.strata.values())
+        events = [ev for g in self.groups.values() for ev in g]
+        self.jsonData = {"status": "ok", "message": {
+            "total-results": self.population, "events": events}}
+
+    # =====================================
+
+    # Drawing samples
+
+    @classmethod
+    def fromEvents(cls, events, n, by=None, seed=None, confidence=0.95):
+        '''
+        Sample from a list of events or, in one pass, from any iterable of
+        them (e.g. a stream of events from files) by reservoir sampling.
+
+        Parameters
+        ----------
+        events : list or iterable of dicts
+        n : int
+            events to sample, or with `by`, events to sample from each stratum
+        by : str, optional
+            field to stratify by, e.g. source_id
+        seed : int, optional
+            for a repeatable sample
+        confidence : float
+            level of the confidence intervals
+
+        Returns
+        -------
+        eventSample
+
+        '''
+
+        rnd = random.Random(seed)
+
+        if isinstance(events, list):
+            # positions of each stratum, then a plain sample of each
+            if by is None:
+                positions = {None: range(len(events))}
+            else:
+                positions = {}
+                for i, ev in enumerate(events):
+                    positions.setdefault(ev.get(by), []).append(i)
+
+            groups = {}
+            strata = {}
+            for h, pos in positions.items():
+                chosen = rnd.sample(pos, min(n, len(pos)))
+                groups[h] = [events[i] for i in sorted(chosen)]
+                strata[h] = [len(pos), len(chosen)]
+
+        else:
+            # algorithm R: item i of a stratum replaces a random one of the
+            # reservoir with probability n / i
+            groups = {}
+            strata = {}
+            for ev in events:
+                h = None if by is None else ev.get(by)
+                reservoir = groups.get(h)
+                if reservoir is None:
+                    reservoir = groups[h] = []
+                    strata[h] = [0, 0]
+                strata[h][0] += 1
+                if len(reservoir) < n:
+                    reservoir.append(ev)
+                else:
+                    j = rnd.randrange(strata[h][0])
+                    if j < n:
+                        reservoir[j] = ev
+            for h in strata:
+                strata[h][1] = len(groups[h])
+
+        return cls(groups, strata, by, confidence, seed)
+
+    # =====================================
+
+    # Estimates
+
+    def estimate(self, counts):
+        '''
+        Scale counts in the sample up to the whole set of events.
+
+        Parameters
+        ----------
+        counts : dict
+            stratum -> number of matches among the sampled events
+
+        Returns
+        -------
+        estimate
+
+        '''
+
+        z = NormalDist().inv_cdf(0.5 + self.confidence / 2)
+
+        value = 0.0
+        variance = 0.0
+        for h, (size, sampled) in self.strata.items():
+            k = counts.get(h, 0)
+            if sampled == 0:
+                continue
+            value += size * k / sampled
+            if sampled < size:
+                # the share is nudged off 0 and 1 so that no matches in the
+                # sample doesn't give an interval of zero width
+                p = min(1.0, (k + 0.5) / (sampled + 1))
+                fpc = (size - sampled) / (size - 1)
+                variance += size ** 2 * p * (1 - p) / sampled * fpc
+
+        half = z * math.sqrt(variance)
+
+        return estimate(value, max(0.0, value - half), min(self.population, value + half))
+
+    def _perStratum(self, method, *args, **kwargs):
+        ''' run an eventRecord method on the events of each stratum '''
+
+        results = {}
+        for h, events in self.groups.items():
+            er = eventRecord()
+            er.jsonData = {"status": "ok", "message": {
+                "total-results": len(events), "events": events}}
+            results[h] = getattr(eventRecord, method)(er, *args, **kwargs)
+
+        return results
+
+    def _scale(self, results):
+        ''' estimates from per-stratum results that are counts or dicts of counts '''
+
+        first = next(iter(results.values()), 0)
+        if not isinstance(first, dict):
+            return self.estimate(results)
+
+        keys = {}
+        for r in results.values():
+            keys.update(dict.fromkeys(r))
+
+        return {k: self.estimate({h: r.get(k, 0) for h, r in results.items()}) for k in keys}
+
+    # =====================================
+
+    # Analysis functions
+
+    def getHits(self, quiet=False):
+        '''
+        Estimated number of events in the whole set that are like the ones in
+        the sample, e.g. that matched filterEvents().
+
+        '''
+
+        if self.filtered:
+            h = self._scale({g: len(events) for g, events in self.groups.items()})
+        else:
+            h = estimate(self.population, self.population, self.population)
+        self.stats['hits'] = h
+
+        if not(quiet):
+            metrics.say(repr(h), "events estimated")
+
+        return h
+
+    def searchEvents(self, field, value):
+        ''' as eventRecord.searchEvents(), with estimated counts '''
+
+        return self._scale(self._perStratum('searchEvents', field, value))
+
+    def eventHist(self, field, bins=[], useObjs=False, useSubjs=False):
+        ''' as eventRecord.eventHist(), with estimated counts '''
+
+        results = self._perStratum('eventHist', field, bins, useObjs, useSubjs)
+        if len(results) == 0:
+            # an empty sample: still a dict, of the bins if there are any
+            self.histData = {b: self.estimate({}) for b in bins}
+        else:
+            self.histData = self._scale(results)
+
+        return self.histData
+
+    def filterEvents(self, mode="AND", useSubjs=False, useObjs=False, filters={}):
+        '''
+        as eventRecord.filterEvents(), giving an eventSample of the sampled
+        events that match. Its estimates are for the events that match in
+        the whole set.
+
+        '''
+
+        results = self._perStratum('filterEvents', mode, useSubjs, useObjs, filters)
+        if any(r is None for r in results.values()):
+            return
+
+        groups = {h: r.jsonData["message"]["events"] for h, r in results.items()}
+        filtered = eventSample(groups, {h: list(s) for h, s in self.strata.items()},
+                               self.by, self.confidence, self.seed)
+        filtered.filtered = True
+        filtered.jsonLoadSuccess = True
+
+        return filtered
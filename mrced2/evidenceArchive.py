@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk fetching of evidence records into a local, compressed archive.
+
+@author: martynrittman
+"""
+
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from mrced2.instrument import metrics, retryAfter
+except:
+    from instrument import metrics, retryAfter
+
+
+class evidenceArchive:
+    '''
+    A local archive of evidence records from Crossref Event Data.
+
+    Records are stored gzip-compressed under the sha256 hash of their content
+    (objects/ab/abcdef....json.gz), so identical records are only stored once.
+    index.jsonl maps each evidence record URL to its hash, one line per record.
+
+    basic usage:
+        ea = evidenceArchive('evidence')
+        ea.fetchAll(events)   # an eventRecord or a list of evidence record ids/URLs
+        er = ea.getRecord(url)   # an evidenceRecords object, no network call
+
+    '''
+
+    def __init__(self, folder='evidence', quiet=False,
+                 baseUrl='https://evidence.eventdata.crossref.org'):
+        '''
+        Parameters
+        ----------
+        folder : str
+            directory that holds the archive, created if it doesn't exist
+        quiet : boolean
+            There is no printed output if True. The default is False.
+        baseUrl : str
+            location of the evidence service, used to turn evidence record
+            ids into URLs
+
+        '''
+
+        self.folder = folder
+        self.quiet = quiet
+        self.urlPrefix = baseUrl.rstrip('/') + '/evidence/'
+        self.indexFile = os.path.join(folder, 'index.jsonl')
+
+        os.makedirs(os.path.join(folder, 'objects'), exist_ok=True)
+
+        # url -> sha256 of the record
+        self.index = {}
+        self.loadIndex()
+
+        # put() can be called from several threads, e.g. by a pipeline
+        self._lock = threading.Lock()
+
+    # =====================================
+
+    # Archive storage
+
+    def loadIndex(self):
+        ''' read index.jsonl, later lines win if a URL appears more than once '''
+
+        self.index = {}
+        if not os.path.exists(self.indexFile):
+            return
+
+        with open(self.indexFile) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.index[entry['url']] = entry['sha256']
+                except (ValueError, KeyError):
+                    # a partly written line from an interrupted run
+                    continue
+
+    def objectPath(self, digest):
+        ''' path of the compressed file for a given hash '''
+
+        return os.path.join(self.folder, 'objects', digest[:2], digest + '.json.gz')
+
+    def fullUrl(self, url):
+        ''' prefix an evidence record id with the evidence URL if necessary '''
+
+        if url.startswith('http'):
+            return url
+        return self.urlPrefix + url
+
+    def has(self, url):
+        ''' is the evidence record in the archive? '''
+
+        return self.fullUrl(url) in self.index
+
+    def put(self, url, content):
+        '''
+        Add the raw bytes of an evidence record to the archive.
+
+        Returns
+        -------
+        str:
+            sha256 hash of the content
+
+        '''
+
+        url = self.fullUrl(url)
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.objectPath(digest)
+
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write to a temporary file first so a crash can't leave half a
+                # record. Other processes may be writing the same record, so the
+                # name has this process's id; self._lock covers its threads.
+                tmp = path + '.' + str(os.getpid()) + '.tmp'
+                with gzip.open(tmp, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp, path)
+
+            if self.index.get(url) != digest:
+                with open(self.indexFile, 'a') as f:
+                    f.write(json.dumps({'url': url, 'sha256': digest,
+                                        'size': len(content)}) + '\n')
+                self.index[url] = digest
+
+        return digest
+
+    def getBytes(self, url):
+        ''' raw bytes of an archived record, or None if it isn't archived '''
+
+        digest = self.index.get(self.fullUrl(url))
+        if digest is None:
+            return None
+
+        with gzip.open(self.objectPath(digest), 'rb') as f:
+            return f.read()
+
+    def get(self, url):
+        ''' an archived record as a dictionary, or None if it isn't archived '''
+
+        content = self.getBytes(url)
+        if content is None:
+            return None
+
+        return json.loads(content)
+
+    def getRecord(self, url):
+        ''' an archived record as an evidenceRecords object, or None if it isn't archived '''
+
+        # imported here to avoid a circular import with evidenceRecords
+        try:
+            from mrced2.evidenceRecords import evidenceRecords
+        except:
+            from evidenceRecords import evidenceRecords
+
+        jsonData = self.get(url)
+        if jsonData is None:
+            return None
+
+        er = evidenceRecords()
+        er.query = self.fullUrl(url)
+        er.jsonData = jsonData
+        er.success = True
+
+        return er
+
+    # =====================================
+
+    # Bulk fetching
+
+    def evidenceUrls(self, source):
+        '''
+        Get a deduplicated list of evidence record URLs.
+
+        Parameters
+        ----------
+        source : eventRecord or list of str
+            events whose evidence_record fields are used, or a list of evidence
+            record ids or URLs
+
+        Returns
+        -------
+        list of str:
+            full URLs, in the order they were first seen
+
+        '''
+
+        if hasattr(source, 'jsonData'):
+            try:
+                events = source.jsonData['message']['events']
+            except (KeyError, TypeError):
+                events = []
+            urls = (ev['evidence_record'] for ev in events if 'evidence_record' in ev)
+        else:
+            urls = source
+
+        return list(dict.fromkeys(self.fullUrl(u) for u in urls))
+
+    def fetchAll(self, source, workers=8, retry=3, refresh=False, seen=None, backoff=2.0,
+                 maxWait=300):
+        '''
+        Fetch evidence records concurrently and add them to the archive.
+        Records that are already archived aren't fetched again unless refresh
+        is True, nor are records in seen, e.g. fetched by another worker.
+
+        Parameters
+        ----------
+        source : eventRecord or list of str
+            see evidenceUrls()
+        workers : int
+            maximum number of requests in flight at once
+        retry : int
+            number of attempts per record
+        refresh : boolean
+            fetch records even if they are already archived or seen
+        seen : seenSet, optional
+            URLs of records handled by earlier runs or other workers. They
+            are skipped, and the records fetched or archived are added.
+        backoff : float
+            seconds to wait after a rate limited (429 or 503) response
+            without a Retry-After, doubling with each attempt
+        maxWait : float
+            most seconds to wait before trying a record again
+
+        Returns
+        -------
+        dict:
+            counts of records requested, already archived, already seen,
+            fetched and failed, and a list of the URLs that failed
+
+        '''
+
+        urls = self.evidenceUrls(source)
+        todo = urls if refresh else [u for u in urls if u not in self.index]
+        archived = len(urls) - len(todo)
+        if seen is not None and not(refresh):
+            seen.addMany([u for u in urls if u in self.index], 'evidence')
+            todo = seen.filterNew(todo, 'evidence')
+
+        summary = {'requested': len(urls), 'archived': archived,
+                   'seen': len(urls) - archived - len(todo),
+                   'fetched': 0, 'failed': 0, 'failedUrls': []}
+
+        if not(self.quiet):
+            metrics.say(str(len(todo)) + ' of ' + str(len(urls)) +
+                        ' evidence records to fetch')
+
+        if len(todo) == 0:
+            return summary
+
+        # one connection pool shared by all the workers
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        def fetch(url):
+            for ii in range(retry):
+                try:
+                    r = metrics.get(url, session=session, retries=ii, timeout=60)
+                except requests.RequestException:
+                    continue
+                if r.status_code in (200, 201):
+                    return r.content
+                if r.status_code in (429, 503) and ii < retry - 1:
+                    wait = retryAfter(r.headers.get('Retry-After'), backoff * 2 ** ii)
+                    time.sleep(min(wait, maxWait))
+            return None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch, url): url for url in todo}
+            for future in as_completed(futures):
+                url = futures[future]
+                content = future.result()
+                if content is None:
+                    summary['failed'] += 1
+                    summary['failedUrls'].append(url)
+                    continue
+
+                self.put(url, content)
+                summary['fetched'] += 1
+                if seen is not None:
+                    seen.add(url, 'evidence')
+
+                if not(self.quiet) and summary['fetched'] % 100 == 0:
+                    metrics.say(str(summary['fetched']) + ' evidence records fetched')
+
+        session.close()
+
+        if not(self.quiet):
+            metrics.say('fetched ' + str(summary['fetched']) + ', failed ' +
+                        str(summary['failed']))
+
+        return summary
+
+    def records(self, source=None):
+        '''
+        Iterate archived records as evidenceRecords objects.
+
+        Parameters
+        ----------
+        source : eventRecord or list of str, optional
+            restrict to these records (see evidenceUrls()), otherwise everything
+            in the archive is returned. Records that aren't archived are skipped.
+
+        '''
+
+        urls = self.index if source is None else self.evidenceUrls(source)
+        for url in list(urls):
+            er = self.getRecord(url)
+            if er is not None:
+                yield er
@@ -6,20 +6,38 @@ Created on Wed Mar 17 14:53:14 2021
 @author: martynrittman
 """
 
-import requests
 import json
-from urllib.parse import urlparse
+try:
+    from mrced2.domainAnalytics import countRecordDomains, countRecordTwitterDomains
+    from mrced2.patternMatcher import patternMatcher
+    from mrced2.instrument import metrics, actionCount
+    from mrced2.rawJson import lazyJsonData, rawJson, writeBytes, writeResponse
+except:
+    from domainAnalytics import countRecordDomains, countRecordTwitterDomains
+    from patternMatcher import patternMatcher
+    from instrument import metrics, actionCount
+    from rawJson import lazyJsonData, rawJson, writeBytes, writeResponse
 
 
 class evidenceRecords:
     ''' Query and perform operations on activity logs from Crossref Event Data '''
 
-    def __init__(self):
+    # can hold a rawJson, parsed when it is first used
+    jsonData = lazyJsonData()
+
+    def __init__(self, baseUrl='https://evidence.eventdata.crossref.org'):
+        '''
+        Parameters
+        ----------
+        baseUrl : str
+            location of the evidence service, can be changed e.g. to use a mockServer
+
+        '''
 
         self.outputFile = 'test.json'
 
         self.jsonData = []
-        self.urlPrefix = 'https://evidence.eventdata.crossref.org/evidence/'
+        self.urlPrefix = baseUrl.rstrip('/') + '/evidence/'
         self.query = ''
 
     # =====================================
@@ -44,18 +62,14 @@ class evidenceRecords:
         '''
 
         # prefix with the correct url if necessary
-        try:
-            x = url[:49] == self.urlPrefix
-        except IndexError:
-            x = False
-        if not(x):
+        if not(url.startswith(self.urlPrefix)):
             url = self.urlPrefix + url
 
         self.query = url
 
-        print(self.query)
+        metrics.say(self.query)
 
-    def runQuery(self, quiet=False):
+    def runQuery(self, quiet=False, saveToFile=True, archive=None, raw=False, compress=False):
         '''
         Runs the query generated by buildQuery. self.success is True if the query
         runs successfully.
@@ -67,6 +81,14 @@ class evidenceRecords:
         saveToFile : boolean
             Saves the json contents of the activity log to self.outputFile if 
             set to True. The default is True.
+        archive : evidenceArchive
+            If given, the record is read from the archive when it's there, and
+            added to the archive when it's fetched.
+        raw : boolean
+            Write the response to self.outputFile as it arrives, without parsing
+            and re-encoding it. self.jsonData is parsed when it is first used.
+        compress : boolean
+            With raw, write a gzip file (self.outputFile + '.gz').
 
         Returns
         -------
@@ -74,28 +96,61 @@ class evidenceRecords:
 
         '''
 
-        r = requests.get(self.query)
+        # read from the local archive if we already have the record
+        if archive is not None and archive.has(self.query):
+            self.success = True
+            if raw:
+                self.jsonData = rawJson(content=archive.getBytes(self.query))
+            else:
+                self.jsonData = archive.get(self.query)
+            if not(quiet):
+                metrics.say("evidence record read from archive")
+            return
+
+        # the archive needs the bytes in memory anyway, otherwise they're streamed to the file
+        stream = raw and saveToFile and archive is None
+        r = metrics.get(self.query, stream=stream)
+
+        if raw and r.status_code in (200, 201):
+            self.success = True
+            if stream:
+                filename, head = writeResponse(r, self.outputFile, compress)
+                self.jsonData = rawJson(filename=filename)
+            else:
+                if archive is not None:
+                    archive.put(self.query, r.content)
+                if saveToFile:
+                    filename = writeBytes(r.content, self.outputFile, compress)
+                self.jsonData = rawJson(content=r.content)
+
+            if saveToFile and not(quiet):
+                metrics.say("output file written to " + filename)
 
         # stop if there wasn't a response
-        if r.status_code in (200, 201):
+        elif r.status_code in (200, 201):
             self.success = True
             # find and save the next cursor (add to next call to iterate results pages)
             self.jsonData = r.json()
 
+            if archive is not None:
+                archive.put(self.query, r.content)
+
             if saveToFile:
                 with open(self.outputFile, 'w') as f:
                     # save the json result to file
                     json.dump(self.jsonData, f)
                     if not(quiet):
-                        print("output file written to " + self.outputFile)
+                        metrics.say("output file written to " + self.outputFile)
 
         else:
             self.success = False
+            r.close()
 
     # =====================================
 
     # Analysis functions
 
+    @metrics.timed(size=actionCount)
     def filterBySubject(self, subjFilter):
         '''
 
@@ -106,7 +161,8 @@ class evidenceRecords:
         Parameters
         ----------
         subjFilter: dict
-            fields and values to filter for in subject
+            fields and values to filter for in subject. A value can also be a
+            list of substrings (e.g. a list of domains), any of which matches.
 
         Returns
         -------
@@ -115,6 +171,14 @@ class evidenceRecords:
 
         '''
 
+        # compile the substrings for each field once
+        matchers = {}
+        for field in subjFilter:
+            values = subjFilter[field]
+            if isinstance(values, str):
+                values = [values]
+            matchers[field] = patternMatcher(values)
+
         # do the filtering
 
         filteredPages = []
@@ -125,10 +189,10 @@ class evidenceRecords:
             # run through actions
             for action in page['actions']:
 
-                for field in subjFilter:
+                for field in matchers:
                     try:
                         # search using substrings
-                        if subjFilter[field] in action['subj'][field]:
+                        if matchers[field].any(action['subj'][field]):
                             filteredActions.append(action)
 
                             # searching is OR-type: it's a match if we find anything
@@ -142,6 +206,7 @@ class evidenceRecords:
 
         # create an activitylogs object
         filteredLog = evidenceRecords()
+        filteredLog.urlPrefix = self.urlPrefix
         filteredLog.success = 1
 
         # add the full json record
@@ -150,10 +215,13 @@ class evidenceRecords:
 
         return filteredLog
 
+    @metrics.timed(size=actionCount)
     def countDomains(self):
         '''
         Get the number of domains used in observations, along with counts of 
         observations and events. Don't use this for Twitter, see countTwitterDomains.
+        This counts one record in this process; for many records counted in
+        parallel, see domainAnalytics.run with record files or an evidenceArchive.
 
         Returns
         -------
@@ -163,39 +231,9 @@ class evidenceRecords:
 
         '''
 
-        domains = {}
-
-        # get to the list of actions
-        for page in self.jsonData['pages']:
-            for action in page['actions']:
-
-                # get the candidate url from the action
-                try:
-                    url = action['subj']['url']
-                except KeyError:
-                    continue
-
-                # pull the domain from the url
-                urlp = urlparse(url)
-                domain = urlp.netloc
-
-                # add the domain to the output if needed
-                if not (domain in domains):
-                    domains[domain] = {'observations': 0, 'events': 0}
-
-                # record observations and events
-                domains[domain]['observations'] += len(
-                    action['processed-observations'])
-                domains[domain]['events'] += len(action['events'])
-
-        # add success rates
-
-        for domain in domains:
-            domains[domain]['event-ratio'] = domains[domain]['events'] / \
-                float(domains[domain]['observations'])
-
-        return domains
+        return countRecordDomains(self.jsonData).toDict()
 
+    @metrics.timed(size=actionCount)
     def countTwitterDomains(self):
         '''
         Get the number of domains used in observations, along with counts of observations and events
@@ -215,65 +253,7 @@ class evidenceRecords:
 
         '''
 
-        domains = {}
-
-        try:
-            if not(self.jsonData['agent']['name'] == 'twitter-agent'):
-                return domains
-        except:
-            # something went wrong
-            "couldn't locate agent name"
-            return domains
-
-        # get to the lists of candidates and events
-        for page in self.jsonData['pages']:
-            for action in page['actions']:
-                for obs in action['processed-observations']:
-                    try:
-                        for candidate in obs['candidates']:
-                            try:
-                                url = candidate['value']
-                            except KeyError:
-                                continue
-
-                            # add candidate url to output
-                            urlp = urlparse(url)
-                            domain = urlp.netloc
-
-                            if not(domain in domains):
-                                domains[domain] = {
-                                    'observations': 0, 'events': 0}
-
-                            domains[domain]['observations'] += 1
-                    except:
-                        pass
-
-                for event in action['events']:
-
-                    try:
-                        url = event['obj']['url']
-                    except KeyError:
-                        continue
-
-                    # add candidate url to output
-                    urlp = urlparse(url)
-                    domain = urlp.netloc
-
-                    if not(domain in domains):
-                        domains[domain] = {'observations': 0, 'events': 0}
-
-                    domains[domain]['events'] += 1
-
-        # add success rates
-        for domain in domains:
-            try:
-                domains[domain]['event-ratio'] = domains[domain]['events'] / \
-                    float(domains[domain]['observations'])
-            except:
-                # catch division by zero case
-                domains[domain]['event-ratio'] = 0
-
-        return domains
+        return countRecordTwitterDomains(self.jsonData).toDict()
 
 
 if __name__ == '__main__':
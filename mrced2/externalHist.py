@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Counts of event values that can grow larger than memory, spilled to disk.
+
+@author: martynrittman
+"""
+
+import os
+import sys
+import json
+import heapq
+import shutil
+import zlib
+import tempfile
+
+
+# rough bytes held by one entry of a dict of counts, besides its key
+ENTRYSIZE = 100
+
+# most times a partition is split again before it is added up as it is
+MAXLEVEL = 6
+
+
+def parseSize(size):
+    ''' bytes from a number or a string such as 512MB or 2GB '''
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    s = size.strip().upper().rstrip('B')
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+
+    return int(s)
+
+
+class externalHist:
+    '''
+    Number of events with each value of a field, like eventHist() without
+    bins, for fields with more values than fit in memory (e.g. subj_id or
+    the tweet author).
+
+    Counts are kept in a dict until it takes about memoryBudget bytes. It is
+    then split by a hash of each value into `partitions` files on disk and
+    emptied. At the end, each partition is read back and added up on its
+    own, so no more than about a partition's worth of values is in memory at
+    once. A partition that is still too big is split again. The totals are
+    kept in one file, so they can be read any number of times, and more
+    events can still be added.
+
+    Events can be added from an eventRecord, from a stream (e.g. as the sink
+    of a pipeline) or in batches. add() isn't thread-safe; pipeline sinks
+    are never called at the same time.
+
+    basic usage:
+        with externalHist('subj.author.url', memoryBudget='256MB') as h:
+            h.update(events)
+            h.top(20)
+            h.writeCsv('authors.csv')
+
+    '''
+
+    def __init__(self, field, memoryBudget='256MB', partitions=64, folder=None,
+                 useObjs=False, useSubjs=False, key=None):
+        '''
+        Parameters
+        ----------
+        field : str
+            field to count the values of. Dots go into nested fields, e.g.
+            subj.author.url
+        memoryBudget : int or str
+            bytes of counts to hold in memory, e.g. 512MB
+        partitions : int
+            files the counts are split into when they are spilled
+        folder : str, optional
+            where to make the temporary folder for spilled counts
+        useObjs, useSubjs : boolean
+            as for eventHist(), also count the field in obj and subj
+        key : function, optional
+            takes an event and returns the value to count, or a list of
+            values, instead of field
+
+        '''
+
+        self.field = field
+        self.path = field.split('.')
+        self.memoryBudget = parseSize(memoryBudget)
+        self.partitions = partitions
+        self.useObjs = useObjs
+        self.useSubjs = useSubjs
+        self.key = key
+
+        self.counts = {}
+        self.used = 0
+        self.events = 0
+        self.spills = 0
+
+        self.folder = tempfile.mkdtemp(prefix='mrced2-hist-', dir=folder)
+        # the totals of the partitions once they have been read, and the
+        # number of spills they include
+        self.merged = None
+        self.mergedSpills = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        ''' delete the spilled counts '''
+
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+    # =====================================
+
+    # Counting
+
+    def values(self, ev):
+        ''' the values of the field in one event '''
+
+        if self.key is not None:
+            v = self.key(ev)
+            return v if isinstance(v, list) else [v]
+
+        dc = [ev]
+        if self.useObjs and 'obj' in ev:
+            dc.append(ev['obj'])
+        if self.useSubjs and 'subj' in ev:
+            dc.append(ev['subj'])
+
+        found = []
+        for d in dc:
+            for part in self.path:
+                if not isinstance(d, dict) or part not in d:
+                    break
+                d = d[part]
+            else:
+                found.append(d)
+
+        return found
+
+    def add(self, ev):
+        ''' count one event '''
+
+        counts = self.counts
+        for v in self.values(ev):
+            if v is None:
+                continue
+            if isinstance(v, (list, dict)):
+                v = json.dumps(v, sort_keys=True)
+            c = counts.get(v)
+            if c is None:
+                counts[v] = 1
+                self.used += sys.getsizeof(v) + ENTRYSIZE
+            else:
+                counts[v] = c + 1
+
+        self.events += 1
+        if self.used > self.memoryBudget:
+            self.spill()
+
+    def update(self, events):
+        '''
+        Count events: a list, an iterable or an eventRecord.
+
+        Returns
+        -------
+        self
+
+        '''
+
+        if hasattr(events, 'jsonData'):
+            events = events.jsonData["message"]["events"]
+        for ev in events:
+            self.add(ev)
+
+        return self
+
+    def __call__(self, ev):
+        # so it can be given as a sink, e.g. pipeline.run(hours, sink=h)
+        self.add(ev)
+
+    # =====================================
+
+    # Spilling
+
+    def _partition(self, value, level):
+        # crc32 is linear, so a salt would only shuffle the partitions of
+        # values of the same length: the crc is mixed with the level instead
+        # (the murmur3 finaliser), so that a partition split again does split
+        h = zlib.crc32(repr(value).encode()) ^ (level * 0x9E3779B9 & 0xFFFFFFFF)
+        h = (h ^ (h >> 16)) * 0x85EBCA6B & 0xFFFFFFFF
+        h = (h ^ (h >> 13)) * 0xC2B2AE35 & 0xFFFFFFFF
+
+        return (h ^ (h >> 16)) % self.partitions
+
+    def _partitionFile(self, prefix, p):
+        return os.path.join(self.folder, prefix + str(p).zfill(4) + '.jsonl')
+
+    def _write(self, counts, prefix, level):
+        ''' append counts to the partition files under prefix '''
+
+        parts = {}
+        for v, c in counts.items():
+            parts.setdefault(self._partition(v, level), []).append(json.dumps([v, c]) + '\n')
+
+        for p, lines in parts.items():
+            with open(self._partitionFile(prefix, p), 'a') as f:
+                f.writelines(lines)
+
+    def spill(self):
+        ''' write the counts held in memory to the partition files and empty them '''
+
+        if self.counts:
+            self._write(self.counts, 'p', 0)
+            self.spills += 1
+        self.counts = {}
+        self.used = 0
+
+    # =====================================
+
+    # Results
+
+    def _merge(self, filename, level):
+        ''' (value, count) from one partition file, split again if it is too big '''
+
+        counts = {}
+        used = 0
+        prefix = None
+        with open(filename) as f:
+            for line in f:
+                v, c = json.loads(line)
+                old = counts.get(v)
+                if old is None:
+                    counts[v] = c
+                    used += sys.getsizeof(v) + ENTRYSIZE
+                else:
+                    counts[v] = old + c
+                if used > self.memoryBudget and level < MAXLEVEL:
+                    # split this partition with a different hash
+                    prefix = os.path.basename(filename)[:-6] + '-'
+                    self._write(counts, prefix, level + 1)
+                    counts = {}
+                    used = 0
+        os.remove(filename)
+
+        if prefix is None:
+            yield from counts.items()
+            return
+
+        self._write(counts, prefix, level + 1)
+        for p in range(self.partitions):
+            sub = self._partitionFile(prefix, p)
+            if os.path.exists(sub):
+                yield from self._merge(sub, level + 1)
+
+    def _mergeAll(self):
+        '''
+        Add up the partitions into one file of totals, self.merged. Totals
+        from an earlier merge are split into the partitions again first, if
+        counts have been spilled since.
+
+        '''
+
+        if self.merged is not None:
+            with open(self.merged) as f:
+                counts = {}
+                used = 0
+                for line in f:
+                    v, c = json.loads(line)
+                    counts[v] = c
+                    used += sys.getsizeof(v) + ENTRYSIZE
+                    if used > self.memoryBudget:
+                        self._write(counts, 'p', 0)
+                        counts = {}
+                        used = 0
+                self._write(counts, 'p', 0)
+            os.remove(self.merged)
+
+        merged = os.path.join(self.folder, 'merged.jsonl')
+        with open(merged + '.tmp', 'w') as f:
+            for p in range(self.partitions):
+                filename = self._partitionFile('p', p)
+                if os.path.exists(filename):
+                    f.writelines(json.dumps([v, c]) + '\n' for v, c in self._merge(filename, 0))
+        os.replace(merged + '.tmp', merged)
+
+        self.merged = merged
+        self.mergedSpills = self.spills
+
+    def items(self):
+        '''
+        All the (value, count) pairs, in no particular order. With spilled
+        counts, the partitions are added up on the first read (or the first
+        after more counts were spilled) and the totals read from disk.
+
+        '''
+
+        if self.spills == 0:
+            yield from self.counts.items()
+            return
+
+        self.spill()
+        if self.merged is None or self.mergedSpills != self.spills:
+            self._mergeAll()
+
+        with open(self.merged) as f:
+            for line in f:
+                v, c = json.loads(line)
+                yield v, c
+
+    def top(self, n=10):
+        ''' the n values with the most events, as (value, count) '''
+
+        return heapq.nlargest(n, self.items(), key=lambda kv: kv[1])
+
+    def toDict(self):
+        ''' all the counts as a dict, if they fit in memory '''
+
+        return dict(self.items())
+
+    def toDataFrame(self):
+        ''' pandas DataFrame with a row per value, if they fit in memory '''
+
+        import pandas as pd
+
+        return pd.DataFrame(self.items(), columns=[self.field, 'count'])
+
+    def writeCsv(self, filename, minCount=1):
+        '''
+        Write value,count lines to a csv file without holding them all.
+
+        Returns
+        -------
+        int:
+            number of values written
+
+        '''
+
+        import csv
+
+        n = 0
+        with open(filename + '.tmp', 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow([self.field, 'count'])
+            for v, c in self.items():
+                if c >= minCount:
+                    w.writerow([v, c])
+                    n += 1
+        os.replace(filename + '.tmp', filename)
+
+        return n
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Harvests of many DOI prefixes at once, shared fairly between prefixes and
+kept within a concurrency budget for each API host.
+
+basic usage:
+
+    hs = harvestScheduler(folder='.mrced2-cache/scheduler', mailto='me@example.org')
+    hs.addPrefixes(['10.21105', '10.1101', '10.7554'], kinds=('works', 'eventCounts'))
+    hs.addJob('events', '10.21105', priority=1, filters={'source': 'wikipedia'})
+    hs.run()
+    for work in hs.iterItems('works:10.21105'):
+        ...
+
+@author: martynrittman
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from mrced2.instrument import metrics, hostRateLimiter, retryAfter
+    from mrced2.rawJson import rawJson, writeBytes
+except:
+    from instrument import metrics, hostRateLimiter, retryAfter
+    from rawJson import rawJson, writeBytes
+
+
+# job kinds -> the API they use
+KINDS = {
+    'works': 'apiUrl',  # works of the prefix from the REST API
+    'eventCounts': 'eventDataUrl',  # number of events per source
+    'events': 'eventDataUrl',  # all the events of the prefix
+}
+
+# fields of the works pages
+WORKFIELDS = 'DOI,type,published,is-referenced-by-count,title'
+
+
+class harvestScheduler:
+    '''
+    Runs harvest jobs for many prefixes, one page at a time.
+
+    Each job is a series of requests: the pages of a works or events harvest,
+    or the event counts of each source. The scheduler keeps up to
+    self.hostLimits[host] requests in flight to each API host. When a slot is
+    free it goes to the job with the highest priority and, among those, the
+    one that has waited longest for its last page, so a prefix with a million
+    works gets no more of the budget than one with ten.
+
+    Job state is saved to folder/state.json and pages to folder/jobs/, so a
+    run that is stopped carries on from where it was. Jobs that are added
+    again keep their state.
+
+    A job's status is pending, done or failed. Failed requests are retried
+    after a back off, up to `retry` attempts, while other jobs carry on.
+    Cursors expire after a few minutes, so a job whose cursor is refused
+    (e.g. when a saved harvest is resumed later) starts again from its first
+    page.
+
+    '''
+
+    def __init__(self, folder='.mrced2-cache/scheduler', mailto='Anonymous',
+                 apiUrl='https://api.crossref.org',
+                 eventDataUrl='https://api.eventdata.crossref.org',
+                 hostLimits=None, defaultHostLimit=4, rates=None, workers=None,
+                 rows=1000, retry=3, backoff=2.0, compress=False, quiet=False):
+        '''
+        Parameters
+        ----------
+        folder : str
+            where the state and pages are kept
+        mailto : str
+            email address sent with API queries
+        apiUrl, eventDataUrl : str
+            locations of the REST API and Event Data, e.g. a mockServer
+        hostLimits : dict, optional
+            host -> most requests in flight at once
+        defaultHostLimit : int
+            limit for hosts not in hostLimits
+        rates : dict, optional
+            host -> most requests started per second. Applied through
+            metrics.limiter while run() is going.
+        workers : int, optional
+            threads; defaults to the sum of the host limits
+        rows : int
+            items per page
+        retry : int
+            attempts per request
+        backoff : float
+            seconds before a failed request is tried again, doubled each time
+        compress : boolean
+            gzip the pages
+        quiet : boolean
+            if true, nothing is printed to screen.
+
+        '''
+
+        self.folder = folder
+        self.mailto = mailto
+        self.apiUrl = apiUrl.rstrip('/')
+        self.eventDataUrl = eventDataUrl.rstrip('/')
+        self.hostLimits = dict(hostLimits or {})
+        self.defaultHostLimit = defaultHostLimit
+        self.rates = rates
+        self.rows = rows
+        self.retry = retry
+        self.backoff = backoff
+        self.compress = compress
+        self.quiet = quiet
+
+        self.workers = workers or sum(self.hostLimit(h) for h in
+                                      {self.host(self.apiUrl), self.host(self.eventDataUrl)})
+
+        self.stateFile = os.path.join(folder, 'state.json')
+        self.jobs = {}
+        # number of pages dispatched, the round robin clock
+        self.clock = 0
+
+        os.makedirs(os.path.join(folder, 'jobs'), exist_ok=True)
+        if os.path.exists(self.stateFile):
+            self.load()
+
+        self._local = threading.local()
+
+    # =====================================
+
+    # Jobs
+
+    def host(self, url):
+        return urlparse(url).netloc
+
+    def hostLimit(self, host):
+        return self.hostLimits.get(host, self.defaultHostLimit)
+
+    def addJob(self, kind, prefix, priority=0, filters=None, sources=None):
+        '''
+        Add a job, unless it is already there.
+
+        Parameters
+        ----------
+        kind : str
+            works, eventCounts or events
+        prefix : str
+            DOI prefix, e.g. 10.21105
+        priority : int
+            jobs with a higher priority are served first
+        filters : dict, optional
+            other Event Data filters, for events and eventCounts jobs
+        sources : list of str, optional
+            for eventCounts, the sources to count. All sources are counted
+            with one facet query if not given.
+
+        Returns
+        -------
+        str:
+            the job id, e.g. works:10.21105
+
+        '''
+
+        if kind not in KINDS:
+            raise ValueError('kind should be one of ' + ', '.join(KINDS))
+
+        jobId = kind + ':' + prefix
+        if filters or sources:
+            jobId += ':' + hashlib.sha1(json.dumps([filters, sources], sort_keys=True)
+                                        .encode()).hexdigest()[:8]
+
+        job = self.jobs.get(jobId)
+        if job is None:
+            job = self.jobs[jobId] = {
+                'id': jobId, 'kind': kind, 'prefix': prefix, 'filters': filters or {},
+                'sources': sources, 'status': 'pending', 'cursor': None, 'pages': 0,
+                'items': 0, 'result': None, 'attempts': 0, 'error': None,
+                'notBefore': 0.0, 'lastServed': 0, 'added': len(self.jobs), 'restarts': 0}
+        # the priority can be changed by adding the job again
+        job['priority'] = priority
+
+        return jobId
+
+    def addPrefixes(self, prefixes, kinds=('works', 'eventCounts'), priority=0, **kwargs):
+        ''' add jobs of each kind for a list of prefixes, returns the job ids '''
+
+        return [self.addJob(kind, p, priority, **kwargs) for p in prefixes for kind in kinds]
+
+    def reset(self, jobId):
+        ''' start a job again from the first page, e.g. for a new day's works '''
+
+        job = self.jobs[jobId]
+        job.update(status='pending', cursor=None, pages=0, items=0, result=None,
+                   attempts=0, error=None, notBefore=0.0)
+
+    def retryFailed(self):
+        '''
+        Make failed jobs pending again, from where they stopped. Jobs that
+        failed with a client error start from the first page, as their
+        cursor can't be used again.
+
+        '''
+
+        for job in self.jobs.values():
+            if job['status'] == 'failed':
+                if job['cursor'] and str(job['error']).startswith('HTTP 4'):
+                    self.reset(job['id'])
+                job.update(status='pending', attempts=0, error=None, notBefore=0.0)
+
+    def status(self):
+        ''' status -> number of jobs '''
+
+        counts = {'pending': 0, 'done': 0, 'failed': 0}
+        for job in self.jobs.values():
+            counts[job['status']] += 1
+
+        return counts
+
+    # =====================================
+
+    # Running
+
+    def _session(self):
+        # one requests session per thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+
+        return session
+
+    def _jobUrl(self, job):
+        return getattr(self, KINDS[job['kind']])
+
+    def _next(self, inFlight, busy, now):
+        ''' the job that should get the next free slot, or None '''
+
+        best = None
+        for job in self.jobs.values():
+            if job['status'] != 'pending' or job['id'] in inFlight or job['notBefore'] > now:
+                continue
+            host = self.host(self._jobUrl(job))
+            if busy.get(host, 0) >= self.hostLimit(host):
+                continue
+            rank = (-job['priority'], job['lastServed'], job['added'])
+            if best is None or rank < best[0]:
+                best = (rank, job)
+
+        return None if best is None else best[1]
+
+    def run(self, maxSeconds=None, onStep=None, saveInterval=1.0):
+        '''
+        Run the pending jobs until they are all done or failed.
+
+        Parameters
+        ----------
+        maxSeconds : float, optional
+            stop dispatching requests after this long; the state is saved
+        onStep : function, optional
+            called with each job after each of its requests
+        saveInterval : float
+            most seconds between saves of the state
+
+        Returns
+        -------
+        dict:
+            status -> number of jobs
+
+        '''
+
+        limiter = metrics.limiter
+        if self.rates:
+            metrics.limiter = hostRateLimiter(self.rates)
+
+        started = time.monotonic()
+        saved = started
+        inFlight = {}  # job id -> future
+        busy = {}  # host -> requests in flight
+
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                while True:
+                    now = time.monotonic()
+                    stopping = maxSeconds is not None and now - started > maxSeconds
+
+                    while not(stopping) and len(inFlight) < self.workers:
+                        job = self._next(inFlight, busy, time.time())
+                        if job is None:
+                            break
+                        self.clock += 1
+                        job['lastServed'] = self.clock
+                        host = self.host(self._jobUrl(job))
+                        busy[host] = busy.get(host, 0) + 1
+                        inFlight[job['id']] = pool.submit(self._step, dict(job))
+
+                    if not(inFlight):
+                        waiting = [j['notBefore'] for j in self.jobs.values()
+                                   if j['status'] == 'pending']
+                        if stopping or not(waiting):
+                            break
+                        # only jobs backing off are left; wait for the first,
+                        # but not past the time allowed
+                        seconds = min(waiting) - time.time()
+                        if maxSeconds is not None:
+                            remaining = maxSeconds - (time.monotonic() - started)
+                            if remaining <= 0:
+                                break
+                            seconds = min(seconds, remaining)
+                        time.sleep(max(0.0, seconds))
+                        continue
+
+                    done, _ = wait(list(inFlight.values()), timeout=1.0,
+                                   return_when=FIRST_COMPLETED)
+                    for jobId in [j for j, f in inFlight.items() if f in done]:
+                        job = self.jobs[jobId]
+                        self._apply(job, inFlight.pop(jobId).result())
+                        host = self.host(self._jobUrl(job))
+                        busy[host] -= 1
+                        if onStep is not None:
+                            onStep(job)
+
+                    if time.monotonic() - saved > saveInterval:
+                        self.save()
+                        saved = time.monotonic()
+        finally:
+            metrics.limiter = limiter
+            self.save()
+
+        counts = self.status()
+        if not(self.quiet):
+            metrics.say('harvest jobs: ' + ', '.join(str(v) + ' ' + k for k, v in counts.items()))
+
+        return counts
+
+    def _apply(self, job, update):
+        ''' fold the result of a request into its job (in the scheduling thread) '''
+
+        if update.get('restart') and job.get('restarts', 0) < self.retry:
+            # the cursor has expired: the pages so far are fetched again
+            restarts = job.get('restarts', 0) + 1
+            self.reset(job['id'])
+            job['restarts'] = restarts
+            if not(self.quiet):
+                metrics.say(job['id'] + ': cursor refused, starting again from the first page')
+            return
+
+        if 'error' in update:
+            job['attempts'] += 1
+            job['error'] = update['error']
+            if update.get('fatal') or job['attempts'] >= self.retry:
+                job['status'] = 'failed'
+                if not(self.quiet):
+                    metrics.say(job['id'] + ' failed: ' + str(update['error']))
+            else:
+                seconds = update.get('retryAfter') or self.backoff * 2 ** (job['attempts'] - 1)
+                job['notBefore'] = time.time() + seconds
+            return
+
+        job.update(update)
+        job['attempts'] = 0
+        job['error'] = None
+
+    def _step(self, job):
+        '''
+        Make the next request of a job, in a worker thread. The job is a copy;
+        what changed is returned, or {'error': ...} if the request failed.
+        Nothing is raised, so one job can't stop the others.
+
+        '''
+
+        try:
+            return self._request(job)
+        except Exception as e:
+            return {'error': repr(e)}
+
+    def _request(self, job):
+        ''' the work of _step() '''
+
+        import requests
+
+        kind = job['kind']
+        if kind == 'works':
+            url = self.apiUrl + '/prefixes/' + job['prefix'] + '/works'
+            params = {'rows': self.rows, 'cursor': job['cursor'] or '*',
+                      'mailto': self.mailto, 'select': WORKFIELDS}
+        else:
+            url = self.eventDataUrl + '/v1/events'
+            params = dict(job['filters'], **{'obj-id.prefix': job['prefix'],
+                                             'mailto': self.mailto})
+            if kind == 'events':
+                params['rows'] = self.rows
+                if job['cursor']:
+                    params['cursor'] = job['cursor']
+            else:
+                params['rows'] = 0
+                source = self._nextSource(job)
+                if source is None:
+                    params['facet'] = 'source:*'
+                else:
+                    params['source'] = source
+
+        try:
+            r = metrics.get(url, session=self._session(), params=params,
+                            retries=job['attempts'], timeout=120)
+        except requests.RequestException as e:
+            return {'error': repr(e)}
+
+        if r.status_code != 200:
+            return {'error': 'HTTP ' + str(r.status_code),
+                    'retryAfter': retryAfter(r.headers.get('Retry-After')),
+                    # anything but rate limits and server errors won't go away
+                    'fatal': r.status_code < 500 and r.status_code != 429,
+                    # except an expired cursor, which needs a new one
+                    'restart': r.status_code == 400 and bool(job['cursor'])}
+
+        try:
+            message = rawJson(content=r.content).parse()['message']
+        except (ValueError, KeyError, TypeError) as e:
+            return {'error': 'bad response: ' + repr(e)}
+
+        if kind == 'eventCounts':
+            result = dict(job['result'] or {})
+            if 'facet' in params:
+                result.update(message['facets']['source']['values'])
+                return {'result': result, 'status': 'done'}
+            result[params['source']] = message['total-results']
+            job['result'] = result
+            return {'result': result,
+                    'status': 'done' if self._nextSource(job) is None else 'pending'}
+
+        items = message.get('items' if kind == 'works' else 'events') or []
+        cursor = message.get('next-cursor')
+        update = {'cursor': cursor}
+        if items:
+            writeBytes(r.content, self.pageFile(job['id'], job['pages']), compress=self.compress)
+            update['pages'] = job['pages'] + 1
+            update['items'] = job['items'] + len(items)
+        if not(items) or cursor in (None, '', '-1'):
+            update['status'] = 'done'
+
+        return update
+
+    def _nextSource(self, job):
+        ''' the next source an eventCounts job has to count, None if there isn't one '''
+
+        if not(job['sources']):
+            return None
+        for source in job['sources']:
+            if source not in (job['result'] or {}):
+                return source
+
+        return None
+
+    # =====================================
+
+    # Results
+
+    def jobFolder(self, jobId):
+        return os.path.join(self.folder, 'jobs', jobId.replace(':', '_').replace('/', '_'))
+
+    def pageFile(self, jobId, page):
+        folder = self.jobFolder(jobId)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, 'page' + str(page).zfill(5) + '.json')
+
+    def pages(self, jobId):
+        ''' the page files of a works or events job '''
+
+        job = self.jobs[jobId]
+        suffix = '.gz' if self.compress else ''
+
+        return [self.pageFile(jobId, p) + suffix for p in range(job['pages'])]
+
+    def iterItems(self, jobId):
+        ''' the works or events of a job, one at a time, read from its pages '''
+
+        key = 'items' if self.jobs[jobId]['kind'] == 'works' else 'events'
+        for page in self.pages(jobId):
+            yield from rawJson(filename=page).parse()['message'][key]
+
+    def counts(self, jobId):
+        ''' source -> number of events, for an eventCounts job '''
+
+        return dict(self.jobs[jobId]['result'] or {})
+
+    # =====================================
+
+    # State
+
+    def save(self):
+        ''' write the job state to folder/state.json '''
+
+        with open(self.stateFile + '.tmp', 'w') as f:
+            json.dump({'clock': self.clock, 'jobs': list(self.jobs.values())}, f)
+        os.replace(self.stateFile + '.tmp', self.stateFile)
+
+    def load(self):
+        ''' read the job state saved by save() '''
+
+        with open(self.stateFile) as f:
+            state = json.load(f)
+
+        self.clock = state['clock']
+        self.jobs = {job['id']: job for job in state['jobs']}
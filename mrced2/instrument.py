@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation: timings of HTTP calls and analysis methods, sent to
+pluggable sinks, and a switch for the package's printed progress messages.
+
+basic usage:
+
+    from mrced2 import metrics, jsonLogSink, prometheusSink
+    metrics.addSink(jsonLogSink('harvest-metrics.jsonl'))
+    metrics.addSink(prometheusSink('/var/lib/node_exporter/mrced2.prom'))
+    metrics.quiet = True   # no printed progress messages
+
+@author: martynrittman
+"""
+
+import os
+import time
+import json
+import atexit
+import threading
+import functools
+from urllib.parse import urlparse
+
+
+class callbackSink:
+    ''' passes each measurement (a dict) to a function '''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, record):
+        self.callback(record)
+
+    def flush(self):
+        pass
+
+
+class jsonLogSink:
+    ''' appends each measurement to a file as one line of json '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+    def flush(self):
+        pass
+
+
+class prometheusSink:
+    '''
+    Keeps running totals and recent latencies, and writes them as a
+    Prometheus text file (e.g. for the node exporter's textfile collector)
+    at most every `interval` seconds, and on flush().
+
+    Metrics:
+        mrced2_http_requests_total{host, status}
+        mrced2_http_bytes_total{host}
+        mrced2_http_retries_total{host}
+        mrced2_http_latency_seconds{host, quantile} (summary)
+        mrced2_method_calls_total{method}
+        mrced2_method_input_size_total{method}
+        mrced2_method_seconds{method, quantile} (summary)
+
+    Quantiles are computed over the last `window` measurements.
+
+    '''
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, filename, interval=10.0, window=1000):
+        self.filename = filename
+        self.interval = interval
+        self.window = window
+
+        self.requests = {}  # (host, status) -> count
+        self.bytes = {}  # host -> bytes
+        self.retries = {}  # host -> retries
+        self.latency = {}  # host -> [sum, count, recent values]
+        self.calls = {}  # method -> count
+        self.sizes = {}  # method -> total input size
+        self.seconds = {}  # method -> [sum, count, recent values]
+
+        self._lock = threading.Lock()
+        self._lastWrite = 0.0
+
+    def _observe(self, table, key, value):
+        s = table.get(key)
+        if s is None:
+            s = table[key] = [0.0, 0, []]
+        s[0] += value
+        s[1] += 1
+        s[2].append(value)
+        if len(s[2]) > self.window:
+            del s[2][:len(s[2]) - self.window]
+
+    def emit(self, record):
+        with self._lock:
+            if record['type'] == 'http':
+                host = record['host']
+                key = (host, str(record['status']))
+                self.requests[key] = self.requests.get(key, 0) + 1
+                self.bytes[host] = self.bytes.get(host, 0) + (record['bytes'] or 0)
+                self.retries[host] = self.retries.get(host, 0) + record['retries']
+                self._observe(self.latency, host, record['seconds'])
+            elif record['type'] == 'method':
+                method = record['method']
+                self.calls[method] = self.calls.get(method, 0) + 1
+                self.sizes[method] = self.sizes.get(method, 0) + (record['size'] or 0)
+                self._observe(self.seconds, method, record['seconds'])
+
+            due = time.time() - self._lastWrite >= self.interval
+
+        if due:
+            self.flush()
+
+    def _summary(self, lines, name, label, table):
+        lines.append('# TYPE ' + name + ' summary')
+        for key, (total, count, recent) in sorted(table.items()):
+            ordered = sorted(recent)
+            for q in self.quantiles:
+                value = ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0
+                lines.append(name + '{' + label + '="' + key + '",quantile="' + str(q) + '"} ' + repr(value))
+            lines.append(name + '_sum{' + label + '="' + key + '"} ' + repr(total))
+            lines.append(name + '_count{' + label + '="' + key + '"} ' + str(count))
+
+    def text(self):
+        ''' the metrics in the Prometheus text format '''
+
+        with self._lock:
+            lines = ['# TYPE mrced2_http_requests_total counter']
+            for (host, status), n in sorted(self.requests.items()):
+                lines.append('mrced2_http_requests_total{host="' + host + '",status="' +
+                             status + '"} ' + str(n))
+            lines.append('# TYPE mrced2_http_bytes_total counter')
+            for host, n in sorted(self.bytes.items()):
+                lines.append('mrced2_http_bytes_total{host="' + host + '"} ' + str(n))
+            lines.append('# TYPE mrced2_http_retries_total counter')
+            for host, n in sorted(self.retries.items()):
+                lines.append('mrced2_http_retries_total{host="' + host + '"} ' + str(n))
+            self._summary(lines, 'mrced2_http_latency_seconds', 'host', self.latency)
+
+            lines.append('# TYPE mrced2_method_calls_total counter')
+            for method, n in sorted(self.calls.items()):
+                lines.append('mrced2_method_calls_total{method="' + method + '"} ' + str(n))
+            lines.append('# TYPE mrced2_method_input_size_total counter')
+            for method, n in sorted(self.sizes.items()):
+                lines.append('mrced2_method_input_size_total{method="' + method + '"} ' + str(n))
+            self._summary(lines, 'mrced2_method_seconds', 'method', self.seconds)
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        ''' write the file, via a temporary file so readers never see half of it '''
+
+        text = self.text()
+        with self._lock:
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(self.filename + '.tmp', self.filename)
+            self._lastWrite = time.time()
+
+
+class rateLimiter:
+    '''
+    Spaces out requests so that no more than `perSecond` are started each
+    second, across all threads. Set it as metrics.limiter to apply it to
+    every HTTP call in the package.
+
+    '''
+
+    def __init__(self, perSecond):
+        self.interval = 1.0 / perSecond
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self, url=None):
+        ''' reserve the next slot, returns the seconds to wait for it '''
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+
+        return start - now
+
+    def wait(self, url=None):
+        ''' block until the next request may start '''
+
+        seconds = self.delay(url)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class hostRateLimiter:
+    '''
+    A rateLimiter for each API host, so that a quota on one API doesn't slow
+    down requests to another. Set it as metrics.limiter like a rateLimiter.
+
+        metrics.limiter = hostRateLimiter({'api.crossref.org': 40,
+                                           'api.eventdata.crossref.org': 10})
+
+    '''
+
+    def __init__(self, rates, default=None):
+        '''
+        Parameters
+        ----------
+        rates : dict
+            host -> most requests started per second
+        default : float, optional
+            rate for other hosts, None for no limit
+
+        '''
+
+        self.default = default
+        self.limiters = {host: rateLimiter(r) for host, r in rates.items()}
+        self._lock = threading.Lock()
+
+    def limiter(self, url):
+        ''' the rateLimiter for the host of url, None if it isn't limited '''
+
+        host = urlparse(url).netloc
+        lim = self.limiters.get(host)
+        if lim is None and self.default is not None:
+            with self._lock:
+                lim = self.limiters.setdefault(host, rateLimiter(self.default))
+
+        return lim
+
+    def delay(self, url=None):
+        lim = self.limiter(url or '')
+        return 0.0 if lim is None else lim.delay(url)
+
+    def wait(self, url=None):
+        seconds = self.delay(url)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class instrumentation:
+    '''
+    Collects measurements from across the package and passes them to sinks.
+    With no sinks, measuring costs next to nothing.
+
+    Measurements are dicts:
+        {'type': 'http', 'time', 'method', 'url', 'host', 'status',
+         'seconds', 'bytes', 'retries'}
+        {'type': 'method', 'time', 'method', 'seconds', 'size'}
+
+    self.quiet silences the progress messages printed by the package, on top
+    of each method's own quiet argument.
+
+    self.limiter, if set, is an object whose wait(url) method is called before
+    every HTTP call, e.g. a rateLimiter. Async clients await delay(url) instead.
+
+    '''
+
+    def __init__(self):
+
+        self.sinks = []
+        self.quiet = False
+        self.limiter = None
+
+    def addSink(self, sink):
+        ''' add a sink: an object with emit(record) and flush() methods, or a function '''
+
+        if callable(sink) and not hasattr(sink, 'emit'):
+            sink = callbackSink(sink)
+        self.sinks.append(sink)
+
+        return sink
+
+    def removeSink(self, sink):
+        self.sinks = [s for s in self.sinks if s is not sink and getattr(s, 'callback', None) is not sink]
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def emit(self, record):
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception as e:
+                # a broken sink shouldn't stop a harvest
+                self.say('metrics sink failed: ' + repr(e))
+
+    def say(self, *args):
+        ''' print a progress message, unless self.quiet is set '''
+
+        if not(self.quiet):
+            print(*args)
+
+    # =====================================
+
+    # HTTP
+
+    def recordHttp(self, url, status, seconds, size=None, retries=0, method='GET'):
+        ''' record one HTTP call '''
+
+        if not self.sinks:
+            return
+
+        self.emit({'type': 'http', 'time': time.time(), 'method': method, 'url': url,
+                   'host': urlparse(url).netloc, 'status': status,
+                   'seconds': round(seconds, 6), 'bytes': size, 'retries': retries})
+
+    def get(self, url, session=None, retries=0, **kwargs):
+        '''
+        requests.get (or session.get) that records the call. For streamed
+        responses (stream=True) the latency is the time to the headers and the
+        size is taken from Content-Length, if given.
+
+        Parameters
+        ----------
+        url : str
+        session : requests.Session, optional
+        retries : int
+            number of earlier attempts for the same request, recorded with the call
+        kwargs :
+            passed to requests
+
+        Returns
+        -------
+        requests.Response
+
+        '''
+
+        # imported here so that the package can be imported without requests
+        import requests
+
+        if self.limiter is not None:
+            self.limiter.wait(url)
+
+        start = time.perf_counter()
+        try:
+            r = (session or requests).get(url, **kwargs)
+        except requests.RequestException:
+            self.recordHttp(url, 'error', time.perf_counter() - start, None, retries)
+            raise
+
+        if self.sinks:
+            if kwargs.get('stream'):
+                size = r.headers.get('Content-Length')
+                size = int(size) if size is not None and size.isdigit() else None
+            else:
+                size = len(r.content)
+            self.recordHttp(r.url or url, r.status_code, time.perf_counter() - start, size, retries)
+
+        return r
+
+    # =====================================
+
+    # Analysis methods
+
+    def recordCall(self, method, seconds, size=None):
+        ''' record one call of an analysis method '''
+
+        if not self.sinks:
+            return
+
+        self.emit({'type': 'method', 'time': time.time(), 'method': method,
+                   'seconds': round(seconds, 6), 'size': size})
+
+    def timed(self, size=None, name=None):
+        '''
+        Decorator that records the wall time of a method and the size of its input.
+
+        Parameters
+        ----------
+        size : callable, optional
+            called with the same arguments as the method, returns the input size
+        name : str, optional
+            name to record, defaults to Class.method
+
+        '''
+
+        def decorator(func):
+            label = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.sinks:
+                    return func(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    n = None
+                    if size is not None:
+                        try:
+                            n = size(*args, **kwargs)
+                        except Exception:
+                            n = None
+                    self.recordCall(label, elapsed, n)
+
+            return wrapper
+
+        return decorator
+
+
+def eventCount(er, *args, **kwargs):
+    ''' input size of an eventRecord method: the number of events '''
+
+    return len(er.jsonData['message']['events'])
+
+
+def actionCount(er, *args, **kwargs):
+    ''' input size of an evidenceRecords method: the number of actions '''
+
+    return sum(len(page['actions']) for page in er.jsonData['pages'])
+
+
+def retryAfter(value, default=None):
+    '''
+    Seconds to wait from a Retry-After header: a number of seconds or an
+    HTTP date. default if it is missing or can't be read.
+
+    '''
+
+    if value is None:
+        return default
+
+    value = str(value).strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return default
+
+    if seconds != seconds or seconds == float('inf'):
+        return default
+
+    return max(0.0, seconds)
+
+
+# the instrumentation used throughout the package
+metrics = instrumentation()
+
+atexit.register(metrics.flush)
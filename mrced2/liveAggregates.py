@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Aggregates that are updated with each batch of new events, for live
+dashboards fed by eventData.tail().
+
+basic usage:
+
+    la = liveAggregates()   # sources, dois and lastHour
+    la.add('lastDay', recentActivity(window=86400, bucket=3600))
+    for events in ed.tail({'obj-id.prefix': '10.21105'}, aggregators=la):
+        publish(la.snapshot())
+
+@author: martynrittman
+"""
+
+import time
+import heapq
+import calendar
+
+
+def toEpoch(timestamp):
+    ''' seconds since 1970 for an Event Data timestamp, e.g. 2021-10-25T12:34:56Z '''
+
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+class countBy:
+    '''
+    Number of events for each value of a field, e.g. source_id or obj_id.
+
+    '''
+
+    def __init__(self, field='source_id'):
+        self.field = field
+        self.counts = {}
+        self.total = 0
+
+    def update(self, events):
+        counts = self.counts
+        for ev in events:
+            v = ev.get(self.field)
+            counts[v] = counts.get(v, 0) + 1
+        self.total += len(events)
+
+    def top(self, n=10):
+        ''' the n values with the most events, as (value, count) '''
+
+        return heapq.nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
+    def value(self):
+        return dict(self.counts)
+
+
+class recentActivity:
+    '''
+    Number of events in a sliding window, e.g. the last hour, in buckets
+    (e.g. minutes) so that old events can be dropped without keeping them.
+    Optionally split by a field such as source_id.
+
+    Events are placed by their collected timestamp, or another time field.
+    Events without a readable time are counted in self.skipped.
+    value() and series() are as of now, unless given another time.
+
+    '''
+
+    def __init__(self, window=3600, bucket=60, timeField='timestamp', by=None):
+        '''
+        Parameters
+        ----------
+        window : int
+            seconds covered
+        bucket : int
+            seconds per bucket
+        timeField : str
+            field with the time of each event
+        by : str, optional
+            field to count separately, e.g. source_id
+
+        '''
+
+        self.window = window
+        self.bucket = bucket
+        self.timeField = timeField
+        self.by = by
+        # bucket start -> count, or -> {value: count} with by
+        self.buckets = {}
+        # start of the newest bucket
+        self.newest = None
+        # events left out because their time couldn't be read
+        self.skipped = 0
+
+    def update(self, events):
+        for ev in events:
+            t = ev.get(self.timeField)
+            try:
+                b = toEpoch(t) // self.bucket * self.bucket
+            except (TypeError, ValueError):
+                self.skipped += 1
+                continue
+            if self.newest is None or b > self.newest:
+                self.newest = b
+            if self.by is None:
+                self.buckets[b] = self.buckets.get(b, 0) + 1
+            else:
+                counts = self.buckets.setdefault(b, {})
+                v = ev.get(self.by)
+                counts[v] = counts.get(v, 0) + 1
+
+        self.expire()
+
+    def expire(self, now=None):
+        '''
+        Drop buckets that have left the window, as of now or by default as of
+        the newest event, so that replayed events are kept.
+
+        '''
+
+        if now is None:
+            if self.newest is None:
+                return
+            now = self.newest + self.bucket
+        start = self._start(now)
+        for b in [b for b in self.buckets if b < start]:
+            del self.buckets[b]
+
+    def _start(self, now=None):
+        now = time.time() if now is None else now
+        return (now - self.window) // self.bucket * self.bucket + self.bucket
+
+    def series(self, now=None):
+        '''
+        Counts per bucket over the window, including empty buckets.
+
+        Returns
+        -------
+        list of (str, count):
+            bucket start as YYYY-MM-DDTHH:MM:SSZ, and its count (or dict of
+            counts with by)
+
+        '''
+
+        start = self._start(now)
+        empty = 0 if self.by is None else {}
+
+        return [(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(b)), self.buckets.get(b, empty))
+                for b in range(int(start), int(start + self.window), self.bucket)]
+
+    def value(self, now=None):
+        ''' number of events in the window, or a dict of numbers with by '''
+
+        start = self._start(now)
+        if self.by is None:
+            return sum(c for b, c in self.buckets.items() if b >= start)
+
+        total = {}
+        for b, counts in self.buckets.items():
+            if b >= start:
+                for v, c in counts.items():
+                    total[v] = total.get(v, 0) + c
+
+        return total
+
+
+class liveAggregates:
+    '''
+    A set of named aggregates that are all updated with each batch of
+    events. Aggregates are objects with update(events) and value() methods,
+    e.g. countBy and recentActivity.
+
+    With no aggregates given, it has:
+        sources - events per source_id
+        dois - events per obj_id
+        lastHour - events per minute over the last hour
+
+    '''
+
+    def __init__(self, **aggregates):
+
+        if not aggregates:
+            aggregates = {'sources': countBy('source_id'), 'dois': countBy('obj_id'),
+                          'lastHour': recentActivity(3600, 60)}
+
+        self.aggregates = aggregates
+        self.events = 0
+        self.updated = None
+
+    def add(self, name, aggregate):
+        self.aggregates[name] = aggregate
+        return aggregate
+
+    def __getitem__(self, name):
+        return self.aggregates[name]
+
+    def update(self, events):
+        ''' add a batch of new events to every aggregate '''
+
+        for agg in self.aggregates.values():
+            agg.update(events)
+
+        self.events += len(events)
+        self.updated = time.time()
+
+    def snapshot(self):
+        ''' name -> value of each aggregate, e.g. to serve as json '''
+
+        out = {name: agg.value() for name, agg in self.aggregates.items()}
+        out['events'] = self.events
+        out['updated'] = self.updated
+
+        return out
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the Event Data, REST API, evidence record and activity
+log services, for testing and load testing without the network.
+
+Run from the command line, e.g.
+
+    python -m mrced2.mockServer --port 8000 --events 100000 --latency 0.05 --error-rate 0.01
+
+and point the clients at it:
+
+    ed = mrced2.eventData(baseUrl='http://localhost:8000')
+
+@author: martynrittman
+"""
+
+import sys
+import json
+import time
+import calendar
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    from mrced2.syntheticEvents import syntheticEvents
+    from mrced2.instrument import metrics
+except:
+    from syntheticEvents import syntheticEvents
+    from instrument import metrics
+
+
+class mockServer:
+    '''
+    An HTTP server that emulates the parts of the Crossref APIs used by this
+    package, serving a synthetic corpus (see syntheticEvents):
+
+        /v1/events                  - Event Data queries, with filters, cursor
+                                      pagination, rows=0 hit counts and facets
+        /works/{doi}                - REST API work metadata
+        /prefixes/{prefix}/works    - REST API works for a prefix, with cursors
+        /evidence/{id}              - evidence records
+        /log/{YYYY-MM-DDTHH}.txt    - hourly activity logs
+
+    Latency, server errors and 429 (rate limit) responses can be injected.
+    Injection is seeded, so a run with the same settings and requests in the
+    same order behaves the same way.
+
+    basic usage:
+        with mockServer(events=10000, latency=0.01) as ms:
+            ed = eventData(baseUrl=ms.url)
+            ...
+        ms.requestCount
+
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, events=10000, works=2000, seed=0,
+                 latency=0.0, jitter=0.0, errorRate=0.0, rateLimitRate=0.0,
+                 retryAfter=1, quiet=True):
+        '''
+        Parameters
+        ----------
+        host, port : str, int
+            address to listen on. Port 0 picks a free port, see self.url.
+        events : int
+            number of events in the corpus
+        works : int
+            number of distinct works (DOIs) in the corpus
+        seed : int
+            seed for the corpus and for error injection
+        latency : float
+            seconds added to every response
+        jitter : float
+            extra random latency, up to this many seconds
+        errorRate : float
+            share of requests answered with a 500 error
+        rateLimitRate : float
+            share of requests answered with 429 Too Many Requests
+        retryAfter : int
+            Retry-After header sent with 429 responses
+        quiet : boolean
+            if False, every request is printed
+
+        '''
+
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.rateLimitRate = rateLimitRate
+        self.retryAfter = retryAfter
+        self.quiet = quiet
+
+        self.corpus = syntheticEvents(seed=seed, works=works)
+        self.events = self.corpus.events(events)
+        self.prefix = self.corpus.prefix
+
+        # indexes used by the endpoints
+        self.byEvidence = {}
+        self.byHour = {}
+        self.works = {}
+        for i, ev in enumerate(self.events):
+            self.byEvidence[ev['evidence_record'].rsplit('/', 1)[-1]] = i
+            self.byHour.setdefault(ev['timestamp'][:13], []).append(i)
+            doi = ev['obj_id'][16:]
+            self.works[doi] = self.works.get(doi, 0) + 1
+        self.workList = sorted(self.works, key=lambda d: -self.works[d])
+
+        # filtered lists of events, so that pages of a query don't refilter
+        self._queries = {}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requestCount = 0
+        self.statusCounts = {}
+
+        self.server = ThreadingHTTPServer((host, port), self._handlerClass())
+        self.server.daemon_threads = True
+        self.url = 'http://' + host + ':' + str(self.server.server_address[1])
+        self._thread = None
+
+    # =====================================
+
+    # Running the server
+
+    def start(self):
+        ''' start serving in a background thread '''
+
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+        if not(self.quiet):
+            metrics.say('mock server running at ' + self.url)
+
+        return self
+
+    def stop(self):
+        ''' stop the server '''
+
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _handlerClass(self):
+        ''' a request handler class bound to this server '''
+
+        mock = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                mock.handle(self)
+
+            def log_message(self, format, *args):
+                if not(mock.quiet):
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        return handler
+
+    # =====================================
+
+    # Requests
+
+    def handle(self, request):
+        ''' answer one GET request '''
+
+        with self._lock:
+            self.requestCount += 1
+            draw = self._random.random()
+            delay = self.latency + self.jitter * self._random.random()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if draw < self.rateLimitRate:
+            return self.send(request, 429, {'status': 'error', 'message': 'rate limited'},
+                             headers={'Retry-After': str(self.retryAfter)})
+        if draw < self.rateLimitRate + self.errorRate:
+            return self.send(request, 500, {'status': 'error', 'message': 'injected error'})
+
+        url = urlparse(request.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = unquote(url.path)
+
+        try:
+            if path == '/v1/events':
+                status, body = self.eventsQuery(params)
+            elif path.startswith('/works/'):
+                status, body = self.work(path[len('/works/'):])
+            elif path.startswith('/prefixes/') and path.endswith('/works'):
+                status, body = self.prefixWorks(path[len('/prefixes/'):-len('/works')], params)
+            elif path.startswith('/evidence/'):
+                status, body = self.evidence(path[len('/evidence/'):])
+            elif path.startswith('/log/') and path.endswith('.txt'):
+                status, body = self.log(path[len('/log/'):-len('.txt')])
+            else:
+                status, body = 404, {'status': 'error', 'message': 'not found'}
+        except (ValueError, KeyError) as e:
+            status, body = 400, {'status': 'error', 'message': repr(e)}
+
+        self.send(request, status, body)
+
+    def send(self, request, status, body, headers=None):
+        ''' write a response, json unless body is already a string '''
+
+        with self._lock:
+            self.statusCounts[status] = self.statusCounts.get(status, 0) + 1
+
+        if isinstance(body, str):
+            content = body.encode('utf-8')
+            contentType = 'text/plain'
+        else:
+            content = json.dumps(body).encode('utf-8')
+            contentType = 'application/json'
+
+        request.send_response(status)
+        request.send_header('Content-Type', contentType)
+        request.send_header('Content-Length', str(len(content)))
+        for k, v in (headers or {}).items():
+            request.send_header(k, v)
+        request.end_headers()
+        request.wfile.write(content)
+
+    # =====================================
+
+    # Endpoints
+
+    def matchingEvents(self, params):
+        ''' indices of the events matching the Event Data filters in params '''
+
+        filters = tuple(sorted((k, v) for k, v in params.items()
+                               if k not in ('rows', 'cursor', 'mailto', 'facet')))
+
+        with self._lock:
+            cached = self._queries.get(filters)
+        if cached is not None:
+            return cached
+
+        def keep(ev):
+            for k, v in filters:
+                if k == 'source' and ev['source_id'] != v:
+                    return False
+                elif k == 'obj-id.prefix' and not ev['obj_id'][16:].startswith(v + '/'):
+                    return False
+                elif k == 'subj-id.prefix' and not ev['subj_id'][16:].startswith(v + '/'):
+                    return False
+                elif k == 'obj-id' and ev['obj_id'] not in (v, 'https://doi.org/' + v):
+                    return False
+                elif k == 'subj-id' and ev['subj_id'] not in (v, 'https://doi.org/' + v):
+                    return False
+                elif k == 'relation-type' and ev['relation_type_id'] != v:
+                    return False
+                elif k.startswith('from-') or k.startswith('until-'):
+                    field = 'timestamp' if 'collected' in k else 'occurred_at'
+                    if k.startswith('from-') and ev[field][:10] < v:
+                        return False
+                    if k.startswith('until-') and ev[field][:10] > v:
+                        return False
+            return True
+
+        matching = [i for i, ev in enumerate(self.events) if keep(ev)]
+        with self._lock:
+            self._queries[filters] = matching
+
+        return matching
+
+    def eventsQuery(self, params):
+        ''' /v1/events '''
+
+        matching = self.matchingEvents(params)
+        rows = int(params.get('rows', 1000))
+        start = int(params['cursor'][2:]) if params.get('cursor', '').startswith('c-') else 0
+        page = [self.events[i] for i in matching[start:start + rows]]
+
+        nextCursor = None
+        if rows > 0 and start + rows < len(matching):
+            nextCursor = 'c-' + str(start + rows)
+
+        message = {'next-cursor': nextCursor, 'total-results': len(matching),
+                   'items-per-page': rows, 'events': page}
+
+        if 'facet' in params:
+            name, sep, limit = params['facet'].partition(':')
+            field = {'source': 'source_id', 'relation-type': 'relation_type_id',
+                     'obj-id.prefix': 'obj_id', 'subj-id.domain': 'subj_id'}.get(name, name)
+            values = {}
+            for i in matching:
+                v = self.events[i].get(field)
+                if v is not None:
+                    values[v] = values.get(v, 0) + 1
+            ordered = sorted(values.items(), key=lambda kv: -kv[1])
+            if limit not in ('', '*'):
+                ordered = ordered[:int(limit)]
+            message['facets'] = {name: {'value-count': len(ordered), 'values': dict(ordered)}}
+
+        return 200, {'status': 'ok', 'message-type': 'event-list', 'message': message}
+
+    def workMetadata(self, doi):
+        ''' REST API metadata for a DOI in the corpus '''
+
+        n = int(doi.rsplit('.', 1)[-1]) if doi.rsplit('.', 1)[-1].isdigit() else 0
+        rnd = random.Random(doi)
+        year = 2017 + n % 5
+
+        return {
+            'DOI': doi, 'type': 'posted-content', 'prefix': self.prefix,
+            'title': ['Synthetic work ' + str(n) + (' on COVID-19' if n % 7 == 0 else '')],
+            'abstract': '<jats:title>Abstract</jats:title><jats:p>Abstract of work ' + str(n) + '.</jats:p>',
+            'author': [{'given': 'Author', 'family': 'Number' + str(rnd.randrange(1000))}
+                       for ii in range(1 + n % 4)],
+            'institution': [{'name': 'bioRxiv'}],
+            'group-title': rnd.choice(['Ecology', 'Bioinformatics', 'Neuroscience']),
+            'posted': {'date-parts': [[year, 1 + n % 12, 1 + n % 28]]},
+            'published': {'date-parts': [[year, 1 + n % 12, 1 + n % 28]]},
+            'is-referenced-by-count': self.works.get(doi, 0) // 3,
+        }
+
+    def work(self, doi):
+        ''' /works/{doi} '''
+
+        if doi not in self.works:
+            return 404, 'Resource not found.'
+
+        return 200, {'status': 'ok', 'message-type': 'work', 'message': self.workMetadata(doi)}
+
+    def prefixWorks(self, prefix, params):
+        ''' /prefixes/{prefix}/works '''
+
+        dois = self.workList if prefix == self.prefix else []
+        rows = int(params.get('rows', 20))
+        cursor = params.get('cursor', '*')
+        start = int(cursor[2:]) if cursor.startswith('c-') else 0
+
+        items = [self.workMetadata(d) for d in dois[start:start + rows]]
+        message = {'total-results': len(dois), 'items-per-page': rows, 'items': items}
+        if 'cursor' in params:
+            message['next-cursor'] = 'c-' + str(start + rows)
+
+        return 200, {'status': 'ok', 'message-type': 'work-list', 'message': message}
+
+    def evidence(self, evidenceId):
+        ''' /evidence/{id} '''
+
+        i = self.byEvidence.get(evidenceId)
+        if i is None:
+            return 404, 'Not found'
+
+        ev = self.events[i]
+        subj = dict(ev['subj'])
+        subj.setdefault('url', ev['subj_id'])
+        action = {'url': ev['subj_id'], 'subj': subj,
+                  'processed-observations': [{'type': 'url', 'candidates': [
+                      {'value': ev['obj']['url']}, {'value': ev['obj_id']}]}],
+                  'events': [ev]}
+
+        return 200, {'id': evidenceId, 'timestamp': ev['timestamp'],
+                     'agent': {'name': ev['source_id'] + '-agent'},
+                     'pages': [{'actions': [action]}]}
+
+    def log(self, hour):
+        ''' /log/{YYYY-MM-DDTHH}.txt '''
+
+        lines = []
+        for i in self.byHour.get(hour, []):
+            ev = self.events[i]
+            t = calendar.timegm(time.strptime(ev['timestamp'], '%Y-%m-%dT%H:%M:%SZ')) * 1000
+            evidenceId = ev['evidence_record'].rsplit('/', 1)[-1]
+            lines.append(json.dumps({'s': 'agent', 'c': ev['source_id'], 'f': 'event',
+                                     't': t, 'r': evidenceId, 'e': 't'}))
+
+        return 200, '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    ''' command line entry point '''
+
+    parser = argparse.ArgumentParser(description='Run a local mock of the Crossref APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--events', type=int, default=10000, help='corpus size')
+    parser.add_argument('--works', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true', help='print every request')
+    args = parser.parse_args(argv)
+
+    ms = mockServer(host=args.host, port=args.port, events=args.events, works=args.works,
+                    seed=args.seed, latency=args.latency, jitter=args.jitter,
+                    errorRate=args.error_rate, rateLimitRate=args.rate_limit_rate,
+                    quiet=not args.verbose)
+    print('mock server running at ' + ms.url)
+    try:
+        ms.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ms.server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Match many substrings against text in a single pass.
+
+@author: martynrittman
+"""
+
+
+class patternMatcher:
+    '''
+    Find which of a set of substrings occur in a piece of text, using the
+    Aho-Corasick algorithm: the patterns are compiled once into an automaton
+    and each text is scanned once, however many patterns there are.
+
+    For a handful of patterns, plain substring checks are faster in Python, so
+    they are used below linearThreshold patterns. Results are the same either way.
+
+    basic usage:
+        pm = patternMatcher(['wikipedia.org', 'twitter.com'])
+        pm.search('https://en.wikipedia.org/wiki/DOI')   # {0}
+        pm.matches('https://en.wikipedia.org/wiki/DOI')  # {'wikipedia.org'}
+
+    '''
+
+    linearThreshold = 16
+
+    def __init__(self, patterns):
+        '''
+        Parameters
+        ----------
+        patterns : list of str
+            substrings to look for. Duplicates are allowed and reported separately.
+
+        '''
+
+        self.patterns = list(patterns)
+
+        # an empty pattern is found in any text, like '' in text
+        self.alwaysHit = {i for i, p in enumerate(self.patterns) if p == ''}
+
+        self.useAutomaton = len(self.patterns) >= self.linearThreshold
+        if self.useAutomaton:
+            self.compile()
+
+    def compile(self):
+        '''
+        Build the automaton: a trie of the patterns (self.goto), failure links
+        (self.fail) and the patterns that end at each state (self.out).
+
+        '''
+
+        self.goto = [{}]
+        self.out = [()]
+
+        for i, p in enumerate(self.patterns):
+            if p == '':
+                continue
+            state = 0
+            for ch in p:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.out.append(())
+                state = nxt
+            self.out[state] = self.out[state] + (i,)
+
+        # breadth first, so failure links always point to states already done
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                # a state also matches everything its failure state matches
+                if self.out[self.fail[nxt]]:
+                    self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        '''
+        Which patterns are in the text?
+
+        Parameters
+        ----------
+        text : str
+            text to scan. Anything else (e.g. a list) is checked with "in" for
+            each pattern, in the same way as the rest of the package.
+
+        Returns
+        -------
+        set of int:
+            indices of the patterns that were found
+
+        '''
+
+        if not isinstance(text, str) or not self.useAutomaton:
+            return {i for i, p in enumerate(self.patterns) if p in text}
+
+        hits = set(self.alwaysHit)
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits.update(out[state])
+
+        return hits
+
+    def matches(self, text):
+        ''' the set of patterns (rather than indices) found in the text '''
+
+        return {self.patterns[i] for i in self.search(text)}
+
+    def any(self, text):
+        ''' is any pattern in the text? '''
+
+        if not isinstance(text, str) or not self.useAutomaton:
+            return any(p in text for p in self.patterns)
+
+        if self.alwaysHit:
+            return True
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                return True
+
+        return False
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming pipelines: activity logs -> evidence records -> events.
+
+@author: martynrittman
+"""
+
+import time
+import json
+import queue
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from mrced2.activityLogs import activityLogs
+    from mrced2.activityIndex import activityIndex
+    from mrced2.eventRecord import eventRecord
+    from mrced2.instrument import metrics
+except:
+    from activityLogs import activityLogs
+    from activityIndex import activityIndex
+    from eventRecord import eventRecord
+    from instrument import metrics
+
+
+# put on a queue to tell a worker that there is nothing more to come
+_DONE = object()
+
+
+class pipelineStage:
+    '''
+    One stage of a pipeline: a function run by a number of worker threads,
+    reading from a bounded input queue. The function takes one item and
+    returns an iterable of output items (or None), so a stage can turn one
+    input into many outputs.
+
+    Counters:
+        self.itemsIn, self.itemsOut, self.errors
+        self.busyTime - seconds spent inside the function, summed over workers
+
+    '''
+
+    def __init__(self, name, function, workers=1, queueSize=100):
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.input = queue.Queue(maxsize=queueSize)
+
+        self.itemsIn = 0
+        self.itemsOut = 0
+        self.errors = 0
+        self.busyTime = 0.0
+        self.startTime = None
+        self.endTime = None
+
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def stats(self):
+        ''' counters and throughput (items out per second) for the stage '''
+
+        end = self.endTime or time.time()
+        elapsed = end - self.startTime if self.startTime else 0.0
+
+        return {'stage': self.name, 'workers': self.workers,
+                'in': self.itemsIn, 'out': self.itemsOut, 'errors': self.errors,
+                'queued': self.input.qsize(), 'busy-seconds': round(self.busyTime, 3),
+                'seconds': round(elapsed, 3),
+                'per-second': round(self.itemsOut / elapsed, 1) if elapsed > 0 else 0.0}
+
+
+class pipeline:
+    '''
+    Connects functions as streaming stages with bounded queues between them.
+    Each stage has its own worker threads, so network fetching, JSON parsing
+    and aggregation overlap. When a queue is full the stage feeding it waits
+    (backpressure), so memory use is limited by the queue sizes.
+
+    basic usage:
+        p = pipeline()
+        p.addStage('fetch', fetchFunction, workers=8)
+        p.addStage('parse', parseFunction, workers=2)
+        p.run(inputs, sink=results.append)
+        p.stats()
+
+    See eventsFromLogs() for a ready-made pipeline from activity logs to events.
+
+    '''
+
+    def __init__(self, quiet=False, reportEvery=None):
+        '''
+        Parameters
+        ----------
+        quiet : boolean
+            There is no printed output if True. The default is False.
+        reportEvery : float, optional
+            print the stage counters every this many seconds while running
+
+        '''
+
+        self.stages = []
+        self.quiet = quiet
+        self.reportEvery = reportEvery
+
+    def addStage(self, name, function, workers=1, queueSize=100):
+        '''
+        Add a stage to the end of the pipeline.
+
+        Parameters
+        ----------
+        name : str
+            used in the counters
+        function : callable
+            takes one item, returns an iterable of output items or None
+        workers : int
+            number of threads running the function
+        queueSize : int
+            maximum number of items waiting for this stage
+
+        '''
+
+        self.stages.append(pipelineStage(name, function, workers, queueSize))
+
+        return self
+
+    def _worker(self, i, sink):
+        ''' the loop run by each worker thread of stage i '''
+
+        stage = self.stages[i]
+        last = i == len(self.stages) - 1
+
+        while True:
+            item = stage.input.get()
+            if item is _DONE:
+                break
+
+            with stage._lock:
+                stage.itemsIn += 1
+
+            start = time.time()
+            try:
+                outputs = stage.function(item)
+                for out in outputs or ():
+                    if last:
+                        with stage._lock:
+                            sink(out)
+                    else:
+                        # blocks while the next stage is busy
+                        self.stages[i + 1].input.put(out)
+                    with stage._lock:
+                        stage.itemsOut += 1
+            except Exception as e:
+                with stage._lock:
+                    stage.errors += 1
+                if not(self.quiet):
+                    metrics.say('error in stage ' + stage.name + ': ' + repr(e))
+            finally:
+                with stage._lock:
+                    stage.busyTime += time.time() - start
+
+        # the last worker of a stage to finish tells the next stage
+        with stage._lock:
+            stage._running -= 1
+            finished = stage._running == 0
+        if finished:
+            stage.endTime = time.time()
+            if not last:
+                for ii in range(self.stages[i + 1].workers):
+                    self.stages[i + 1].input.put(_DONE)
+
+    def run(self, inputs, sink=None):
+        '''
+        Run the pipeline over the inputs and wait for it to finish.
+
+        Parameters
+        ----------
+        inputs : iterable
+            items for the first stage, read lazily
+        sink : callable, optional
+            called with each output of the last stage (never concurrently).
+            If not given the outputs are returned as a list.
+
+        Returns
+        -------
+        list of outputs if no sink was given, otherwise None
+
+        '''
+
+        if len(self.stages) == 0:
+            metrics.say('no stages in the pipeline')
+            return
+
+        results = None
+        if sink is None:
+            results = []
+            sink = results.append
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            stage.startTime = time.time()
+            stage._running = stage.workers
+            for w in range(stage.workers):
+                t = threading.Thread(target=self._worker, args=(i, sink),
+                                     name=stage.name + '-' + str(w), daemon=True)
+                t.start()
+                threads.append(t)
+
+        first = self.stages[0]
+        lastReport = time.time()
+        for item in inputs:
+            first.input.put(item)
+            if self.reportEvery and time.time() - lastReport > self.reportEvery:
+                self.printStats()
+                lastReport = time.time()
+        for w in range(first.workers):
+            first.input.put(_DONE)
+
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=self.reportEvery or None)
+                if self.reportEvery and t.is_alive():
+                    self.printStats()
+
+        if not(self.quiet):
+            self.printStats()
+
+        return results
+
+    def stats(self):
+        ''' list of counters for each stage '''
+
+        return [stage.stats() for stage in self.stages]
+
+    def printStats(self):
+        ''' print one line of counters per stage '''
+
+        for s in self.stats():
+            metrics.say(s['stage'] + ': in ' + str(s['in']) + ', out ' + str(s['out']) +
+                        ', errors ' + str(s['errors']) + ', queued ' + str(s['queued']) +
+                        ', ' + str(s['per-second']) + '/s')
+
+
+# =====================================
+
+# Activity logs -> evidence records -> events
+
+
+def eventsFromLogs(hours, agent=None, archive=None, logWorkers=2, fetchWorkers=8,
+                   parseWorkers=1, queueSize=100, quiet=False,
+                   baseUrl='https://evidence.eventdata.crossref.org', seen=None):
+    '''
+    Find the events produced from the evidence records mentioned in some
+    hourly activity logs, as one streaming pipeline:
+
+        logs (read hourly logs, find new evidence records)
+        -> evidence (fetch each evidence record)
+        -> events (pull the events out of each record)
+
+    Parameters
+    ----------
+    hours : list of str
+        hours in the format used by activityLogs.buildQuery, e.g. 2021-01-01T01
+    agent : str, optional
+        only use log entries from this agent, e.g. twitter
+    archive : evidenceArchive, optional
+        evidence records are read from the archive when they're there, and
+        added to it when they're fetched
+    logWorkers, fetchWorkers, parseWorkers : int
+        number of threads for each stage
+    queueSize : int
+        maximum number of items waiting between stages
+    quiet : boolean
+        There is no printed output if True. The default is False.
+    baseUrl : str
+        location of the evidence service, for the logs and the evidence records
+    seen : seenSet, optional
+        evidence records and event ids handled by earlier runs or other
+        workers. Those records aren't fetched and those events aren't
+        returned; the ones handled by this run are added.
+
+    Returns
+    -------
+    (eventRecord, pipeline):
+        the events, deduplicated by id, and the pipeline with its counters.
+        Logs and evidence records that couldn't be fetched are counted in the
+        errors of their stage.
+
+    '''
+
+    found = set()
+    foundLock = threading.Lock()
+    prefix = baseUrl.rstrip('/') + '/evidence/'
+
+    def logStage(hour):
+        al = activityLogs(baseUrl)
+        al.buildQuery(hour, quiet=True)
+        for entry in al.iterLogs(quiet=True):
+            evrec = entry.get(activityIndex.recordKey)
+            if evrec is None:
+                continue
+            if agent is not None and entry.get(activityIndex.agentKey) != agent \
+                    and ('-' + agent + '-') not in evrec:
+                continue
+            url = evrec if evrec.startswith('http') else prefix + evrec
+            with foundLock:
+                if url in found:
+                    continue
+                found.add(url)
+            # before the record is queued, so it is never fetched
+            if seen is not None and seen.contains(url, 'evidence'):
+                continue
+            yield url
+
+        # counted as an error of the stage, like a failed evidence record
+        if not(al.success):
+            raise IOError('log for ' + hour + ' could not be fetched')
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=fetchWorkers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def evidenceStage(url):
+        if archive is not None:
+            content = archive.getBytes(url)
+            if content is not None:
+                return [(url, content)]
+        r = metrics.get(url, session=session, timeout=60)
+        if not(r.status_code in (200, 201)):
+            raise IOError('status ' + str(r.status_code) + ' for ' + url)
+        if archive is not None:
+            archive.put(url, r.content)
+        return [(url, r.content)]
+
+    def eventStage(record):
+        url, content = record
+        jsonData = json.loads(content)
+        for page in jsonData.get('pages', ()):
+            for action in page.get('actions', ()):
+                for event in action.get('events', ()):
+                    yield event
+        processed.append(url)
+
+    events = {}
+    # events without an id can't be deduplicated, so all are kept
+    noId = []
+    processed = []
+
+    def collect(event):
+        eventId = event.get('id')
+        if eventId is None:
+            noId.append(event)
+            return
+        if eventId in events:
+            return
+        if seen is not None and seen.contains(eventId, 'event'):
+            return
+        events[eventId] = event
+
+    p = pipeline(quiet=quiet)
+    p.addStage('logs', logStage, workers=logWorkers, queueSize=queueSize)
+    p.addStage('evidence', evidenceStage, workers=fetchWorkers, queueSize=queueSize)
+    p.addStage('events', eventStage, workers=parseWorkers, queueSize=queueSize)
+    p.run(hours, sink=collect)
+
+    session.close()
+
+    # after the events are collected, so that a run that stops early fetches
+    # its records again next time
+    if seen is not None:
+        seen.addMany(list(events), 'event')
+        seen.addMany(processed, 'evidence')
+
+    found = list(events.values()) + noId
+    er = eventRecord()
+    er.addJsonData({"status": "ok", "message": {
+        "total-results": len(found), "events": found}})
+
+    return er, p
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API responses written straight to disk, and parsed only when they are used.
+
+@author: martynrittman
+"""
+
+import os
+import re
+import gzip
+import json
+import zlib
+
+# orjson is much faster than json for large pages, but isn't required
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# gzip level for pages written through: most of the saving in size of level 9
+# for a fifth of the CPU
+COMPRESSLEVEL = 3
+
+
+class rawJson:
+    '''
+    Unparsed json: either the bytes of a response or the file they were
+    written to (gzip-compressed if the name ends in .gz). Assigned to a
+    lazyJsonData attribute, it is parsed the first time it is used.
+
+    '''
+
+    def __init__(self, content=None, filename=None):
+        self.content = content
+        self.filename = filename
+
+    def read(self):
+        ''' the raw bytes '''
+
+        if self.content is not None:
+            return self.content
+
+        opener = gzip.open if self.filename.endswith('.gz') else open
+        with opener(self.filename, 'rb') as f:
+            return f.read()
+
+    def parse(self):
+        ''' the parsed json '''
+
+        return _loads(self.read())
+
+
+class lazyJsonData:
+    '''
+    A jsonData attribute that can be given a rawJson, which is parsed the
+    first time the attribute is read. Anything else is stored as it is.
+
+        class eventRecord():
+            jsonData = lazyJsonData()
+
+    '''
+
+    def __set_name__(self, owner, name):
+        self.name = '_' + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+
+        try:
+            value = obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name[1:])
+
+        if isinstance(value, rawJson):
+            value = obj.__dict__[self.name] = value.parse()
+
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
+def isParsed(obj, name='jsonData'):
+    ''' False if obj.name holds a rawJson that hasn't been read yet '''
+
+    return not isinstance(obj.__dict__.get('_' + name), rawJson)
+
+
+# =====================================
+
+# Reading fields without parsing
+
+
+def headValue(head, key):
+    '''
+    Find a top-level value (a string, number or null) near the start of a
+    response without parsing it, e.g. the next-cursor of an Event Data page,
+    which comes before the events.
+
+    Parameters
+    ----------
+    head : bytes
+        the first part of the response
+    key : str
+        e.g. next-cursor
+
+    Returns
+    -------
+    (boolean, value):
+        whether the key was found, and its value
+
+    '''
+
+    m = re.search(b'"' + re.escape(key.encode()) +
+                  rb'"\s*:\s*(null|"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?)', head)
+    if m is None:
+        return False, None
+
+    return True, json.loads(m.group(1))
+
+
+# =====================================
+
+# Writing
+
+
+def writeBytes(content, filename, compress=False):
+    '''
+    Write bytes to a file, via a temporary file. A .gz suffix is added to the
+    name if compress is True.
+
+    Returns
+    -------
+    str:
+        the name of the file written
+
+    '''
+
+    if compress and not filename.endswith('.gz'):
+        filename += '.gz'
+
+    if compress:
+        f = gzip.open(filename + '.tmp', 'wb', compresslevel=COMPRESSLEVEL)
+    else:
+        f = open(filename + '.tmp', 'wb')
+    with f:
+        f.write(content)
+    os.replace(filename + '.tmp', filename)
+
+    return filename
+
+
+def writeResponse(r, filename, compress=False, headSize=65536, chunkSize=65536):
+    '''
+    Stream the body of a response (requested with stream=True) to a file, so
+    that it is never held in memory as a whole. A .gz suffix is added to the
+    name if compress is True. If the server already sent the body gzipped,
+    the compressed bytes are written as they arrived.
+
+    Parameters
+    ----------
+    r : requests.Response
+    filename : str
+    compress : boolean
+        write a gzip file
+    headSize : int
+        number of bytes from the start of the body to return, e.g. for headValue()
+    chunkSize : int
+
+    Returns
+    -------
+    (str, bytes):
+        the name of the file written and the start of the (decompressed) body
+
+    '''
+
+    if compress and not filename.endswith('.gz'):
+        filename += '.gz'
+
+    head = b''
+    encoding = r.headers.get('Content-Encoding', '').strip().lower()
+
+    if compress and encoding == 'gzip':
+        # already compressed: only the start is decompressed, to find the head
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(filename + '.tmp', 'wb') as f:
+            for chunk in r.raw.stream(chunkSize, decode_content=False):
+                if len(head) < headSize:
+                    head += decompressor.decompress(decompressor.unconsumed_tail + chunk,
+                                                    headSize - len(head))
+                f.write(chunk)
+    else:
+        if compress:
+            f = gzip.open(filename + '.tmp', 'wb', compresslevel=COMPRESSLEVEL)
+        else:
+            f = open(filename + '.tmp', 'wb')
+        with f:
+            for chunk in r.iter_content(chunkSize):
+                if len(head) < headSize:
+                    head += chunk[:headSize - len(head)]
+                f.write(chunk)
+
+    os.replace(filename + '.tmp', filename)
+
+    return filename, head
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Graph of the relations between subjects and objects of events, in
+compressed sparse row (CSR) arrays.
+
+@author: martynrittman
+"""
+
+from array import array
+
+import numpy as np
+
+
+# relations between works, as opposed to mentions on the web
+WORKRELATIONS = ('references', 'cites', 'is-referenced-by', 'is-cited-by',
+                 'is-supplement-to', 'is-supplemented-by', 'is-part-of', 'has-part',
+                 'is-version-of', 'has-version', 'is-identical-to', 'is-derived-from',
+                 'is-source-of', 'is-new-version-of', 'is-previous-version-of')
+
+# relation types that point from the work being used to the one using it,
+# and their forward forms: "x is-cited-by y" is "y cites x"
+INVERSES = {'is-referenced-by': 'references', 'is-cited-by': 'cites',
+            'is-supplemented-by': 'is-supplement-to', 'has-part': 'is-part-of',
+            'has-version': 'is-version-of', 'is-source-of': 'is-derived-from',
+            'is-previous-version-of': 'is-new-version-of', 'is-documented-by': 'documents',
+            'is-compiled-by': 'compiles', 'is-required-by': 'requires',
+            'is-reviewed-by': 'reviews', 'is-described-by': 'describes',
+            'is-continued-by': 'continues', 'is-obsoleted-by': 'obsoletes',
+            'has-metadata': 'is-metadata-for', 'is-original-form-of': 'is-variant-form-of'}
+
+
+class relationGraph:
+    '''
+    Events as edges subj_id -> obj_id, labelled with their relation_type_id,
+    e.g. a DataCite dataset that is-supplement-to an article. Nodes are
+    numbered in the order they are first seen, and edges are held in numpy
+    arrays:
+
+        self.nodes - node number -> id (a DOI URL or other subj/obj id)
+        self.relations - label number -> relation_type_id
+        self.outOffsets, self.outTargets, self.outLabels - the edges from
+            node k are outTargets[outOffsets[k]:outOffsets[k+1]]
+        self.inOffsets, self.inSources, self.inLabels - the same for the
+            edges to each node
+
+    DataCite reports relations in both directions, so by default inverse
+    relations (see INVERSES) are turned round as they are added: "x
+    is-cited-by y" becomes the edge y -> x labelled cites. Edges then
+    always point from the work that uses to the work that is used, and
+    relation types given to queries are read in their forward form too.
+
+    Queries take ids (bare DOIs are matched to https://doi.org/ ids) and
+    work on whole frontiers of nodes at once, so that traversals of
+    millions of edges stay in numpy.
+
+    basic usage:
+        g = relationGraph(er, relations=WORKRELATIONS)   # er is an eventRecord
+        g.inDegree('10.21105/joss.01686')
+        g.neighbourhood('10.21105/joss.01686', k=2, direction='both')
+        g.citers('10.21105')     # who cites the prefix, and how often
+
+    '''
+
+    def __init__(self, events=None, relations=None, unique=True, forward=True):
+        '''
+        Parameters
+        ----------
+        events : eventRecord or iterable of dicts, optional
+            events to build the graph from
+        relations : list of str, optional
+            only keep edges of these relation types, e.g. WORKRELATIONS.
+            All are kept if not given.
+        unique : boolean
+            keep one edge per subject, object and relation, e.g. when the
+            same reference is reported twice
+        forward : boolean
+            turn inverse relations round, so that "x is-referenced-by y"
+            and "y references x" are the same edge
+
+        '''
+
+        self.keep = None if relations is None else set(relations)
+        self.unique = unique
+        self.forward = forward
+
+        self.nodes = []
+        self.relations = []
+        self._nodeIds = {}
+        self._relationIds = {}
+
+        # edges added since the arrays were built
+        self._src = array('q')
+        self._dst = array('q')
+        self._rel = array('q')
+
+        self.outOffsets = np.zeros(1, dtype=np.int64)
+        self.outTargets = np.zeros(0, dtype=np.int64)
+        self.outLabels = np.zeros(0, dtype=np.int32)
+        self.inOffsets = np.zeros(1, dtype=np.int64)
+        self.inSources = np.zeros(0, dtype=np.int64)
+        self.inLabels = np.zeros(0, dtype=np.int32)
+
+        if events is not None:
+            self.update(events)
+
+    # =====================================
+
+    # Building
+
+    def _nodeId(self, name):
+        k = self._nodeIds.get(name)
+        if k is None:
+            k = self._nodeIds[name] = len(self.nodes)
+            self.nodes.append(name)
+
+        return k
+
+    def add(self, ev):
+        ''' add the edge of one event; call build() once all are added '''
+
+        rel = ev.get('relation_type_id')
+        subj = ev.get('subj_id')
+        obj = ev.get('obj_id')
+        if rel is None or subj is None or obj is None:
+            return
+        if self.keep is not None and rel not in self.keep:
+            return
+        if self.forward and rel in INVERSES:
+            rel = INVERSES[rel]
+            subj, obj = obj, subj
+
+        r = self._relationIds.get(rel)
+        if r is None:
+            r = self._relationIds[rel] = len(self.relations)
+            self.relations.append(rel)
+
+        self._src.append(self._nodeId(subj))
+        self._dst.append(self._nodeId(obj))
+        self._rel.append(r)
+
+    def update(self, events):
+        '''
+        Add events (an eventRecord or an iterable) and rebuild the arrays.
+
+        Returns
+        -------
+        self
+
+        '''
+
+        if hasattr(events, 'jsonData'):
+            events = events.jsonData["message"]["events"]
+        for ev in events:
+            self.add(ev)
+
+        return self.build()
+
+    def build(self):
+        ''' fold the edges added since the last build into the CSR arrays '''
+
+        n = len(self.nodes)
+        if len(self._src) == 0:
+            self._resize(n)
+            return self
+
+        # the edges already built, and the new ones
+        built = np.repeat(np.arange(len(self.outOffsets) - 1), np.diff(self.outOffsets))
+        src = np.concatenate([built, np.frombuffer(self._src, dtype=np.int64)])
+        dst = np.concatenate([self.outTargets, np.frombuffer(self._dst, dtype=np.int64)])
+        rel = np.concatenate([self.outLabels, np.frombuffer(self._rel, dtype=np.int64).astype(np.int32)])
+
+        self._src = array('q')
+        self._dst = array('q')
+        self._rel = array('q')
+
+        # sorted by source, which the out arrays need, and repeats next to each other
+        order = np.lexsort((rel, dst, src))
+        src, dst, rel = src[order], dst[order], rel[order]
+        if self.unique and len(src) > 1:
+            keep = np.ones(len(src), dtype=bool)
+            keep[1:] = (np.diff(src) != 0) | (np.diff(dst) != 0) | (np.diff(rel) != 0)
+            src, dst, rel = src[keep], dst[keep], rel[keep]
+
+        self.outTargets = dst
+        self.outLabels = rel
+        self.outOffsets = _offsets(src, n)
+
+        order = np.argsort(dst, kind='stable')
+        self.inSources = src[order]
+        self.inLabels = rel[order]
+        self.inOffsets = _offsets(dst, n)
+
+        return self
+
+    def _resize(self, n):
+        ''' offsets for nodes added without edges '''
+
+        for name in ('outOffsets', 'inOffsets'):
+            offsets = getattr(self, name)
+            if len(offsets) < n + 1:
+                setattr(self, name, np.concatenate(
+                    [offsets, np.full(n + 1 - len(offsets), offsets[-1], dtype=np.int64)]))
+
+    # =====================================
+
+    # Queries
+
+    def __len__(self):
+        ''' number of edges '''
+
+        return len(self.outTargets)
+
+    def node(self, name):
+        ''' node number of an id or bare DOI, None if it isn't in the graph '''
+
+        k = self._nodeIds.get(name)
+        if k is None and not name.startswith('http'):
+            k = self._nodeIds.get('https://doi.org/' + name)
+
+        return k
+
+    def _nodes(self, names):
+        ''' node numbers of one id or a list of them, leaving out any not in the graph '''
+
+        if isinstance(names, str):
+            names = [names]
+        ks = [self.node(n) for n in names]
+
+        return np.array([k for k in ks if k is not None], dtype=np.int64)
+
+    def _labels(self, relations):
+        ''' label numbers of a list of relation types, None for all '''
+
+        if relations is None:
+            return None
+        if isinstance(relations, str):
+            relations = [relations]
+        if self.forward:
+            relations = [INVERSES.get(r, r) for r in relations]
+
+        return np.array([self._relationIds[r] for r in relations if r in self._relationIds],
+                        dtype=np.int32)
+
+    def outDegree(self, name=None):
+        ''' number of edges from a node, or an array for all nodes '''
+
+        degrees = np.diff(self.outOffsets)
+        if name is None:
+            return degrees
+
+        k = self.node(name)
+        return 0 if k is None else int(degrees[k])
+
+    def inDegree(self, name=None):
+        ''' number of edges to a node, or an array for all nodes '''
+
+        degrees = np.diff(self.inOffsets)
+        if name is None:
+            return degrees
+
+        k = self.node(name)
+        return 0 if k is None else int(degrees[k])
+
+    def _step(self, frontier, direction, labels):
+        ''' node numbers one edge away from the nodes in frontier, with repeats '''
+
+        found = []
+        if direction in ('out', 'both'):
+            found.append(_gather(self.outOffsets, self.outTargets, self.outLabels, frontier, labels))
+        if direction in ('in', 'both'):
+            found.append(_gather(self.inOffsets, self.inSources, self.inLabels, frontier, labels))
+
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def neighbours(self, name, direction='out', relations=None):
+        '''
+        Ids one edge away from a node.
+
+        Parameters
+        ----------
+        name : str
+            id or bare DOI
+        direction : str
+            'out' (what the node relates to), 'in' (what relates to it) or 'both'
+        relations : list of str, optional
+            only follow these relation types
+
+        Returns
+        -------
+        list of str
+
+        '''
+
+        found = np.unique(self._step(self._nodes(name), direction, self._labels(relations)))
+
+        return [self.nodes[k] for k in found]
+
+    def neighbourhood(self, names, k=2, direction='both', relations=None):
+        '''
+        All the nodes within k edges, by breadth-first search.
+
+        Parameters
+        ----------
+        names : str or list of str
+            ids or bare DOIs to start from
+        k : int
+            most edges away
+        direction : str
+            'out', 'in' or 'both'
+        relations : list of str, optional
+            only follow these relation types
+
+        Returns
+        -------
+        dict:
+            id -> number of edges away, including the start nodes at 0
+
+        '''
+
+        labels = self._labels(relations)
+        distance = np.full(len(self.nodes), -1, dtype=np.int64)
+
+        frontier = np.unique(self._nodes(names))
+        distance[frontier] = 0
+        for hop in range(1, k + 1):
+            if len(frontier) == 0:
+                break
+            found = np.unique(self._step(frontier, direction, labels))
+            frontier = found[distance[found] < 0]
+            distance[frontier] = hop
+
+        reached = np.nonzero(distance >= 0)[0]
+
+        return {self.nodes[i]: int(distance[i]) for i in reached}
+
+    def citers(self, prefix, relations=None):
+        '''
+        Who relates to the works of a DOI prefix, e.g. which works cite it:
+        the sources of the edges into the prefix's works. With inverse
+        relations turned round (forward=True) these include the works that
+        a prefix's work is-referenced-by or is-cited-by.
+
+        Parameters
+        ----------
+        prefix : str
+            DOI prefix, e.g. 10.21105
+        relations : list of str, optional
+            only count these relation types, e.g. ['references', 'cites']
+
+        Returns
+        -------
+        dict:
+            id -> number of edges to the prefix's works, largest first
+
+        '''
+
+        start = 'https://doi.org/' + prefix.lower() + '/'
+        targets = np.array([k for k, name in enumerate(self.nodes)
+                            if name.lower().startswith(start)], dtype=np.int64)
+        if len(targets) == 0:
+            return {}
+
+        sources = _gather(self.inOffsets, self.inSources, self.inLabels, targets,
+                          self._labels(relations))
+        ids, counts = np.unique(sources, return_counts=True)
+        order = np.argsort(-counts, kind='stable')
+
+        return {self.nodes[ids[i]]: int(counts[i]) for i in order}
+
+    def edges(self, relations=None):
+        '''
+        All the edges, as (subject id, relation type, object id).
+
+        '''
+
+        labels = self._labels(relations)
+        src = np.repeat(np.arange(len(self.nodes)), np.diff(self.outOffsets))
+        keep = np.ones(len(src), dtype=bool) if labels is None else np.isin(self.outLabels, labels)
+        for s, r, d in zip(src[keep], self.outLabels[keep], self.outTargets[keep]):
+            yield self.nodes[s], self.relations[r], self.nodes[d]
+
+    # =====================================
+
+    # Saving
+
+    def save(self, filename):
+        ''' save the graph to an .npz file '''
+
+        self.build()
+        np.savez_compressed(filename, nodes=np.array(self.nodes, dtype=str),
+                            relations=np.array(self.relations, dtype=str),
+                            outOffsets=self.outOffsets, outTargets=self.outTargets,
+                            outLabels=self.outLabels, inOffsets=self.inOffsets,
+                            inSources=self.inSources, inLabels=self.inLabels,
+                            unique=self.unique, forward=self.forward,
+                            keep=np.array(sorted(self.keep or ()), dtype=str),
+                            filtered=self.keep is not None)
+
+    @classmethod
+    def load(cls, filename):
+        ''' load a graph saved by save(); more events can be added to it '''
+
+        g = cls()
+        with np.load(filename) as data:
+            g.nodes = data['nodes'].tolist()
+            g.relations = data['relations'].tolist()
+            for name in ('outOffsets', 'outTargets', 'outLabels',
+                         'inOffsets', 'inSources', 'inLabels'):
+                setattr(g, name, data[name])
+            g.unique = bool(data['unique'])
+            g.forward = bool(data['forward'])
+            if bool(data['filtered']):
+                g.keep = set(data['keep'].tolist())
+        g._nodeIds = {name: k for k, name in enumerate(g.nodes)}
+        g._relationIds = {name: k for k, name in enumerate(g.relations)}
+
+        return g
+
+
+def _offsets(keys, n):
+    ''' CSR offsets of n rows from the row of each entry '''
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+
+    return offsets
+
+
+def _gather(offsets, targets, labels, rows, keep=None):
+    ''' the targets of all the rows in one go, optionally only those with labels in keep '''
+
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # positions starts[i] .. starts[i] + lengths[i] - 1 for every row
+    ends = np.cumsum(lengths)
+    positions = np.arange(total) - np.repeat(ends - lengths, lengths) + np.repeat(starts, lengths)
+
+    if keep is not None:
+        positions = positions[np.isin(labels[positions], keep)]
+
+    return targets[positions]
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental builds of reports: each step declares its inputs, its output is
+cached under a hash of them, and only steps whose inputs changed are run.
+
+@author: martynrittman
+"""
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import inspect
+from datetime import date
+
+try:
+    from mrced2.instrument import metrics
+except:
+    from instrument import metrics
+
+
+class buildStep:
+    ''' one step of a reportBuild, see reportBuild.step() '''
+
+    def __init__(self, name, func, inputs=(), params=None, files=(), version=None,
+                 maxAge=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+        self.files = tuple(files)
+        self.maxAge = maxAge
+
+        # changing the code of a step invalidates it, unless a version is given
+        if version is None:
+            try:
+                version = inspect.getsource(func)
+            except (OSError, TypeError):
+                version = func.__code__.co_code.hex()
+        self.version = hashlib.sha256(str(version).encode()).hexdigest()
+
+
+class reportBuild:
+    '''
+    A small build system for analysis steps, e.g. harvest works -> count
+    sources -> join -> aggregate -> chart data.
+
+    Each step declares the steps it takes as inputs, its parameters and any
+    files it reads. Its output is pickled and stored under the sha256 of its
+    content, and found again through a key made from the hashes of the step's
+    code, parameters, files and inputs. A step is run only if that key is new
+    (or its output is older than maxAge). If a step runs again but gives the
+    same output as before, the steps after it don't need to run.
+
+    basic usage:
+        rb = reportBuild('.mrced2-cache/build')
+
+        @rb.step(params={'prefix': '10.21105', 'day': '2021-10-25'})
+        def works(prefix, day):
+            ...
+
+        @rb.step(inputs=['works'])
+        def citations(works):
+            return sum(w['citations'] for w in works)
+
+        results = rb.build()     # {'works': [...], 'citations': 1234}
+        rb.printLog()
+
+    '''
+
+    def __init__(self, cache='.mrced2-cache/build', quiet=False):
+        '''
+        Parameters
+        ----------
+        cache : str
+            folder for outputs and keys, created if it doesn't exist
+        quiet : boolean
+            There is no printed output if True. The default is False.
+
+        '''
+
+        self.cache = cache
+        self.quiet = quiet
+        self.steps = {}
+
+        # step -> {'status': 'ran' or 'cached', 'seconds', 'key', 'output'} from the last build
+        self.log = {}
+
+        os.makedirs(os.path.join(cache, 'keys'), exist_ok=True)
+        os.makedirs(os.path.join(cache, 'objects'), exist_ok=True)
+
+        # path -> [size, mtime, sha256], so unchanged files aren't hashed again
+        self.fileHashesFile = os.path.join(cache, 'files.json')
+        self.fileHashes = {}
+        if os.path.exists(self.fileHashesFile):
+            with open(self.fileHashesFile) as f:
+                self.fileHashes = json.load(f)
+
+    # =====================================
+
+    # Declaring steps
+
+    def addStep(self, name, func, inputs=(), params=None, files=(), version=None, maxAge=None):
+        '''
+        Add a step.
+
+        Parameters
+        ----------
+        name : str
+        func : function
+            called with the outputs of the inputs and the params as keyword
+            arguments, returns the output of the step, which must be picklable
+        inputs : list of str
+            names of the steps whose outputs are used
+        params : dict
+            keyword arguments for func, json-serialisable (or with a str() that
+            identifies them)
+        files : list of str
+            files read by func. A change to their content invalidates the step.
+        version : str, optional
+            invalidates the step when changed. Defaults to the source of func.
+        maxAge : float, optional
+            seconds after which the output is out of date even if nothing
+            changed, e.g. for a harvest from an API
+
+        '''
+
+        self.steps[name] = buildStep(name, func, inputs, params, files, version, maxAge)
+
+        return func
+
+    def step(self, name=None, inputs=(), params=None, files=(), version=None, maxAge=None):
+        ''' decorator version of addStep(), the name defaults to the function's '''
+
+        def decorator(func):
+            return self.addStep(name or func.__name__, func, inputs, params, files,
+                                version, maxAge)
+
+        return decorator
+
+    # =====================================
+
+    # Storage
+
+    def _keyPath(self, key):
+        return os.path.join(self.cache, 'keys', key[:2], key + '.json')
+
+    def _objectPath(self, digest):
+        return os.path.join(self.cache, 'objects', digest[:2], digest + '.pkl')
+
+    def _write(self, path, content, mode='wb'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', mode) as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+    def fileHash(self, path):
+        ''' sha256 of a file's content, reused while its size and mtime are unchanged '''
+
+        st = os.stat(path)
+        known = self.fileHashes.get(path)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+
+        self.fileHashes[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+
+        return h.hexdigest()
+
+    def stepKey(self, step, inputHashes):
+        ''' the cache key of a step, from its code, params, files and input hashes '''
+
+        spec = {'step': step.name, 'version': step.version,
+                'params': step.params, 'inputs': inputHashes,
+                'files': {path: self.fileHash(path) for path in step.files}}
+
+        return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+    def loadOutput(self, digest):
+        with open(self._objectPath(digest), 'rb') as f:
+            return pickle.load(f)
+
+    # =====================================
+
+    # Building
+
+    def order(self, targets=None):
+        ''' the steps needed for targets (all steps by default), inputs first '''
+
+        ordered = []
+        state = {}
+
+        def visit(name, path):
+            if name not in self.steps:
+                raise KeyError('unknown step ' + name + (' (input of ' + path[-1] + ')' if path else ''))
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('steps depend on each other: ' + ' -> '.join(path + [name]))
+
+            state[name] = 'visiting'
+            for i in self.steps[name].inputs:
+                visit(i, path + [name])
+            state[name] = 'done'
+            ordered.append(name)
+
+        for name in (targets or list(self.steps)):
+            visit(name, [])
+
+        return ordered
+
+    def build(self, targets=None, force=()):
+        '''
+        Run the steps that are out of date.
+
+        Parameters
+        ----------
+        targets : list of str, optional
+            the steps whose outputs are wanted, all steps by default. The
+            steps they depend on are included.
+        force : list of str
+            steps to run even if they're up to date
+
+        Returns
+        -------
+        dict:
+            output of each target. Outputs of other steps are only loaded from
+            the cache if a step that uses them has to run.
+
+        '''
+
+        order = self.order(targets)
+        targets = set(targets or self.steps)
+
+        self.log = {}
+        hashes = {}  # step -> hash of its output
+        outputs = {}  # step -> output, loaded when needed
+
+        def output(name):
+            if name not in outputs:
+                outputs[name] = self.loadOutput(hashes[name])
+            return outputs[name]
+
+        for name in order:
+            step = self.steps[name]
+            key = self.stepKey(step, {i: hashes[i] for i in step.inputs})
+
+            entry = None
+            if os.path.exists(self._keyPath(key)):
+                with open(self._keyPath(key)) as f:
+                    entry = json.load(f)
+                if step.maxAge is not None and time.time() - entry['created'] > step.maxAge:
+                    entry = None
+                elif not os.path.exists(self._objectPath(entry['output'])):
+                    entry = None
+
+            if entry is not None and name not in force:
+                hashes[name] = entry['output']
+                self.log[name] = {'status': 'cached', 'seconds': 0.0, 'key': key,
+                                  'output': entry['output']}
+                continue
+
+            start = time.perf_counter()
+            value = step.func(**{i: output(i) for i in step.inputs}, **step.params)
+            seconds = time.perf_counter() - start
+
+            content = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.sha256(content).hexdigest()
+            if not os.path.exists(self._objectPath(digest)):
+                self._write(self._objectPath(digest), content)
+            self._write(self._keyPath(key), json.dumps(
+                {'step': name, 'output': digest, 'created': time.time(),
+                 'seconds': round(seconds, 3)}), 'w')
+
+            hashes[name] = digest
+            outputs[name] = value
+            self.log[name] = {'status': 'ran', 'seconds': round(seconds, 3), 'key': key,
+                              'output': digest}
+            metrics.recordCall('reportBuild.' + name, seconds)
+
+            if not(self.quiet):
+                metrics.say(name + ' ran in ' + str(round(seconds, 2)) + ' s')
+
+        self._write(self.fileHashesFile, json.dumps(self.fileHashes), 'w')
+
+        return {name: output(name) for name in order if name in targets}
+
+    def printLog(self):
+        ''' print what the last build did '''
+
+        for name, entry in self.log.items():
+            metrics.say(name.ljust(20) + entry['status'].ljust(8) + str(entry['seconds']) + ' s')
+
+
+# =====================================
+
+# The journal report of index.ipynb
+
+
+def journalReport(rb, prefix='10.21105', mailto='Anonymous',
+                  sources=('Twitter', 'Wikipedia', 'DataCite', 'Hypothesis', 'Newsfeed'),
+                  day=None, apiUrl='https://api.crossref.org',
+                  eventDataUrl='https://api.eventdata.crossref.org', maxPoints=5000):
+    '''
+    Add the steps of the journal notebook (index.ipynb) to a reportBuild:
+
+        works         works of the prefix from the REST API, once a day
+        sourceCounts  number of events from each source, once a day
+        sources       Crossref citations joined with the event counts
+        byYear        works and citations per year of publication
+        chartData     data for the bar chart and the scatter plot, reduced to at
+                      most maxPoints marks
+
+    Parameters
+    ----------
+    rb : reportBuild
+    prefix : str
+        DOI prefix of the journal
+    mailto : str
+        email address sent with API queries
+    sources : list of str
+        Event Data sources to count
+    day : str, optional
+        YYYY-MM-DD, the harvests are repeated when it changes. Defaults to today.
+    apiUrl, eventDataUrl : str
+        locations of the REST API and Event Data, e.g. a mockServer
+    maxPoints : int
+        works are plotted one by one up to this many, and binned above it
+
+    Returns
+    -------
+    reportBuild
+
+    '''
+
+    day = day or date.today().strftime('%Y-%m-%d')
+
+    @rb.step(params={'prefix': prefix, 'mailto': mailto, 'day': day, 'apiUrl': apiUrl})
+    def works(prefix, mailto, day, apiUrl):
+        ''' DOI, publication date, citation count and title of every work '''
+
+        rows = []
+        cursor = '*'
+        while True:
+            r = metrics.get(apiUrl.rstrip('/') + '/prefixes/' + prefix + '/works',
+                            params={'rows': 500, 'cursor': cursor, 'mailto': mailto,
+                                    'select': 'DOI,published,is-referenced-by-count,title'})
+            r.raise_for_status()
+            message = r.json()['message']
+            items = message.get('items', [])
+            if len(items) == 0:
+                break
+
+            for item in items:
+                parts = (item.get('published') or {}).get('date-parts') or [[]]
+                rows.append({'DOI': item['DOI'],
+                             'published': '-'.join(str(p).zfill(2) for p in parts[0]) or None,
+                             'citations': int(item.get('is-referenced-by-count') or 0),
+                             'title': (item.get('title') or [''])[0].strip()})
+            cursor = message.get('next-cursor')
+            if not cursor:
+                break
+
+        return sorted(rows, key=lambda w: (-w['citations'], w['DOI']))
+
+    @rb.step(params={'prefix': prefix, 'mailto': mailto, 'sources': list(sources), 'day': day,
+                     'eventDataUrl': eventDataUrl})
+    def sourceCounts(prefix, mailto, sources, day, eventDataUrl):
+        ''' number of events from each source '''
+
+        try:
+            from mrced2.eventData import eventData
+        except:
+            from eventData import eventData
+
+        ed = eventData(mailto=mailto, baseUrl=eventDataUrl)
+        counts = {}
+        for source in sources:
+            ed.buildQuery({'obj-id.prefix': prefix, 'source': source.lower(), 'rows': 0}, quiet=True)
+            ed.runQuery(retry=5, quiet=True, saveToFile=False)
+            if not(ed.success):
+                raise RuntimeError('Event Data query failed for ' + source)
+            counts[source] = ed.events.getHits(quiet=True)
+
+        return counts
+
+    @rb.step(inputs=['works', 'sourceCounts'])
+    def sources(works, sourceCounts):
+        ''' Crossref citations and event counts, one row per source '''
+
+        return [{'source': 'Crossref', 'count': sum(w['citations'] for w in works)}] + \
+            [{'source': s, 'count': c} for s, c in sourceCounts.items()]
+
+    @rb.step(inputs=['works'])
+    def byYear(works):
+        ''' number of works and citations by year of publication '''
+
+        years = {}
+        for w in works:
+            year = (w['published'] or '')[:4] or 'unknown'
+            y = years.setdefault(year, {'year': year, 'works': 0, 'citations': 0})
+            y['works'] += 1
+            y['citations'] += w['citations']
+
+        return [years[y] for y in sorted(years)]
+
+    @rb.step(inputs=['works', 'sources', 'byYear'], params={'maxPoints': maxPoints})
+    def chartData(works, sources, byYear, maxPoints):
+        ''' what the charts of the report plot, of a bounded size '''
+
+        try:
+            from mrced2.chartData import chartData as reducer
+        except:
+            from chartData import chartData as reducer
+
+        cd = reducer(maxPoints=maxPoints)
+
+        return {'bars': cd.bars(sources, names=('source', 'count')),
+                'scatter': cd.points([w['published'] for w in works],
+                                     [w['citations'] for w in works], yScale='log',
+                                     names=('published', 'citations')),
+                'byYear': byYear}
+
+    return rb
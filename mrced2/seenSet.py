@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A persistent record of the evidence records and events already processed,
+shared across runs and worker processes.
+
+@author: martynrittman
+"""
+
+import os
+import math
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# other processes may add bits at the same time, a lock file stops lost updates
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class seenSet:
+    '''
+    Membership of keys (evidence record URLs, event ids) in a set kept on
+    disk, so that work done by an earlier run or by another worker is
+    skipped before any network call.
+
+    Two files in `folder`:
+        bloom.bin - a Bloom filter, memory mapped. Most keys that were never
+                    added are ruled out here without touching the disk.
+        seen.sqlite - every key, the exact check for keys the filter can't
+                      rule out, so a false positive of the filter never
+                      skips new work
+
+    Keys are kept per kind, e.g. 'evidence' and 'event', so the same set can
+    hold both. Any number of processes can use the same folder.
+
+    basic usage:
+        seen = seenSet('.mrced2-cache/seen')
+        new = seen.filterNew(urls, 'evidence')    # the urls not seen before
+        ...
+        seen.addMany(new, 'evidence')
+
+    '''
+
+    def __init__(self, folder='.mrced2-cache/seen', capacity=10 ** 7, errorRate=0.001):
+        '''
+        Parameters
+        ----------
+        folder : str
+            where the files are kept, created if it doesn't exist
+        capacity : int
+            number of keys the Bloom filter is sized for. It keeps working
+            past this, with more keys going to the exact check.
+        errorRate : float
+            share of new keys that the filter lets through to the exact check,
+            at capacity
+
+        Settings of an existing set are read from it, and these are ignored.
+
+        '''
+
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(folder, 'seen.sqlite'), timeout=60,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (kind TEXT, key TEXT, '
+                        'PRIMARY KEY (kind, key)) WITHOUT ROWID')
+
+        # the first process to make the set picks the size of the filter
+        bits = max(64, int(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        bits = (bits + 7) // 8 * 8
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('bits', ?)", (str(bits),))
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('hashes', ?)", (str(hashes),))
+        self.db.commit()
+        meta = dict(self.db.execute('SELECT name, value FROM meta'))
+        self.bits = int(meta['bits'])
+        self.hashes = int(meta['hashes'])
+
+        self.bloomFile = os.path.join(folder, 'bloom.bin')
+        self._lockFile = open(os.path.join(folder, 'bloom.lock'), 'a')
+        with self._fileLock():
+            if not os.path.exists(self.bloomFile) or os.path.getsize(self.bloomFile) != self.bits // 8:
+                with open(self.bloomFile, 'ab') as f:
+                    f.truncate(self.bits // 8)
+        self.bloom = np.memmap(self.bloomFile, dtype=np.uint8, mode='r+', shape=(self.bits // 8,))
+
+        # counters for this object
+        self.checked = 0
+        self.ruledOut = 0
+
+    def close(self):
+        self.bloom.flush()
+        self.db.close()
+        self._lockFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def _fileLock(self):
+        ''' held by one process at a time, around changes to the filter; see _setBits() '''
+
+        if fcntl is not None:
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+
+    # =====================================
+
+    # Bloom filter
+
+    def _positions(self, keys, kind):
+        ''' bit positions of each key, an array of len(keys) x self.hashes '''
+
+        h = np.empty((len(keys), 2), dtype=np.uint64)
+        for i, key in enumerate(keys):
+            d = hashlib.blake2b((kind + '\0' + key).encode(), digest_size=16).digest()
+            h[i, 0] = int.from_bytes(d[:8], 'little')
+            h[i, 1] = int.from_bytes(d[8:], 'little') | 1
+
+        # double hashing: h1 + i * h2, wrapping at 2**64
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            positions = h[:, :1] + steps * h[:, 1:]
+
+        return positions % np.uint64(self.bits)
+
+    def _mightHave(self, keys, kind):
+        ''' False where a key is certainly not in the set '''
+
+        positions = self._positions(keys, kind)
+        bytesAt = (positions >> np.uint64(3)).astype(np.int64)
+        masks = (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+
+        return ((self.bloom[bytesAt] & masks) != 0).all(axis=1)
+
+    def _setBits(self, keys, kind):
+        positions = self._positions(keys, kind).ravel()
+        bytesAt = (positions >> np.uint64(3)).astype(np.int64)
+        masks = (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+
+        # flock doesn't keep out other threads using the same file, so the
+        # object's lock is held as well
+        with self._lock, self._fileLock():
+            np.bitwise_or.at(self.bloom, bytesAt, masks)
+
+    # =====================================
+
+    # Membership
+
+    def filterNew(self, keys, kind='evidence'):
+        '''
+        The keys that aren't in the set, in the order given.
+
+        Parameters
+        ----------
+        keys : list of str
+        kind : str
+            e.g. 'evidence' or 'event'
+
+        Returns
+        -------
+        list of str
+
+        '''
+
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+
+        maybe = self._mightHave(keys, kind)
+        self.checked += len(keys)
+        self.ruledOut += int((~maybe).sum())
+
+        # the exact check, only for keys the filter couldn't rule out
+        candidates = [k for k, m in zip(keys, maybe) if m]
+        found = set()
+        with self._lock:
+            for i in range(0, len(candidates), 500):
+                batch = candidates[i:i + 500]
+                rows = self.db.execute('SELECT key FROM seen WHERE kind = ? AND key IN (' +
+                                       ','.join('?' * len(batch)) + ')', [kind] + batch)
+                found.update(r[0] for r in rows)
+
+        return [k for k in keys if k not in found]
+
+    def contains(self, key, kind='evidence'):
+        ''' has the key been added? '''
+
+        return len(self.filterNew([key], kind)) == 0
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+    def addMany(self, keys, kind='evidence'):
+        ''' add keys to the set '''
+
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+
+        # the exact set first, so that a key is never in the filter only
+        with self._lock:
+            self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                                [(kind, k) for k in keys])
+            self.db.commit()
+        self._setBits(keys, kind)
+
+    def add(self, key, kind='evidence'):
+        self.addMany([key], kind)
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def count(self, kind):
+        ''' number of keys of one kind '''
+
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM seen WHERE kind = ?', (kind,)).fetchone()[0]
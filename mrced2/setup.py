@@ -16,4 +16,5 @@ setup(name='mrced2',
       author_email='mrittman@crossref.org',
       license='MIT',
       packages=['mrced2'],
+      entry_points={'console_scripts': ['mrced2=mrced2.cli:main']},
       zip_safe=False)
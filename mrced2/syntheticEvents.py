@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic Event Data corpora with the shape of real query results.
+
+@author: martynrittman
+"""
+
+import json
+import random
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+
+class syntheticEvents:
+    '''
+    Generates events that look like the results of an Event Data query (see
+    ced.json): the same fields, a mix of sources, subjects and objects that
+    depend on the source, a skewed popularity of objects and occurred_at
+    dates that grow over time. Use it for benchmarks and load tests.
+
+    The generator is seeded, so the same settings give the same corpus.
+
+    basic usage:
+        se = syntheticEvents(seed=1)
+        er = se.eventRecord(10000)          # an eventRecord in memory
+        se.writeJson('corpus.json', 10**6)  # a file, written in a stream
+
+    '''
+
+    # share of events from each source, roughly as seen for a journal prefix
+    defaultSources = {'twitter': 0.80, 'wikipedia': 0.08, 'datacite': 0.07,
+                      'newsfeed': 0.03, 'hypothesis': 0.02}
+
+    relations = {'twitter': 'discusses', 'wikipedia': 'references',
+                 'datacite': 'is-supplement-to', 'newsfeed': 'discusses',
+                 'hypothesis': 'annotates', 'reddit': 'discusses',
+                 'crossref': 'references'}
+
+    def __init__(self, seed=0, prefix='10.21105', works=2000, sources=None,
+                 start='2017-06-01', end='2021-10-01', subjects=None):
+        '''
+        Parameters
+        ----------
+        seed : int
+            random seed
+        prefix : str
+            DOI prefix of the objects
+        works : int
+            number of distinct objects (DOIs)
+        sources : dict
+            source_id -> share of events. Defaults to defaultSources.
+        start, end : str
+            range of occurred_at dates, YYYY-MM-DD
+        subjects : int
+            number of distinct subject authors/pages, defaults to 20 * works
+
+        '''
+
+        self.seed = seed
+        self.prefix = prefix
+        self.works = works
+        self.sources = dict(self.defaultSources if sources is None else sources)
+        self.start = datetime.strptime(start, '%Y-%m-%d')
+        self.end = datetime.strptime(end, '%Y-%m-%d')
+        self.subjects = subjects or 20 * works
+
+    @classmethod
+    def fromSample(cls, er, **kwargs):
+        '''
+        Settings taken from real events: the source mix, number of distinct
+        objects and range of dates of an eventRecord.
+
+        '''
+
+        events = er.jsonData['message']['events']
+        counts = {}
+        for ev in events:
+            counts[ev['source_id']] = counts.get(ev['source_id'], 0) + 1
+
+        dates = sorted(ev['occurred_at'][:10] for ev in events)
+        settings = {'sources': {s: c / float(len(events)) for s, c in counts.items()},
+                    'works': max(1, len(set(ev['obj_id'] for ev in events))),
+                    'start': dates[0], 'end': dates[-1]}
+        settings.update(kwargs)
+
+        return cls(**settings)
+
+    # =====================================
+
+    # Generating events
+
+    def iterEvents(self, n, seed=None):
+        '''
+        Yield n events.
+
+        Parameters
+        ----------
+        n : int
+            number of events
+        seed : int, optional
+            overrides self.seed
+
+        '''
+
+        rnd = random.Random(self.seed if seed is None else seed)
+        sources = list(self.sources)
+        weights = [self.sources[s] for s in sources]
+        span = (self.end - self.start).total_seconds()
+
+        # draw sources in blocks, it's much faster than one at a time
+        block = 10000
+        for i0 in range(0, n, block):
+            drawn = rnd.choices(sources, weights, k=min(block, n - i0))
+            for source in drawn:
+                # popularity of works is skewed: a few get most of the events
+                work = int(self.works * rnd.random() ** 3)
+                doi = self.prefix + '/synthetic.' + str(work).zfill(5)
+
+                # activity grows over time, so later dates are more likely
+                occurred = self.start + timedelta(seconds=span * rnd.random() ** 0.5)
+                collected = occurred + timedelta(seconds=int(rnd.expovariate(1 / 3600.0)))
+
+                yield self.makeEvent(rnd, source, doi, occurred, collected)
+
+    def makeEvent(self, rnd, source, doi, occurred, collected):
+        ''' one event from a given source, for a given DOI '''
+
+        author = rnd.randrange(self.subjects)
+        eid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+        date = occurred.strftime('%Y%m%d')
+
+        if source == 'twitter':
+            status = str(rnd.getrandbits(60))
+            subjId = 'http://twitter.com/user' + str(author) + '/statuses/' + status
+            subj = {'pid': subjId, 'title': 'Tweet ' + status,
+                    'issued': occurred.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'author': {'url': 'http://www.twitter.com/user' + str(author)},
+                    'alternative-id': status}
+            if rnd.random() < 0.5:
+                original = rnd.randrange(self.subjects)
+                subj['original-tweet-url'] = 'http://twitter.com/user' + \
+                    str(original) + '/statuses/' + str(rnd.getrandbits(60))
+                subj['original-tweet-author'] = 'http://www.twitter.com/user' + str(original)
+        elif source == 'wikipedia':
+            lang = rnd.choice(('en', 'en', 'en', 'de', 'fr', 'es', 'ja'))
+            subjId = 'https://' + lang + '.wikipedia.org/wiki/Page_' + str(author)
+            subj = {'pid': subjId, 'url': subjId, 'title': 'Page ' + str(author),
+                    'api-url': 'https://' + lang + '.wikipedia.org/w/index.php?title=Page_' + str(author)}
+        elif source in ('datacite', 'crossref'):
+            subjId = 'https://doi.org/10.5281/zenodo.' + str(author)
+            subj = {'pid': subjId, 'work_type_id': 'dataset'}
+        else:
+            subjId = 'https://blog' + str(author % 500) + '.example.org/post/' + str(author)
+            subj = {'pid': subjId, 'url': subjId, 'title': 'Post ' + str(author)}
+
+        return {
+            'license': 'https://creativecommons.org/publicdomain/zero/1.0/',
+            'obj_id': 'https://doi.org/' + doi,
+            'source_token': str(uuid.UUID(int=zlib.crc32(source.encode()), version=4)),
+            'occurred_at': occurred.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'subj_id': subjId,
+            'id': eid,
+            'evidence_record': 'https://evidence.eventdata.crossref.org/evidence/' +
+                               date + '-' + source + '-' + eid,
+            'terms': 'https://doi.org/10.13003/CED-terms-of-use',
+            'action': 'add',
+            'subj': subj,
+            'source_id': source,
+            'obj': {'pid': 'https://doi.org/' + doi,
+                    'url': 'https://joss.theoj.org/papers/' + doi},
+            'timestamp': collected.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'relation_type_id': self.relations.get(source, 'discusses'),
+        }
+
+    def events(self, n, seed=None):
+        ''' list of n events '''
+
+        return list(self.iterEvents(n, seed))
+
+    def jsonData(self, n, seed=None):
+        ''' n events wrapped like an Event Data query result '''
+
+        return {'status': 'ok', 'message-type': 'event-list',
+                'message': {'next-cursor': None, 'total-results': n,
+                            'items-per-page': n, 'events': self.events(n, seed)}}
+
+    def eventRecord(self, n, seed=None):
+        ''' an eventRecord holding n events '''
+
+        try:
+            from mrced2.eventRecord import eventRecord
+        except:
+            from eventRecord import eventRecord
+
+        er = eventRecord()
+        er.addJsonData(self.jsonData(n, seed))
+
+        return er
+
+    def writeJson(self, filename, n, seed=None):
+        '''
+        Write n events to a json file in the Event Data format, one event at a
+        time, so that corpora larger than memory can be written.
+
+        '''
+
+        with open(filename, 'w') as f:
+            f.write('{"status": "ok", "message-type": "event-list", "message": '
+                    '{"next-cursor": null, "total-results": ' + str(n) +
+                    ', "items-per-page": ' + str(n) + ', "events": [')
+            for i, ev in enumerate(self.iterEvents(n, seed)):
+                if i:
+                    f.write(', ')
+                f.write(json.dumps(ev))
+            f.write(']}}')
+
+    def evidenceRecord(self, n, source='wikipedia', seed=None):
+        '''
+        An evidence record with n actions, shaped like those used by
+        evidenceRecords.countDomains (and countTwitterDomains for twitter).
+
+        '''
+
+        rnd = random.Random(self.seed if seed is None else seed)
+        actions = []
+        for ev in self.iterEvents(n, seed):
+            obs = [{'type': 'url', 'candidates': [{'value': ev['obj']['url']}, {'value': ev['obj_id']}]}]
+            events = [ev] if rnd.random() < 0.7 else []
+            actions.append({'url': ev['subj_id'], 'subj': ev['subj'].copy(),
+                            'processed-observations': obs, 'events': events})
+            actions[-1]['subj'].setdefault('url', ev['subj_id'])
+
+        return {'id': str(uuid.UUID(int=rnd.getrandbits(128), version=4)),
+                'agent': {'name': source + '-agent'},
+                'pages': [{'actions': actions}]}
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Turn batches of works from the Crossref REST API into flat records.
+
+@author: martynrittman
+"""
+
+import re
+
+
+# Abstract cleaning removes "jats:" from a whole column joined into one
+# string, so that substitution runs once per batch rather than once per work.
+# Columns that contain the separator are cleaned one value at a time instead.
+SEP = '\x1e'
+
+# default patterns for the covid flag
+COVID_PATTERNS = (r'CoV-2', r'COVID')
+
+# leading <title>...</title> element of an abstract
+TITLE_RE = re.compile(r'^<title>.*?</title>')
+
+
+def compilePatterns(patterns, flags=re.IGNORECASE):
+    '''
+    Compile several patterns into a single alternation so that text can be
+    classified in one pass.
+
+    Parameters
+    ----------
+    patterns : list of str
+        regular expressions, any of which counts as a match
+
+    Returns
+    -------
+    compiled regular expression
+
+    '''
+
+    return re.compile('|'.join('(?:' + p + ')' for p in patterns), flags)
+
+
+def compilePath(path):
+    '''
+    Turn a path like ("message", "title", 0) or "posted.date-parts.0" into a
+    function that takes a list of dicts and returns a list of the values at
+    that path, with None where the value is missing.
+
+    '''
+
+    if isinstance(path, str):
+        path = path.split('.')
+    keys = [int(p) if isinstance(p, str) and p.isdigit() else p for p in path]
+
+    def get(w):
+        for key in keys:
+            if isinstance(w, dict):
+                w = w.get(key)
+            elif isinstance(w, list) and isinstance(key, int) and -len(w) <= key < len(w):
+                w = w[key]
+            else:
+                return None
+        return w
+
+    def column(works):
+        return [get(w) for w in works]
+
+    return column
+
+
+def authorNames(authors):
+    ''' the string of [{"name": "given family"}, ...] produced by restApi.authorName '''
+
+    if not authors:
+        return '[]'
+
+    return '[' + ', '.join(["{'name': %r}" % (a.get("given", '') + ' ' + a.get("family", ''))
+                            for a in authors]) + ']'
+
+
+def datePartsToString(date_parts, fill=False):
+    '''
+    Return a CSL date-parts list as ISO formatted string:
+    ('YYYY', 'YYYY-MM', 'YYYY-MM-DD', or None).
+
+    Parameters
+    ----------
+    date_parts : list or tuple
+        like [year, month, day] as integers, also [year, month] and [year]
+        where the day or month-and-day are missing
+    fill : bool
+        if True, set missing months to January and missing days to the
+        first day of the month
+
+    From https://manubot.github.io/manubot/reference/manubot/cite/csl_item/,
+    used by restApi.date_parts_to_string.
+
+    '''
+
+    if not date_parts:
+        return None
+
+    if not isinstance(date_parts, (tuple, list)):
+        raise ValueError("date_parts must be a tuple or list")
+
+    while fill and 1 <= len(date_parts) < 3:
+        date_parts.append(1)
+
+    widths = 4, 2, 2
+    str_parts = []
+    for i, part in enumerate(date_parts[:3]):
+        width = widths[i]
+        if isinstance(part, int):
+            part = str(part)
+        if not isinstance(part, str):
+            break
+        part = part.zfill(width)
+        if len(part) != width or not part.isdigit():
+            break
+        str_parts.append(part)
+
+    if not str_parts:
+        return None
+
+    return "-".join(str_parts)
+
+
+class workExtractor:
+    '''
+    A declarative, compiled mapping from work JSON (the "message" of a
+    /works/{doi} response, or an item of a /works list) to flat records.
+
+    The spec is a dictionary of column name -> field, where field is one of:
+        a path, e.g. "title.0" or ("institution", 0, "name")
+        a tuple (path, function), the function is applied to the value
+
+    Text columns are processed in batches after extraction:
+        flags - dict of column -> (list of source columns, list of patterns),
+                the column is True if any pattern is found in the source
+                columns joined together (e.g. title + abstract)
+        clean - list of columns that are cleaned like abstracts (jats:
+                namespaces and leading titles removed)
+
+    basic usage:
+        we = workExtractor()
+        columns = we.extract(works)
+        records = we.toRecords(columns)
+
+    '''
+
+    # the fields produced by restApi.runQuery
+    defaultSpec = {
+        "archive": "institution.0.name",
+        "subject-area": "group-title",
+        "title": "title.0",
+        "authors": ("author", authorNames),
+        "abstract": "abstract",
+        "posted": ("posted.date-parts.0", datePartsToString),
+    }
+
+    defaultFlags = {"covid": (["title", "abstract"], COVID_PATTERNS)}
+
+    defaultClean = ["abstract"]
+
+    def __init__(self, spec=None, flags=None, clean=None):
+        '''
+        Parameters
+        ----------
+        spec : dict
+            column name -> path or (path, function), see the class docstring.
+            The default reproduces restApi.runQuery.
+        flags : dict
+            column name -> (source columns, patterns)
+        clean : list
+            columns to clean as abstracts
+
+        '''
+
+        self.spec = dict(self.defaultSpec if spec is None else spec)
+        self.flags = dict(self.defaultFlags if flags is None else flags)
+        self.clean = list(self.defaultClean if clean is None else clean)
+
+        self.compile()
+
+    def compile(self):
+        ''' Compile the spec. Needs re-running if self.spec, self.flags or self.clean change. '''
+
+        self._getters = []
+        for column, field in self.spec.items():
+            if isinstance(field, tuple) and len(field) == 2 and callable(field[1]):
+                self._getters.append((column, compilePath(field[0]), field[1]))
+            else:
+                self._getters.append((column, compilePath(field), None))
+
+        self._flags = [(column, sources, compilePatterns(patterns))
+                       for column, (sources, patterns) in self.flags.items()]
+
+    def addField(self, column, path, function=None):
+        ''' add a new column to the spec '''
+
+        self.spec[column] = path if function is None else (path, function)
+        self.compile()
+
+    def addFlag(self, column, sources, patterns):
+        ''' add a new pattern flag computed from the text of the source columns '''
+
+        self.flags[column] = (sources, patterns)
+        self.compile()
+
+    # =====================================
+
+    # Extraction
+
+    def extract(self, works):
+        '''
+        Extract a batch of works into columns.
+
+        Parameters
+        ----------
+        works : list of dicts
+            work metadata as returned by the REST API
+
+        Returns
+        -------
+        dict of lists:
+            column name -> list of values, one per work
+
+        '''
+
+        columns = {}
+
+        # plain fields, one loop per column
+        for column, getColumn, function in self._getters:
+            values = getColumn(works)
+            if function is not None:
+                values = [function(v) for v in values]
+            columns[column] = values
+
+        # pattern flags, computed on the raw text before cleaning, on the
+        # source columns joined as restApi has always done (title + abstract)
+        for column, sources, pattern in self._flags:
+            if len(sources) == 1:
+                texts = columns[sources[0]]
+            else:
+                texts = [''.join(v for v in row if v.__class__ is str)
+                         for row in zip(*(columns[s] for s in sources))]
+            columns[column] = self.flagColumn(texts, pattern)
+
+        for column in self.clean:
+            columns[column] = self.cleanColumn(columns[column])
+
+        return columns
+
+    def flagColumn(self, values, pattern):
+        '''
+        For each string in values, is the pattern found? All the patterns for
+        a flag are compiled into one expression, so each value is scanned once.
+
+        Returns
+        -------
+        list of booleans
+
+        '''
+
+        search = pattern.search
+        return [v.__class__ is str and search(v) is not None for v in values]
+
+    def cleanColumn(self, values):
+        '''
+        Clean a column of abstracts: remove "jats:" namespaces and a leading
+        <title> element. Missing values stay as None.
+
+        '''
+
+        present = [i for i, v in enumerate(values) if isinstance(v, str)]
+        if len(present) == 0:
+            return list(values)
+
+        if any(SEP in values[i] for i in present):
+            cleaned = [values[i].replace('jats:', '') for i in present]
+        else:
+            cleaned = SEP.join(values[i] for i in present).replace('jats:', '').split(SEP)
+
+        # the title pattern only runs on the abstracts that start with one
+        sub = TITLE_RE.sub
+        out = list(values)
+        for i, v in zip(present, cleaned):
+            out[i] = sub('', v, 1) if v.startswith('<title>') else v
+
+        return out
+
+    def toRecords(self, columns):
+        ''' turn columns produced by extract() into a list of dicts '''
+
+        names = list(columns)
+        return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+    def extractRecords(self, works):
+        ''' extract() followed by toRecords() '''
+
+        return self.toRecords(self.extract(works))
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Daily snapshots of a prefix's works, stored as a base snapshot plus small
+per-day deltas keyed by DOI.
+
+@author: martynrittman
+"""
+
+import os
+import re
+import csv
+import gzip
+import json
+
+import numpy as np
+
+
+class worksSnapshots:
+    '''
+    A store of daily works snapshots, like works_10.21105_2021-10-25.csv.
+
+    The first snapshot is kept in full (base.npz). Each later day is stored as
+    a delta (YYYY-MM-DD.json.gz) holding only the DOIs whose citation count,
+    publication date or title changed, the DOIs that are new and the DOIs that
+    disappeared. DOIs are numbered in the order they were first seen, and
+    citation counts are held in numpy arrays indexed by that number, so a year
+    of snapshots takes about as much space as one, and diffs and time series
+    are computed from the deltas without rebuilding any CSV.
+
+    basic usage:
+        ws = worksSnapshots('10.21105/snapshots')
+        ws.addCsv('works_10.21105_2021-10-25.csv')
+        ws.addCsv('works_10.21105_2021-10-26.csv')
+        changes = ws.diff('2021-10-25', '2021-10-26')
+        dates, counts = ws.timeSeries(['10.21105/joss.01686'])
+
+    '''
+
+    # the columns of the works CSVs written by index.ipynb
+    csvColumns = {'doi': 'DOI', 'published': 'published.date-parts',
+                  'citations': 'is-referenced-by-count', 'title': 'title'}
+
+    def __init__(self, folder):
+        '''
+        Parameters
+        ----------
+        folder : str
+            directory that holds the snapshots, created if it doesn't exist
+
+        '''
+
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        self.dois = []  # DOI of each number
+        self.position = {}  # DOI -> number
+        self.dates = []  # dates of the snapshots, the first is the base
+
+        # the latest snapshot, used to compute the next delta
+        self.citations = np.zeros(0, dtype=np.int64)
+        self.present = np.zeros(0, dtype=bool)
+        self.published = []
+        self.titles = []
+
+        # date -> delta, see _readDelta()
+        self.deltas = {}
+
+        # the base snapshot's columns, the starting point of every query
+        self.base = {'citations': np.zeros(0, dtype=np.int64), 'published': [], 'titles': []}
+
+        self.load()
+
+    # =====================================
+
+    # Storage
+
+    def _path(self, name):
+        return os.path.join(self.folder, name + '.npz')
+
+    def _save(self, name, **arrays):
+        # numpy adds .npz to names without it, so the temporary file keeps the suffix
+        tmp = os.path.join(self.folder, name + '.tmp.npz')
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, self._path(name))
+
+    def _deltaPath(self, date):
+        return os.path.join(self.folder, date + '.json.gz')
+
+    def _writeDelta(self, date, delta):
+        # a day's delta is small, and gzipped json is a quarter of the size of an npz
+        content = json.dumps({'index': delta['index'].tolist(),
+                              'citations': delta['citations'].tolist(),
+                              'removed': delta['removed'].tolist(),
+                              'newDois': delta['newDois'],
+                              'text': {str(k): v for k, v in delta['text'].items()}})
+        with gzip.open(self._deltaPath(date) + '.tmp', 'wt') as f:
+            f.write(content)
+        os.replace(self._deltaPath(date) + '.tmp', self._deltaPath(date))
+
+    def _readDelta(self, date):
+        ''' a delta file, with numpy arrays of DOI numbers and counts '''
+
+        with gzip.open(self._deltaPath(date), 'rt') as f:
+            d = json.load(f)
+
+        return {'index': np.array(d['index'], dtype=np.int64),
+                'citations': np.array(d['citations'], dtype=np.int64),
+                'removed': np.array(d['removed'], dtype=np.int64), 'newDois': d['newDois'],
+                'text': {int(k): v for k, v in d['text'].items()}}
+
+    def load(self):
+        ''' read the base and the deltas, and bring the latest snapshot up to date '''
+
+        if not os.path.exists(self._path('base')):
+            return
+
+        with np.load(self._path('base')) as d:
+            self.dates = [str(d['date'])]
+            self.dois = json.loads(str(d['dois']))
+            self.citations = d['citations'].copy()
+            self.present = np.ones(len(self.dois), dtype=bool)
+            self.published = json.loads(str(d['published']))
+            self.titles = json.loads(str(d['titles']))
+        self.base = {'citations': self.citations.copy(), 'published': list(self.published),
+                     'titles': list(self.titles)}
+
+        deltas = sorted(f[:10] for f in os.listdir(self.folder)
+                        if re.match(r'^\d{4}-\d{2}-\d{2}\.json\.gz$', f))
+        for date in deltas:
+            delta = self._readDelta(date)
+            self.deltas[date] = delta
+            self.dates.append(date)
+            self._apply(delta)
+
+        self.position = {doi: i for i, doi in enumerate(self.dois)}
+
+    def _apply(self, delta):
+        ''' apply a delta to the latest snapshot '''
+
+        n = len(delta['newDois'])
+        if n:
+            self.dois += delta['newDois']
+            self.citations = np.concatenate([self.citations, np.zeros(n, dtype=np.int64)])
+            self.present = np.concatenate([self.present, np.zeros(n, dtype=bool)])
+            self.published += [None] * n
+            self.titles += [None] * n
+
+        self.citations[delta['index']] = delta['citations']
+        self.present[delta['index']] = True
+        self.present[delta['removed']] = False
+        for i, (published, title) in delta['text'].items():
+            self.published[i] = published
+            self.titles[i] = title
+
+    # =====================================
+
+    # Adding snapshots
+
+    def add(self, date, dois, citations, published=None, titles=None):
+        '''
+        Add the snapshot for a day. Snapshots must be added in date order.
+
+        Parameters
+        ----------
+        date : str
+            YYYY-MM-DD
+        dois : list of str
+        citations : list of int
+            citation count of each DOI
+        published, titles : list of str, optional
+            publication date and title of each DOI
+
+        Returns
+        -------
+        dict:
+            numbers of DOIs that changed, were added and were removed
+
+        '''
+
+        if self.dates and date <= self.dates[-1]:
+            raise ValueError('snapshots must be added in date order, the last is ' + self.dates[-1])
+
+        dois = [d.lower() for d in dois]
+        published = list(published) if published is not None else [None] * len(dois)
+        titles = list(titles) if titles is not None else [None] * len(dois)
+        citations = np.asarray(citations, dtype=np.int64)
+
+        # a DOI listed twice keeps its last row
+        rows = {doi: i for i, doi in enumerate(dois)}
+
+        if not self.dates:
+            order = list(rows.values())
+            self.dois = list(rows)
+            self.position = {doi: i for i, doi in enumerate(self.dois)}
+            self.citations = citations[order]
+            self.present = np.ones(len(self.dois), dtype=bool)
+            self.published = [published[i] for i in order]
+            self.titles = [titles[i] for i in order]
+            self.dates = [date]
+            self.base = {'citations': self.citations.copy(), 'published': list(self.published),
+                         'titles': list(self.titles)}
+            self._save('base', date=np.array(date), dois=np.array(json.dumps(self.dois)),
+                       citations=self.citations,
+                       published=np.array(json.dumps(self.published)),
+                       titles=np.array(json.dumps(self.titles)))
+            return {'changed': 0, 'added': len(self.dois), 'removed': 0}
+
+        newDois = [doi for doi in rows if doi not in self.position]
+        start = len(self.dois)
+        position = dict(self.position)
+        for i, doi in enumerate(newDois):
+            position[doi] = start + i
+
+        index = np.fromiter((position[doi] for doi in rows), dtype=np.int64, count=len(rows))
+        values = citations[list(rows.values())]
+
+        # compare with the latest snapshot, new DOIs always count as changed
+        old = np.zeros(len(index), dtype=np.int64)
+        known = index < start
+        old[known] = self.citations[index[known]]
+        wasPresent = np.zeros(len(index), dtype=bool)
+        wasPresent[known] = self.present[index[known]]
+        changed = (values != old) | ~wasPresent
+
+        text = {}
+        for (doi, row), i in zip(rows.items(), index.tolist()):
+            if i >= start or (self.published[i], self.titles[i]) != (published[row], titles[row]):
+                text[i] = [published[row], titles[row]]
+
+        seen = np.zeros(start + len(newDois), dtype=bool)
+        seen[index] = True
+        removed = np.flatnonzero(~seen[:start] & self.present)
+
+        delta = {'index': index[changed], 'citations': values[changed], 'removed': removed,
+                 'newDois': newDois, 'text': text}
+        self._writeDelta(date, delta)
+
+        self.deltas[date] = delta
+        self.dates.append(date)
+        self._apply(delta)
+        self.position = position
+
+        return {'changed': int(changed.sum()) - len(newDois), 'added': len(newDois),
+                'removed': len(removed)}
+
+    def addCsv(self, filename, date=None):
+        '''
+        Add a works CSV written by index.ipynb (DOI, published.date-parts,
+        is-referenced-by-count, title).
+
+        Parameters
+        ----------
+        filename : str
+        date : str, optional
+            YYYY-MM-DD, taken from the file name if not given
+
+        '''
+
+        if date is None:
+            m = re.search(r'(\d{4}-\d{2}-\d{2})', os.path.basename(filename))
+            if m is None:
+                raise ValueError('no date in ' + filename + ', pass one')
+            date = m.group(1)
+
+        c = self.csvColumns
+        dois, citations, published, titles = [], [], [], []
+        with open(filename, newline='') as f:
+            for row in csv.DictReader(f):
+                dois.append(row[c['doi']])
+                try:
+                    citations.append(int(row[c['citations']]))
+                except ValueError:
+                    citations.append(0)
+                published.append(row[c['published']] or None)
+                titles.append(row[c['title']])
+
+        return self.add(date, dois, citations, published, titles)
+
+    # =====================================
+
+    # Queries
+
+    def _check(self, date):
+        if date not in self.dates:
+            raise KeyError('no snapshot for ' + date)
+
+    def citationsAt(self, date):
+        '''
+        Citation counts on a date, from the base and the deltas up to it.
+
+        Returns
+        -------
+        (numpy array, numpy array):
+            citation count and presence (boolean) of each DOI number
+        '''
+
+        self._check(date)
+        base = self.base['citations']
+
+        citations = np.zeros(len(self.dois), dtype=np.int64)
+        present = np.zeros(len(self.dois), dtype=bool)
+        citations[:len(base)] = base
+        present[:len(base)] = True
+
+        for day in self.dates[1:self.dates.index(date) + 1]:
+            delta = self.deltas[day]
+            citations[delta['index']] = delta['citations']
+            present[delta['index']] = True
+            present[delta['removed']] = False
+
+        return citations, present
+
+    def snapshot(self, date=None):
+        '''
+        The works on a date (the latest by default).
+
+        Returns
+        -------
+        dict:
+            columns doi, citations, published, title
+        '''
+
+        date = date or self.dates[-1]
+        citations, present = self.citationsAt(date)
+
+        # text fields from the base and the deltas up to the date
+        extra = [None] * (len(self.dois) - len(self.base['titles']))
+        published = self.base['published'] + extra
+        titles = self.base['titles'] + extra
+        for day in self.dates[1:self.dates.index(date) + 1]:
+            for i, (p, t) in self.deltas[day]['text'].items():
+                published[i] = p
+                titles[i] = t
+
+        keep = np.flatnonzero(present)
+        return {'doi': [self.dois[i] for i in keep], 'citations': citations[keep],
+                'published': [published[i] for i in keep], 'title': [titles[i] for i in keep]}
+
+    def diff(self, start, end):
+        '''
+        Changes in citation counts from one date to another.
+
+        Parameters
+        ----------
+        start, end : str
+            dates of two snapshots, YYYY-MM-DD
+
+        Returns
+        -------
+        dict:
+            doi, before, after and change (arrays) for the DOIs whose count
+            changed, largest increase first, and lists of DOIs added and removed
+
+        '''
+
+        before, wasPresent = self.citationsAt(start)
+        after, isPresent = self.citationsAt(end)
+
+        # only DOIs touched by a delta in between can differ
+        i0, i1 = sorted((self.dates.index(start), self.dates.index(end)))
+        touched = [self.deltas[day]['index'] for day in self.dates[i0 + 1:i1 + 1]]
+        touched += [self.deltas[day]['removed'] for day in self.dates[i0 + 1:i1 + 1]]
+        touched = np.unique(np.concatenate(touched)) if touched else np.zeros(0, dtype=np.int64)
+
+        both = touched[wasPresent[touched] & isPresent[touched]]
+        change = after[both] - before[both]
+        keep = change != 0
+        both, change = both[keep], change[keep]
+        order = np.lexsort((both, -change))
+        both, change = both[order], change[order]
+
+        return {'doi': [self.dois[i] for i in both], 'before': before[both], 'after': after[both],
+                'change': change,
+                'added': [self.dois[i] for i in touched[isPresent[touched] & ~wasPresent[touched]]],
+                'removed': [self.dois[i] for i in touched[wasPresent[touched] & ~isPresent[touched]]]}
+
+    def timeSeries(self, dois=None):
+        '''
+        Citation counts of DOIs on every date.
+
+        Parameters
+        ----------
+        dois : list of str, optional
+            defaults to every DOI
+
+        Returns
+        -------
+        (list of str, numpy array):
+            the dates, and a (DOIs x dates) array of counts, -1 where a DOI
+            wasn't in a snapshot
+
+        '''
+
+        if dois is None:
+            index = np.arange(len(self.dois))
+        else:
+            index = np.array([self.position[d.lower()] for d in dois], dtype=np.int64)
+
+        # position of each DOI number in the output, -1 if it isn't wanted
+        rowOf = np.full(len(self.dois), -1, dtype=np.int64)
+        rowOf[index] = np.arange(len(index))
+
+        base = self.base['citations']
+
+        values = np.full(len(index), -1, dtype=np.int64)
+        inBase = index < len(base)
+        values[inBase] = base[index[inBase]]
+
+        series = np.empty((len(index), len(self.dates)), dtype=np.int64)
+        series[:, 0] = values
+        for j, day in enumerate(self.dates[1:], start=1):
+            delta = self.deltas[day]
+            rows = rowOf[delta['index']]
+            sel = rows >= 0
+            values[rows[sel]] = delta['citations'][sel]
+            rows = rowOf[delta['removed']]
+            values[rows[rows >= 0]] = -1
+            series[:, j] = values
+
+        return list(self.dates), series
+
+    def size(self):
+        ''' bytes on disk '''
+
+        return sum(os.path.getsize(os.path.join(self.folder, f)) for f in os.listdir(self.folder))